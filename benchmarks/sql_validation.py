@@ -0,0 +1,126 @@
+"""
+Benchmark SQL validation: parser-based validator vs. the former keyword substring check.
+
+Validates a labelled corpus of generated queries with both validators and prints, per validator, the
+time per query and how many valid queries were wrongly rejected (each costing an LLM correction round
+trip) or invalid ones wrongly accepted. The parser-based validator is measured cold (parse cache
+cleared before every query) and through ``SQLiteRepository.validate_query`` with a warm schema cache.
+
+Usage:
+    python -m benchmarks.sql_validation --repeat 200
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import create_engine, text
+
+from sql_agent.repositories.exceptions import ValidationError
+from sql_agent.repositories.sql_validation import parse_statement, schema_from_metadata, validate_read_only_query
+from sql_agent.repositories.sqlite_repository import SQLiteRepository
+
+SCHEMA = """
+CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT, created_date DATE, deleted BOOLEAN);
+CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, price NUMERIC, updated_at TIMESTAMP);
+CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER, product_id INTEGER, quantity INTEGER,
+                     status TEXT, created_date DATE, updated_at TIMESTAMP);
+"""
+TABLE_NAMES = ("customers", "products", "orders")
+
+# (query, whether it should pass validation)
+CORPUS = [
+    ("SELECT * FROM orders", True),
+    ("SELECT id, updated_at FROM orders ORDER BY updated_at DESC LIMIT 10", True),
+    ("SELECT name, created_date FROM customers WHERE deleted = 0", True),
+    ("SELECT status, COUNT(*) AS n FROM orders GROUP BY status HAVING COUNT(*) > 1", True),
+    ("SELECT c.name, SUM(p.price * o.quantity) AS total FROM orders o JOIN customers c ON c.id = o.customer_id "
+     "JOIN products p ON p.id = o.product_id WHERE o.created_date >= '2024-01-01' GROUP BY c.name "
+     "ORDER BY total DESC LIMIT 10", True),
+    ("WITH recent AS (SELECT customer_id, COUNT(*) AS n FROM orders WHERE status = 'delivered' "
+     "GROUP BY customer_id) SELECT c.name, r.n FROM customers c JOIN recent r ON r.customer_id = c.id", True),
+    ("SELECT name FROM customers c WHERE EXISTS (SELECT 1 FROM orders WHERE customer_id = c.id)", True),
+    ("SELECT name FROM products WHERE name LIKE '%update%' OR name = 'DROP-IN adapter'", True),
+    ("SELECT id FROM orders UNION SELECT id FROM customers ORDER BY id", True),
+    ("VACUUM INTO '/tmp/select_from_orders.db'", False),
+    ("DROP TABLE orders", False),
+    ("SELECT * FROM orders; DELETE FROM orders", False),
+    ("WITH gone AS (DELETE FROM orders RETURNING *) SELECT * FROM gone", False),
+    ("SELECT total FROM orders", False),
+    ("SELECT o.amount FROM orders o", False),
+    ("SELECT * FROM order_items", False),
+    ("SELECT id FROM orders WHERE status = \"shipped\"", False),
+    ("SELECT FROM orders WHERE", False),
+]
+
+
+def keyword_check(query: str):
+    """Substring check used by ``validate_query`` before the parser-based validator"""
+    if not query:
+        raise ValidationError("Empty SQL query")
+
+    sql_upper = query.upper()
+    if 'SELECT' not in sql_upper or 'FROM' not in sql_upper:
+        raise ValidationError("Generated query does not contain SELECT and FROM clauses")
+
+    dangerous_keywords = ['DROP', 'DELETE', 'UPDATE', 'INSERT', 'CREATE', 'ALTER', 'TRUNCATE', 'GRANT', 'REVOKE']
+    for keyword in dangerous_keywords:
+        if keyword in sql_upper:
+            raise ValidationError(f"Generated query contains potentially dangerous keyword: {keyword}")
+
+
+def run(validate, repeat, before_each=None):
+    """Validate the corpus ``repeat`` times, returning per-query timings and the number of wrong verdicts"""
+    timings = []
+    false_rejections = false_acceptances = 0
+    for iteration in range(repeat):
+        for query, expected in CORPUS:
+            if before_each:
+                before_each()
+            start = time.perf_counter()
+            try:
+                validate(query)
+                accepted = True
+            except ValidationError:
+                accepted = False
+            timings.append(time.perf_counter() - start)
+            if iteration == 0:
+                false_rejections += expected and not accepted
+                false_acceptances += accepted and not expected
+    return timings, false_rejections, false_acceptances
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=100, help="Passes over the query corpus per validator")
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as conn:
+        for statement in SCHEMA.split(";"):
+            if statement.strip():
+                conn.execute(text(statement))
+    repository = SQLiteRepository(engine=engine)
+    schema = schema_from_metadata(repository.get_table_metadata(TABLE_NAMES), "sqlite")
+
+    variants = [
+        ("keyword", keyword_check, None),
+        ("parser (cold)", lambda query: validate_read_only_query(query, "sqlite", schema), parse_statement.cache_clear),
+        ("repository", lambda query: repository.validate_query(query, TABLE_NAMES), parse_statement.cache_clear),
+        ("repository (cached parse)", lambda query: repository.validate_query(query, TABLE_NAMES), None),
+    ]
+
+    print(f"{len(CORPUS)} queries, {sum(expected for _, expected in CORPUS)} valid")
+    print(f"{'validator':>26} {'median µs':>10} {'p95 µs':>8} {'max µs':>8} {'false rejections':>17} "
+          f"{'false acceptances':>18}")
+    for label, validate, before_each in variants:
+        timings, false_rejections, false_acceptances = run(validate, args.repeat, before_each)
+        timings.sort()
+        print(f"{label:>26} {statistics.median(timings) * 1e6:>10.1f} "
+              f"{timings[int(len(timings) * 0.95)] * 1e6:>8.1f} {timings[-1] * 1e6:>8.1f} "
+              f"{false_rejections:>17} {false_acceptances:>18}")
+
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,5 +11,10 @@ python manage.py create_superuser
 echo "Seeding database with sample data..."
 python manage.py seed_db --num 1000
 
+if [ "${SERVER:-runserver}" = "uvicorn" ]; then
+    echo "Starting the ASGI server..."
+    exec uvicorn querycraft.asgi:application --host 0.0.0.0 --port 8000 --workers "${UVICORN_WORKERS:-1}"
+fi
+
 echo "Starting the Django server..."
 exec python manage.py runserver 0.0.0.0:8000
\ No newline at end of file
@@ -0,0 +1,111 @@
+import contextlib
+import logging
+import selectors
+import socket
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+from sql_agent.cancellation import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+
+def client_socket(request) -> Optional[socket.socket]:
+    """
+    Socket of the client of a WSGI request, if the server exposes it: gunicorn does, and the Django development
+    server passes its buffered reader of the socket as ``wsgi.input``. ASGI requests have none; Django cancels the
+    task of an async view when its client disconnects instead.
+    """
+    sock = request.META.get('gunicorn.socket')
+    if sock is None:
+        # Django wraps the input in a LimitedStream, which keeps the read method of the buffered reader
+        stream = request.META.get('wsgi.input')
+        reader = getattr(getattr(stream, '_read', None), '__self__', stream)
+        sock = getattr(getattr(reader, 'raw', None), '_sock', None)
+    return sock if isinstance(sock, socket.socket) else None
+
+
+class DisconnectWatcher:
+    """
+    Cancels the ``CancellationToken`` of a request answered by a sync view once its client closes the connection.
+
+    A single background thread polls the sockets of the requests in progress every ``interval`` seconds; a socket
+    that is readable but has no data left to read was closed by the client. Sockets on which the client sent more
+    data, e.g. a pipelined request, are no longer watched.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.disconnects = 0
+        self._watched: Dict[socket.socket, CancellationToken] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @contextlib.contextmanager
+    def watch(self, request) -> Iterator[CancellationToken]:
+        """Token cancelled when the client of ``request`` disconnects while the block runs"""
+        token = CancellationToken()
+        sock = client_socket(request)
+        if sock is None:
+            yield token
+            return
+
+        with self._lock:
+            self._watched[sock] = token
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name="disconnect-watcher", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        try:
+            yield token
+        finally:
+            with self._lock:
+                self._watched.pop(sock, None)
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                watched = dict(self._watched)
+                if not watched:
+                    self._wakeup.clear()
+            if not watched:
+                self._wakeup.wait()
+                continue
+
+            try:
+                for sock in self._readable(watched):
+                    with self._lock:
+                        token = self._watched.pop(sock, None)
+                    if token is not None and self._closed(sock):
+                        self.disconnects += 1
+                        logger.info("Client disconnected, cancelling its request")
+                        token.cancel()
+            except Exception:
+                logger.exception("Failed to poll client sockets")
+
+    def _readable(self, watched: Dict[socket.socket, CancellationToken]):
+        with selectors.DefaultSelector() as selector:
+            for sock in watched:
+                try:
+                    selector.register(sock, selectors.EVENT_READ)
+                except (OSError, ValueError):
+                    # Closed by the server since the snapshot was taken, its request is finishing
+                    continue
+            if not selector.get_map():
+                time.sleep(self.interval)
+                return []
+            return [key.fileobj for key, _ in selector.select(self.interval)]
+
+    @staticmethod
+    def _closed(sock: socket.socket) -> bool:
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+
+disconnect_watcher = DisconnectWatcher()
@@ -0,0 +1,46 @@
+import csv
+import io
+import json
+from typing import Iterable, Iterator, List
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def ndjson_chunks(columns: List[str], batches: Iterable[List[list]]) -> Iterator[str]:
+    """Encode batches of rows as newline-delimited JSON objects, one chunk per batch."""
+    encoder = DjangoJSONEncoder()
+    for batch in batches:
+        yield "".join(encoder.encode(dict(zip(columns, row))) + "\n" for row in batch)
+
+
+def csv_chunks(columns: List[str], batches: Iterable[List[list]]) -> Iterator[str]:
+    """Encode batches of rows as CSV with a header line, one chunk per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    yield buffer.getvalue()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+
+EXPORT_ENCODERS = {
+    'ndjson': ndjson_chunks,
+    'csv': csv_chunks,
+}
+
+SSE_CONTENT_TYPE = 'text/event-stream'
+
+
+def sse_event(event: str, data) -> str:
+    """Encode a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {DjangoJSONEncoder().encode(data)}\n\n"
@@ -0,0 +1,207 @@
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+from typing import Callable, Optional, Tuple
+
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.utils import timezone
+
+from .models import JobStatus, QueryJob
+
+logger = logging.getLogger(__name__)
+
+# Answers the question of a job, returning the response payload and its HTTP status; the event is set once the
+# pool stops, handlers waiting for something else should give up the job with ``JobInterrupted`` then
+JobHandler = Callable[[QueryJob, threading.Event], Tuple[dict, int]]
+
+
+class JobInterrupted(Exception):
+    """Raised by a job handler giving up a job because its pool is stopping; the job is queued again"""
+    pass
+
+
+class JobWorkerPool:
+    """
+    Worker threads answering the queued jobs of the ``query_jobs`` table, without an external broker.
+
+    Jobs are claimed with a conditional update, so the pools of several processes (web servers or
+    ``manage.py run_query_workers``) can drain the same table. A maintenance thread renews the heartbeat of the
+    jobs running in this pool, requeues running jobs whose heartbeat stopped because their process died (failing
+    them after ``max_attempts``) and deletes finished jobs ``result_ttl`` seconds after they finished.
+    """
+
+    def __init__(
+            self,
+            handler: JobHandler,
+            workers: int = 2,
+            poll_interval: float = 2.0,
+            heartbeat_interval: float = 10.0,
+            stale_after: float = 60.0,
+            max_attempts: int = 3,
+            result_ttl: float = 86400
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.result_ttl = result_ttl
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._running_jobs = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._signals = 0
+        self._stopped = threading.Event()
+        self._threads = []
+
+    @classmethod
+    def from_env(cls, handler: JobHandler, **kwargs):
+        """Factory method to create a pool configured from environment variables."""
+        options = {
+            'workers': int(os.environ.get('JOB_WORKERS', 2)),
+            'poll_interval': float(os.environ.get('JOB_POLL_INTERVAL', 2)),
+            'heartbeat_interval': float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 10)),
+            'stale_after': float(os.environ.get('JOB_STALE_AFTER', 60)),
+            'max_attempts': int(os.environ.get('JOB_MAX_ATTEMPTS', 3)),
+            'result_ttl': float(os.environ.get('JOB_RESULT_TTL', 86400)),
+        }
+        return cls(handler, **{**options, **kwargs})
+
+    def start(self):
+        """Start the worker and maintenance threads."""
+        for index in range(self.workers):
+            self._threads.append(threading.Thread(
+                target=self._work, args=(f"{self.name}:{index}",), name=f"query-job-worker-{index}", daemon=True
+            ))
+        self._threads.append(threading.Thread(target=self._maintain, name="query-job-maintenance", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop taking jobs and wait for the jobs being answered."""
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def notify(self):
+        """Wake up an idle worker, e.g. after a job was submitted."""
+        with self._wakeup:
+            self._signals += 1
+            self._wakeup.notify()
+
+    def claim_job(self, worker: str) -> Optional[QueryJob]:
+        """Take the oldest queued job not claimed by another worker, if any."""
+        candidates = QueryJob.objects.filter(status=JobStatus.QUEUED).order_by('created_at')
+        for job_id in candidates.values_list('id', flat=True)[:self.workers + 1]:
+            now = timezone.now()
+            claimed = QueryJob.objects.filter(id=job_id, status=JobStatus.QUEUED).update(
+                status=JobStatus.RUNNING, worker=worker, started_at=now, heartbeat_at=now, attempts=F('attempts') + 1
+            )
+            if claimed:
+                return QueryJob.objects.get(id=job_id)
+        return None
+
+    def run_job(self, job: QueryJob):
+        """Answer a claimed job and store its response."""
+        with self._lock:
+            self._running_jobs.add(job.id)
+        try:
+            response, response_status = self.handler(job, self._stopped)
+        except JobInterrupted:
+            # Not an attempt that counts towards max_attempts, another worker starts over
+            QueryJob.objects.filter(id=job.id, status=JobStatus.RUNNING, worker=job.worker).update(
+                status=JobStatus.QUEUED, worker=None, started_at=None, heartbeat_at=None, attempts=F('attempts') - 1
+            )
+            logger.info("Requeued job %s of a stopping worker", job.id)
+            return
+        except Exception:
+            logger.exception("Failed to answer job %s", job.id)
+            response = {'question': job.question, 'error': "An unexpected error occurred. Please contact support."}
+            response_status = 500
+        finally:
+            with self._lock:
+                self._running_jobs.discard(job.id)
+
+        # A job requeued after missing heartbeats belongs to its new worker
+        QueryJob.objects.filter(id=job.id, status=JobStatus.RUNNING, worker=job.worker).update(
+            status=JobStatus.SUCCEEDED if response_status < 400 else JobStatus.FAILED,
+            response=response,
+            response_status=response_status,
+            finished_at=timezone.now()
+        )
+
+    def recover_stale_jobs(self) -> int:
+        """Requeue running jobs whose worker stopped sending heartbeats, or fail them after too many attempts."""
+        now = timezone.now()
+        stale = QueryJob.objects.filter(
+            status=JobStatus.RUNNING, heartbeat_at__lt=now - timedelta(seconds=self.stale_after)
+        )
+        for job in stale.filter(attempts__gte=self.max_attempts):
+            QueryJob.objects.filter(id=job.id, status=JobStatus.RUNNING, worker=job.worker).update(
+                status=JobStatus.FAILED,
+                response={
+                    'question': job.question,
+                    'error': f"The question was abandoned after {job.attempts} attempts by workers that stopped",
+                },
+                response_status=500,
+                finished_at=now
+            )
+        requeued = stale.filter(attempts__lt=self.max_attempts).update(
+            status=JobStatus.QUEUED, worker=None, started_at=None, heartbeat_at=None
+        )
+        if requeued:
+            logger.warning("Requeued %d jobs of stopped workers", requeued)
+            for _ in range(min(requeued, self.workers)):
+                self.notify()
+        return requeued
+
+    def delete_expired_jobs(self) -> int:
+        """Delete jobs that finished more than ``result_ttl`` seconds ago."""
+        deleted, _ = QueryJob.objects.filter(
+            finished_at__lt=timezone.now() - timedelta(seconds=self.result_ttl)
+        ).delete()
+        return deleted
+
+    def _work(self, worker: str):
+        try:
+            while not self._stopped.is_set():
+                close_old_connections()
+                job = self.claim_job(worker)
+                if job is not None:
+                    self.run_job(job)
+                    continue
+                with self._wakeup:
+                    if not self._signals and not self._stopped.is_set():
+                        self._wakeup.wait(self.poll_interval)
+                    self._signals = max(self._signals - 1, 0)
+        except Exception:
+            logger.exception("Job worker %s stopped", worker)
+        finally:
+            connection.close()
+
+    def _maintain(self):
+        try:
+            while True:
+                try:
+                    with self._lock:
+                        running_jobs = list(self._running_jobs)
+                    if running_jobs:
+                        QueryJob.objects.filter(id__in=running_jobs, status=JobStatus.RUNNING).update(
+                            heartbeat_at=timezone.now()
+                        )
+                    self.recover_stale_jobs()
+                    self.delete_expired_jobs()
+                except Exception:
+                    logger.exception("Job maintenance failed")
+                finally:
+                    close_old_connections()
+                if self._stopped.wait(self.heartbeat_interval):
+                    break
+        finally:
+            connection.close()
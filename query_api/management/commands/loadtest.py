@@ -0,0 +1,331 @@
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from sql_agent.llm_scheduler import LLMRequest
+from sql_agent.registry import get_agent_registry
+from sql_agent.sql_coder.replay import StubChatModel, use_chat_model
+from query_api.views import describe_error, get_agent_options, get_db_connection_url
+
+DEFAULT_WORKLOAD = os.path.join(settings.BASE_DIR, 'benchmarks', 'workloads', 'questions.jsonl')
+
+# Upper bounds of the latency histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, math.inf)
+
+# Sends a question, returning the HTTP status (0 when no response was received), the generation count and an error
+Sender = Callable[[str], Tuple[int, Optional[int], Optional[str]]]
+
+
+class Outcome(NamedTuple):
+    # Seconds from the scheduled arrival (open loop) or the send (closed loop) until the response
+    latency: float
+    status: int
+    generations: Optional[int]
+    error: Optional[str]
+
+
+def load_workload(path: str) -> List[dict]:
+    """Questions of a JSONL workload file: one object with a ``question`` (and optionally its ``sql``) per line."""
+    workload = []
+    with open(path, encoding='utf-8') as workload_file:
+        for number, line in enumerate(workload_file, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not isinstance(item, dict) or not str(item.get('question', '')).strip():
+                raise CommandError(f"{path}:{number}: expected an object with a non-empty 'question'")
+            workload.append(item)
+    if not workload:
+        raise CommandError(f"{path} contains no questions")
+    return workload
+
+
+def api_sender(url: str, timeout: float, client_id: str) -> Sender:
+    """Ask questions through the HTTP API at ``url``."""
+    def send(question):
+        request = urllib.request.Request(
+            url,
+            data=json.dumps({'question': question}).encode(),
+            headers={'Content-Type': 'application/json', 'X-Client-Id': client_id},
+            method='POST',
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                body = json.load(response)
+                return response.status, (body.get('metadata') or {}).get('generations'), None
+        except urllib.error.HTTPError as e:
+            try:
+                error = json.load(e).get('error')
+            except ValueError:
+                error = e.reason
+            return e.code, None, error
+        except (urllib.error.URLError, OSError) as e:
+            return 0, None, f"{type(e).__name__}: {getattr(e, 'reason', e)}"
+
+    return send
+
+
+def agent_sender(db_connection_url: str, client_id: str) -> Sender:
+    """Ask questions directly to the SyncAgent of the process registry, as ``QueryAPIView`` does."""
+    sql_agent = get_agent_registry().get_agent(db_connection_url=db_connection_url, **get_agent_options())
+    request_deadline = float(os.environ.get('REQUEST_DEADLINE', 60))
+
+    def send(question):
+        llm_request = LLMRequest(
+            client=client_id, deadline=time.monotonic() + request_deadline if request_deadline else None
+        )
+        try:
+            answer = sql_agent.ask(question=question, llm_request=llm_request)
+        except Exception as e:
+            message, code = describe_error(e)
+            return code, None, f"{type(e).__name__}: {message}"
+        return 200, answer.get("total_generations"), None
+
+    return send
+
+
+def run_closed_loop(send: Sender, questions: List[str], concurrency: int, duration: float,
+                    max_requests: Optional[int]) -> List[Outcome]:
+    """``concurrency`` clients each asking their next question as soon as the previous one was answered."""
+    outcomes = []
+    lock = threading.Lock()
+    sent = 0
+    deadline = time.monotonic() + duration
+
+    def client():
+        nonlocal sent
+        while time.monotonic() < deadline:
+            with lock:
+                if max_requests is not None and sent >= max_requests:
+                    return
+                question = questions[sent % len(questions)]
+                sent += 1
+            started = time.monotonic()
+            status, generations, error = send(question)
+            with lock:
+                outcomes.append(Outcome(time.monotonic() - started, status, generations, error))
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def run_open_loop(send: Sender, questions: List[str], rate: float, arrival: str, concurrency: int,
+                  duration: float, max_requests: Optional[int]) -> List[Outcome]:
+    """
+    Questions arriving at ``rate`` per second regardless of how fast they are answered, at most ``concurrency``
+    in flight. Latencies count from the scheduled arrival, so time spent waiting for a free client is included.
+    """
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def ask(question, scheduled):
+        status, generations, error = send(question)
+        return Outcome(time.monotonic() - scheduled, status, generations, error)
+
+    futures = []
+    start = scheduled = time.monotonic()
+    try:
+        while scheduled - start < duration and (max_requests is None or len(futures) < max_requests):
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(ask, questions[len(futures) % len(questions)], scheduled))
+            scheduled += random.expovariate(rate) if arrival == 'poisson' else 1 / rate
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def latency_summary(latencies: List[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def histogram(latencies: List[float]) -> List[Tuple[float, int]]:
+    counts = Counter(next(bound for bound in HISTOGRAM_BUCKETS if latency <= bound) for latency in latencies)
+    return [(bound, counts[bound]) for bound in HISTOGRAM_BUCKETS]
+
+
+def summarize(outcomes: List[Outcome], elapsed: float) -> dict:
+    """Throughput, error rates and latency percentiles overall and by generation count."""
+    succeeded = [outcome for outcome in outcomes if outcome.status == 200]
+    errors = Counter(f"HTTP {outcome.status}" if outcome.status else "no response"
+                     for outcome in outcomes if outcome.status != 200)
+    by_generations = defaultdict(list)
+    for outcome in succeeded:
+        by_generations[outcome.generations].append(outcome.latency)
+
+    return {
+        'requests': len(outcomes),
+        'succeeded': len(succeeded),
+        'errors': dict(errors),
+        'error_rate': (len(outcomes) - len(succeeded)) / len(outcomes) if outcomes else 0.0,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(succeeded) / elapsed if elapsed else 0.0,
+        'latency': latency_summary([outcome.latency for outcome in outcomes]) if outcomes else None,
+        'latency_by_generations': {
+            str(generations) if generations is not None else 'unknown': latency_summary(latencies)
+            for generations, latencies in sorted(by_generations.items(), key=lambda item: (item[0] is None, item[0]))
+        },
+        'histogram': [
+            {'le_ms': None if math.isinf(bound) else bound * 1000, 'count': count}
+            for bound, count in histogram([outcome.latency for outcome in outcomes])
+        ],
+        'sample_errors': list(dict.fromkeys(outcome.error for outcome in outcomes if outcome.error))[:5],
+    }
+
+
+class Command(BaseCommand):
+    help = 'Replay a question workload against /api/query/ or a SyncAgent and report latency percentiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workload', default=DEFAULT_WORKLOAD,
+            help='JSONL file with one {"question": ..., "sql": ...} object per line, asked in a loop'
+        )
+        parser.add_argument(
+            '--target', choices=['api', 'agent'], default='api',
+            help='Ask through the HTTP API of a running server, or directly to a SyncAgent in this process'
+        )
+        parser.add_argument('--url', default='http://localhost:8000/api/query/', help='Query endpoint of the API target')
+        parser.add_argument('--timeout', type=float, default=120, help='HTTP timeout in seconds of the API target')
+        parser.add_argument('--database-url', help='Database of the agent target (defaults to the DB_* settings)')
+        parser.add_argument('--concurrency', type=int, default=4, help='Questions in flight at most')
+        parser.add_argument(
+            '--rate', type=float,
+            help='Open loop: questions arriving per second regardless of response times; '
+                 'without it each of the --concurrency clients asks again once answered'
+        )
+        parser.add_argument(
+            '--arrival', choices=['poisson', 'uniform'], default='poisson', help='Arrival process of the open loop'
+        )
+        parser.add_argument('--duration', type=float, default=30, help='Seconds during which questions are sent')
+        parser.add_argument('--max-requests', type=int, help='Stop after sending this many questions')
+        parser.add_argument(
+            '--llm-stub-latency', type=float,
+            help='Agent target: answer LLM calls with the workload SQL after this mean latency in seconds, '
+                 'instead of calling Ollama'
+        )
+        parser.add_argument(
+            '--llm-stub-jitter', type=float, default=0.3, help='Shape of the log-normal latency of the LLM stub'
+        )
+        parser.add_argument('--client-id', default='loadtest', help='Client the LLM scheduler accounts the questions to')
+        parser.add_argument('--output', help='Also write the report as JSON to this file')
+
+    def handle(self, *args, **options):
+        workload = load_workload(options['workload'])
+        questions = [item['question'].strip() for item in workload]
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency must be at least 1")
+        if options['rate'] is not None and options['rate'] <= 0:
+            raise CommandError("--rate must be positive")
+
+        llm_stub = nullcontext()
+        if options['llm_stub_latency'] is not None:
+            if options['target'] != 'agent':
+                raise CommandError("--llm-stub-latency only applies to --target agent")
+            llm_stub = use_chat_model(StubChatModel(
+                latency=options['llm_stub_latency'],
+                jitter=options['llm_stub_jitter'],
+                answers={item['question'].strip(): item['sql'] for item in workload if item.get('sql')},
+            ))
+
+        if options['target'] == 'api':
+            send = api_sender(options['url'], options['timeout'], options['client_id'])
+            target = options['url']
+        else:
+            send = agent_sender(options['database_url'] or get_db_connection_url(), options['client_id'])
+            target = 'SyncAgent' + (f" with LLM stub ({options['llm_stub_latency']} s)"
+                                    if options['llm_stub_latency'] is not None else '')
+
+        if options['rate']:
+            mode = (f"open loop, {options['rate']:g} questions/s ({options['arrival']}), "
+                    f"at most {options['concurrency']} in flight")
+        else:
+            mode = f"closed loop, {options['concurrency']} concurrent clients"
+        self.stdout.write(f"Asking {len(questions)} workload questions to {target}: {mode}, {options['duration']:g} s")
+
+        with llm_stub:
+            started = time.monotonic()
+            if options['rate']:
+                outcomes = run_open_loop(
+                    send, questions, options['rate'], options['arrival'], options['concurrency'],
+                    options['duration'], options['max_requests']
+                )
+            else:
+                outcomes = run_closed_loop(
+                    send, questions, options['concurrency'], options['duration'], options['max_requests']
+                )
+            elapsed = time.monotonic() - started
+
+        report = {
+            'target': target,
+            'mode': mode,
+            # Arrival rate actually offered by the open loop, which varies around --rate with Poisson arrivals
+            'offered_rps': len(outcomes) / options['duration'] if options['rate'] else None,
+            **summarize(outcomes, elapsed),
+        }
+        self.write_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2)
+
+    def write_report(self, report):
+        self.stdout.write(
+            f"\n{report['requests']} questions in {report['elapsed_s']:.1f} s: {report['succeeded']} answered, "
+            f"error rate {report['error_rate']:.1%}, throughput {report['throughput_rps']:.2f} answers/s"
+        )
+        if report['offered_rps'] and report['throughput_rps'] < 0.9 * report['offered_rps']:
+            self.stdout.write(self.style.WARNING(
+                f"Throughput is below the offered {report['offered_rps']:.2f} questions/s: questions queued up, "
+                f"the rate is not sustainable"
+            ))
+        for error, count in report['errors'].items():
+            self.stdout.write(self.style.ERROR(f"  {error}: {count}"))
+        for error in report['sample_errors']:
+            self.stdout.write(f"    {error}")
+        if not report['latency']:
+            return
+
+        self.stdout.write(f"\n{'latency (ms)':<16}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        rows = [('all', report['latency'])] + [
+            (f"{generations} generation{'' if generations == '1' else 's'}", summary)
+            for generations, summary in report['latency_by_generations'].items()
+        ]
+        for label, summary in rows:
+            self.stdout.write(
+                f"{label:<16}{summary['count']:>7}{summary['p50_ms']:>10.0f}{summary['p95_ms']:>10.0f}"
+                f"{summary['p99_ms']:>10.0f}{summary['max_ms']:>10.0f}"
+            )
+
+        self.stdout.write("")
+        largest = max(bucket['count'] for bucket in report['histogram']) or 1
+        for bucket in report['histogram']:
+            label = f"<= {bucket['le_ms']:g} ms" if bucket['le_ms'] is not None else "> 60000 ms"
+            self.stdout.write(f"{label:>12} | {'#' * round(40 * bucket['count'] / largest):<40} {bucket['count']}")
@@ -0,0 +1,34 @@
+import os
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from query_api.jobs import JobWorkerPool
+from query_api.views import answer_job
+
+
+class Command(BaseCommand):
+    help = 'Answer the questions submitted to /api/jobs/ in a dedicated process'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of worker threads',
+            default=int(os.environ.get('JOB_WORKERS', 2)) or 2
+        )
+
+    def handle(self, *args, **options):
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopped.set())
+
+        pool = JobWorkerPool.from_env(answer_job, workers=options['workers'])
+        pool.start()
+        self.stdout.write(f'Started {pool.workers} job workers ({pool.name})')
+
+        stopped.wait()
+        self.stdout.write('Waiting for running jobs to finish...')
+        pool.stop()
+        self.stdout.write(self.style.SUCCESS('Job workers stopped'))
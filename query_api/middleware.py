@@ -0,0 +1,78 @@
+import gzip
+import os
+from typing import Optional
+
+import zstandard
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from .exports import EXPORT_CONTENT_TYPES
+from .renderers import ARROW_STREAM_CONTENT_TYPE
+
+# Content encodings in order of preference
+COMPRESSORS = {
+    'zstd': lambda content: zstandard.ZstdCompressor(level=3).compress(content),
+    'gzip': lambda content: gzip.compress(content, compresslevel=6),
+}
+
+# Only API results are compressed: HTML pages carry CSRF tokens, which compression would expose to BREACH
+COMPRESSED_PATH_PREFIX = '/api/'
+COMPRESSED_CONTENT_TYPES = ('application/json', EXPORT_CONTENT_TYPES['csv'], ARROW_STREAM_CONTENT_TYPE)
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """The preferred content encoding of ``COMPRESSORS`` an ``Accept-Encoding`` header accepts, if any."""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return next((encoding for encoding in COMPRESSORS if encoding in accepted), None)
+
+
+def compressible(response) -> bool:
+    """Whether the content type of a response is one of ``COMPRESSED_CONTENT_TYPES``."""
+    content_type = response.get('Content-Type', '').partition(';')[0].strip().lower()
+    return content_type in COMPRESSED_CONTENT_TYPES
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compresses ``/api/`` JSON, CSV and Arrow responses of at least ``RESPONSE_COMPRESSION_MIN_BYTES`` bytes with zstd
+    or gzip, whichever the client accepts, zstd first. Streaming responses (exports, Server-Sent Events) are sent as
+    they are produced, and other responses, e.g. the HTML of the UI and admin, are left to Django.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.min_bytes = int(os.environ.get('RESPONSE_COMPRESSION_MIN_BYTES', 1024))
+
+    def process_response(self, request, response):
+        if not request.path.startswith(COMPRESSED_PATH_PREFIX) or not compressible(response):
+            return response
+        if response.streaming or response.has_header('Content-Encoding') or len(response.content) < self.min_bytes:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        compressed = COMPRESSORS[encoding](response.content)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The compressed body is no longer byte-for-byte the one a strong ETag stands for
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
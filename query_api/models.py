@@ -1,3 +1,6 @@
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.db.models import Q
 
@@ -56,3 +59,37 @@ class Order(models.Model):
                 name="order_status_valid"
             )
         ]
+
+
+class JobStatus(models.TextChoices):
+    QUEUED = 'queued', 'Queued'
+    RUNNING = 'running', 'Running'
+    SUCCEEDED = 'succeeded', 'Succeeded'
+    FAILED = 'failed', 'Failed'
+
+
+class QueryJob(models.Model):
+    """A question answered in the background by the job worker pool, see ``query_api.jobs``."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    question = models.TextField()
+    client = models.CharField(max_length=255, null=True, blank=True)
+    priority = models.CharField(max_length=20, default='interactive')
+    status = models.CharField(max_length=20, choices=JobStatus.choices, default=JobStatus.QUEUED)
+    # Response payload of /api/query/ and its HTTP status, for failures as well
+    response = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    response_status = models.IntegerField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Job {self.id} - {self.status}"
+
+    class Meta:
+        db_table = 'query_jobs'
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='query_jobs_status_created'),
+        ]
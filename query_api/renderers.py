@@ -0,0 +1,165 @@
+import datetime
+import decimal
+import uuid
+from typing import Optional
+
+import orjson
+import pyarrow
+import pyarrow.ipc
+from rest_framework.renderers import BaseRenderer
+
+from sql_agent.models import Result
+from .exports import EXPORT_CONTENT_TYPES, csv_chunks
+
+ARROW_STREAM_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Values JSON has no type for; columns holding them are converted by ``json_value``
+_CONVERTED_TYPES = (
+    decimal.Decimal, datetime.date, datetime.time, datetime.timedelta, bytes, bytearray, memoryview, uuid.UUID
+)
+
+
+def json_value(value):
+    """
+    JSON value of a database value: intervals as numbers of seconds, dates and times as ISO 8601 strings, and
+    decimals as strings, which keep all their digits where a JSON number would be rounded to a double.
+    """
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def _first_value(rows, index):
+    return next((row[index] for row in rows if row[index] is not None), None)
+
+
+def result_data(result: Result, layout: str = 'rows') -> dict:
+    """
+    JSON-ready payload of a result with typed values, without going through a serializer field per value.
+
+    Only the columns holding values JSON has no type for (decimals, dates, ...) are converted, the others are passed
+    through as returned by the database driver. With the ``columns`` layout the values are returned as one list per
+    column under ``values`` instead of one list per row under ``rows``.
+    """
+    rows = result.rows
+    converted = [
+        index for index in range(len(result.columns)) if isinstance(_first_value(rows, index), _CONVERTED_TYPES)
+    ]
+    data = {'columns': result.columns}
+
+    if layout == 'columns' or converted:
+        values = [list(column) for column in zip(*rows)] if rows else [[] for _ in result.columns]
+        for index in converted:
+            values[index] = [None if value is None else json_value(value) for value in values[index]]
+        if layout == 'columns':
+            data['values'] = values
+        else:
+            rows = list(zip(*values))
+    if layout != 'columns':
+        data['rows'] = rows
+
+    data['total_rows'] = result.total_rows
+    data['is_truncated'] = result.is_truncated
+    data['estimated_total_rows'] = result.estimated_total_rows
+    return data
+
+
+def encode_json(data: dict, layout: str = 'rows') -> bytes:
+    """Encode a response payload as JSON, its ``Result``, if any, with ``result_data``."""
+    if isinstance(data.get('result'), Result):
+        data = {**data, 'result': result_data(data['result'], layout)}
+    return orjson.dumps(data, default=str)
+
+
+def encode_arrow(result: Result, metadata: Optional[dict] = None) -> bytes:
+    """Encode a result as an Arrow IPC stream, with ``metadata`` in its schema."""
+    columns = list(zip(*result.rows)) if result.rows else [() for _ in result.columns]
+    arrays = []
+    for values in columns:
+        try:
+            arrays.append(pyarrow.array(values))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # Values of several types in one column, e.g. in SQLite
+            arrays.append(pyarrow.array([None if value is None else str(value) for value in values], pyarrow.string()))
+    schema = pyarrow.schema(
+        [pyarrow.field(name, array.type) for name, array in zip(result.columns, arrays)], metadata=metadata
+    )
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+    return sink.getvalue().to_pybytes()
+
+
+def _describe_result(renderer_context, result: Result):
+    response = (renderer_context or {}).get('response')
+    if response is not None:
+        response['X-Total-Rows'] = str(result.total_rows)
+        response['X-Is-Truncated'] = 'true' if result.is_truncated else 'false'
+
+
+def _render_error(data, renderer_context) -> bytes:
+    # Payloads without a result, e.g. errors, are sent as JSON whatever the client accepts
+    response = (renderer_context or {}).get('response')
+    if response is not None:
+        response['Content-Type'] = 'application/json'
+    return encode_json(data)
+
+
+class QueryJSONRenderer(BaseRenderer):
+    """
+    Renders ``/api/query/`` payloads as JSON, encoding their ``Result`` directly with typed values, in the layout
+    given by the ``layout`` of the renderer context.
+    """
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return encode_json(data, (renderer_context or {}).get('layout', 'rows'))
+
+
+class ResultCSVRenderer(BaseRenderer):
+    """Renders the result of ``/api/query/`` payloads as CSV with a header line."""
+    media_type = EXPORT_CONTENT_TYPES['csv']
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        result = data.get('result') if isinstance(data, dict) else None
+        if not isinstance(result, Result):
+            return _render_error(data, renderer_context)
+        _describe_result(renderer_context, result)
+        return "".join(csv_chunks(result.columns, [result.rows])).encode()
+
+
+class ResultArrowRenderer(BaseRenderer):
+    """
+    Renders the result of ``/api/query/`` payloads as an Arrow IPC stream, keeping the column types of the database;
+    the question and SQL query are stored in the schema metadata.
+    """
+    media_type = ARROW_STREAM_CONTENT_TYPE
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        result = data.get('result') if isinstance(data, dict) else None
+        if not isinstance(result, Result):
+            return _render_error(data, renderer_context)
+        _describe_result(renderer_context, result)
+        return encode_arrow(result, {'question': data.get('question') or '', 'sql_query': data.get('sql_query') or ''})
+
+
+# Renderers of ``/api/query/`` responses, chosen by the ``Accept`` header (or the ``format`` query parameter)
+RESULT_RENDERERS = [QueryJSONRenderer, ResultCSVRenderer, ResultArrowRenderer]
@@ -1,3 +1,5 @@
+import os
+
 from rest_framework import serializers
 
 
@@ -5,6 +7,8 @@ class ResultSerializer(serializers.Serializer):
     columns = serializers.ListField(child=serializers.CharField())
     rows = serializers.ListField(child=serializers.ListField(child=serializers.CharField()))
     total_rows = serializers.IntegerField()
+    is_truncated = serializers.BooleanField()
+    estimated_total_rows = serializers.IntegerField(allow_null=True)
 
 
 class QueryResponseSerializer(serializers.Serializer):
@@ -12,6 +16,7 @@ class QueryResponseSerializer(serializers.Serializer):
     sql_query = serializers.CharField(allow_null=True)
     result = ResultSerializer(allow_null=True)
     error = serializers.CharField(allow_null=True)
+    metadata = serializers.DictField(allow_null=True, required=False)
 
 class QueryRequestSerializer(serializers.Serializer):
     question = serializers.CharField(required=True, help_text="The natural language question to be converted to SQL")
@@ -19,4 +24,48 @@ class QueryRequestSerializer(serializers.Serializer):
     def validate_question(self, value):
         if not value.strip():
             raise serializers.ValidationError("Question cannot be empty or whitespace only")
-        return value.strip()
\ No newline at end of file
+        return value.strip()
+
+
+class QueryResultRequestSerializer(QueryRequestSerializer):
+    layout = serializers.ChoiceField(
+        choices=['rows', 'columns'], default='rows', help_text="Layout of the result values in JSON responses"
+    )
+
+
+class QueryExportRequestSerializer(QueryRequestSerializer):
+    format = serializers.ChoiceField(choices=['ndjson', 'csv'], default='ndjson', help_text="Export format")
+
+
+class QueryJobRequestSerializer(QueryRequestSerializer):
+    priority = serializers.ChoiceField(
+        choices=['interactive', 'batch'], default='interactive', help_text="Priority of the job's LLM calls"
+    )
+
+
+class QueryJobSerializer(serializers.Serializer):
+    id = serializers.UUIDField()
+    question = serializers.CharField()
+    status = serializers.CharField()
+    priority = serializers.CharField()
+    attempts = serializers.IntegerField()
+    created_at = serializers.DateTimeField()
+    started_at = serializers.DateTimeField(allow_null=True)
+    finished_at = serializers.DateTimeField(allow_null=True)
+
+
+class QueryBatchRequestSerializer(serializers.Serializer):
+    questions = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False, help_text="The natural language questions to answer"
+    )
+    stream = serializers.BooleanField(
+        default=False, help_text="Stream the answers as NDJSON in the order they complete"
+    )
+
+    def validate_questions(self, value):
+        max_questions = int(os.environ.get('BATCH_MAX_QUESTIONS', 500))
+        if len(value) > max_questions:
+            raise serializers.ValidationError(f"At most {max_questions} questions can be asked at once")
+        if any(not question.strip() for question in value):
+            raise serializers.ValidationError("Questions cannot be empty or whitespace only")
+        return [question.strip() for question in value]
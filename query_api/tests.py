@@ -1,3 +1,317 @@
-from django.test import TestCase
+import json
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest.mock import patch
 
-# Create your tests here.
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from sql_agent.models import Result
+
+from .jobs import JobWorkerPool
+from .middleware import accepted_encoding
+from .models import JobStatus, QueryJob
+from .renderers import QueryJSONRenderer, ResultArrowRenderer, ResultCSVRenderer, result_data
+
+
+def answer(job, stopped):
+    return {'question': job.question, 'sql_query': "SELECT 1", 'result': None, 'error': None}, 200
+
+
+class TestQueryJobs(TestCase):
+    def setUp(self):
+        self.pool = JobWorkerPool(answer, workers=1, stale_after=60, max_attempts=2, result_ttl=3600)
+
+    @patch('query_api.views.get_job_worker_pool', return_value=None)
+    def test_submitted_job_is_answered_and_polled(self, _):
+        response = self.client.post(
+            reverse('query-jobs'), {'question': "How many orders?"}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['id']
+        self.assertEqual(response['Location'], reverse('query-job', args=[job_id]))
+
+        # Pending jobs have no result yet
+        response = self.client.get(reverse('query-job-result', args=[job_id]))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], JobStatus.QUEUED)
+
+        job = self.pool.claim_job("worker")
+        self.assertEqual(str(job.id), job_id)
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNone(self.pool.claim_job("other-worker"))
+        self.pool.run_job(job)
+
+        response = self.client.get(reverse('query-job', args=[job_id]))
+        self.assertEqual(response.json()['status'], JobStatus.SUCCEEDED)
+        response = self.client.get(reverse('query-job-result', args=[job_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['sql_query'], "SELECT 1")
+
+    @patch('query_api.views.get_job_worker_pool', return_value=None)
+    def test_unknown_job_is_not_found(self, _):
+        job_id = QueryJob.objects.create(question="How many orders?").id
+        QueryJob.objects.filter(id=job_id).delete()
+        self.assertEqual(self.client.get(reverse('query-job-result', args=[job_id])).status_code, 404)
+
+    @patch('query_api.views.get_job_worker_pool')
+    def test_polling_does_not_start_workers(self, get_job_worker_pool):
+        job_id = QueryJob.objects.create(question="How many orders?").id
+
+        self.assertEqual(self.client.get(reverse('query-job', args=[job_id])).status_code, 200)
+        self.assertEqual(self.client.get(reverse('query-job-result', args=[job_id])).status_code, 202)
+        get_job_worker_pool.assert_not_called()
+
+    @patch('query_api.views.get_agent_registry')
+    def test_overloaded_job_is_requeued_when_the_pool_stops(self, get_agent_registry):
+        from sql_agent.exceptions import Overloaded
+        from .views import answer_job
+        get_agent_registry.return_value.get_agent.return_value.ask.side_effect = Overloaded("busy", retry_after=60)
+        pool = JobWorkerPool(answer_job, workers=1)
+        job_id = QueryJob.objects.create(question="How many orders?").id
+        job = pool.claim_job("worker")
+        pool.stop()
+
+        pool.run_job(job)
+
+        job = QueryJob.objects.get(id=job_id)
+        self.assertEqual((job.status, job.worker, job.attempts), (JobStatus.QUEUED, None, 0))
+
+    @patch.dict('os.environ', {'JOB_MAX_WAIT': '0'})
+    @patch('query_api.views.get_agent_registry')
+    def test_overloaded_job_fails_after_the_maximum_wait(self, get_agent_registry):
+        from sql_agent.exceptions import Overloaded
+        from .views import answer_job
+        get_agent_registry.return_value.get_agent.return_value.ask.side_effect = Overloaded("busy", retry_after=1)
+        pool = JobWorkerPool(answer_job, workers=1)
+        job_id = QueryJob.objects.create(question="How many orders?").id
+
+        pool.run_job(pool.claim_job("worker"))
+
+        job = QueryJob.objects.get(id=job_id)
+        self.assertEqual((job.status, job.response_status), (JobStatus.FAILED, 429))
+
+    def test_jobs_of_stopped_workers_are_recovered(self):
+        stale = timezone.now() - timedelta(seconds=120)
+        retried = QueryJob.objects.create(
+            question="retried", status=JobStatus.RUNNING, attempts=1, worker="crashed", heartbeat_at=stale
+        )
+        abandoned = QueryJob.objects.create(
+            question="abandoned", status=JobStatus.RUNNING, attempts=2, worker="crashed", heartbeat_at=stale
+        )
+        alive = QueryJob.objects.create(
+            question="alive", status=JobStatus.RUNNING, attempts=1, worker="alive", heartbeat_at=timezone.now()
+        )
+
+        self.assertEqual(self.pool.recover_stale_jobs(), 1)
+
+        retried.refresh_from_db()
+        self.assertEqual((retried.status, retried.worker), (JobStatus.QUEUED, None))
+        abandoned.refresh_from_db()
+        self.assertEqual((abandoned.status, abandoned.response_status), (JobStatus.FAILED, 500))
+        alive.refresh_from_db()
+        self.assertEqual(alive.status, JobStatus.RUNNING)
+
+        # A worker that stopped sending heartbeats does not overwrite the job once it was requeued
+        self.assertEqual(self.pool.claim_job("worker").id, retried.id)
+        retried.worker = "crashed"
+        self.pool.run_job(retried)
+        retried.refresh_from_db()
+        self.assertEqual((retried.status, retried.worker), (JobStatus.RUNNING, "worker"))
+
+    def test_finished_jobs_expire(self):
+        now = timezone.now()
+        QueryJob.objects.create(question="expired", status=JobStatus.SUCCEEDED, finished_at=now - timedelta(hours=2))
+        kept = QueryJob.objects.create(question="kept", status=JobStatus.FAILED, finished_at=now)
+        QueryJob.objects.create(question="queued")
+
+        self.assertEqual(self.pool.delete_expired_jobs(), 1)
+        self.assertEqual(QueryJob.objects.count(), 2)
+        self.assertTrue(QueryJob.objects.filter(id=kept.id).exists())
+
+
+class TestJobWorkersAtStartup(TransactionTestCase):
+    def tearDown(self):
+        from . import views
+        if views._job_worker_pool is not None:
+            views._job_worker_pool.stop(5)
+            views._job_worker_pool = None
+
+    @patch.dict('os.environ', {'JOB_WORKERS': '1', 'JOB_POLL_INTERVAL': '0.05', 'JOB_HEARTBEAT_INTERVAL': '0.05'})
+    @patch('query_api.views.answer_job', answer)
+    def test_stale_jobs_are_recovered_when_the_server_starts(self):
+        import runpy
+        import time
+        job = QueryJob.objects.create(
+            question="How many orders?", status=JobStatus.RUNNING, attempts=1, worker="crashed",
+            heartbeat_at=timezone.now() - timedelta(seconds=120)
+        )
+
+        # The server restarts after a crash; no job is submitted afterwards
+        runpy.run_module('querycraft.wsgi')
+
+        for _ in range(100):
+            job.refresh_from_db()
+            if job.status == JobStatus.SUCCEEDED:
+                break
+            time.sleep(0.05)
+        self.assertEqual((job.status, job.attempts), (JobStatus.SUCCEEDED, 2))
+
+
+class TestQueryErrors(TestCase):
+    @patch('query_api.views.get_async_agent_registry')
+    @patch('query_api.views.get_agent_registry')
+    def test_failures_have_the_same_status_on_every_endpoint(self, get_agent_registry, get_async_agent_registry):
+        from unittest.mock import AsyncMock
+        from sql_agent.exceptions import Overloaded, QueryCancelled, QueryTimeout
+        from sql_agent.repositories.exceptions import QueryTimeoutError
+        agent = get_agent_registry.return_value.get_agent.return_value
+        async_agent = get_async_agent_registry.return_value.get_agent.return_value
+        async_agent.ask = AsyncMock()
+
+        for error, code in [
+            (Overloaded("busy", retry_after=5), 429), (QueryTimeout("slow"), 504), (QueryCancelled("gone"), 499),
+            (ValueError("bug"), 500),
+        ]:
+            agent.ask.side_effect = async_agent.ask.side_effect = error
+            for name in ('query', 'query-async', 'query-export'):
+                with self.subTest(error=repr(error), endpoint=name):
+                    response = self.client.post(
+                        reverse(name), {'question': "How many orders?"}, content_type='application/json'
+                    )
+                    self.assertEqual(response.status_code, code)
+                    self.assertEqual(response.get('Retry-After'), '5' if code == 429 else None)
+
+        # The export runs the answered query once more, outside the agent
+        agent.ask.side_effect = None
+        agent.ask.return_value = {'sql_query': "SELECT * FROM orders"}
+        agent.repository.stream_query.side_effect = QueryTimeoutError("Query exceeded the statement timeout")
+        response = self.client.post(
+            reverse('query-export'), {'question': "How many orders?"}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 504)
+
+
+class TestLoadTestReport(TestCase):
+    def test_latencies_are_summarized_by_generation_count(self):
+        from .management.commands.loadtest import Outcome, summarize
+
+        outcomes = [Outcome(latency / 1000, 200, 1, None) for latency in range(1, 101)]
+        outcomes += [Outcome(2.0, 200, 2, None), Outcome(0.01, 429, None, "busy")]
+        report = summarize(outcomes, elapsed=10)
+
+        self.assertEqual((report['requests'], report['succeeded'], report['errors']), (102, 101, {'HTTP 429': 1}))
+        self.assertAlmostEqual(report['throughput_rps'], 10.1)
+        self.assertAlmostEqual(report['latency_by_generations']['1']['p50_ms'], 50)
+        self.assertAlmostEqual(report['latency_by_generations']['1']['p99_ms'], 99)
+        self.assertEqual(report['latency_by_generations']['2']['count'], 1)
+        self.assertEqual(sum(bucket['count'] for bucket in report['histogram']), 102)
+
+
+class TestDisconnectWatcher(TestCase):
+    def test_token_is_cancelled_when_the_client_disconnects(self):
+        import socket
+        import time
+        from types import SimpleNamespace
+        from .disconnect import DisconnectWatcher
+        watcher = DisconnectWatcher(interval=0.05)
+        server, client = socket.socketpair()
+        request = SimpleNamespace(META={'gunicorn.socket': server})
+
+        try:
+            with watcher.watch(request) as cancel_token:
+                time.sleep(0.2)
+                self.assertFalse(cancel_token.cancelled)
+                client.close()
+                deadline = time.monotonic() + 5
+                while not cancel_token.cancelled and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertTrue(cancel_token.cancelled)
+        finally:
+            server.close()
+        self.assertEqual(watcher.disconnects, 1)
+
+    def test_requests_without_a_client_socket_are_not_watched(self):
+        from types import SimpleNamespace
+        from .disconnect import DisconnectWatcher
+        watcher = DisconnectWatcher()
+
+        with watcher.watch(SimpleNamespace(META={})) as cancel_token:
+            self.assertFalse(cancel_token.cancelled)
+        self.assertIsNone(watcher._thread)
+
+
+class TestResultRenderers(TestCase):
+    def setUp(self):
+        self.result = Result(
+            columns=['id', 'price', 'ordered_on', 'note'],
+            rows=[[1, Decimal('9.50'), date(2024, 1, 2), None], [2, None, date(2024, 1, 3), 'gift']],
+            total_rows=2,
+        )
+
+    def test_result_values_are_typed(self):
+        data = result_data(self.result)
+        self.assertEqual(
+            [list(row) for row in data['rows']], [[1, '9.50', '2024-01-02', None], [2, None, '2024-01-03', 'gift']]
+        )
+        self.assertEqual(result_data(self.result, 'columns')['values'], [
+            [1, 2], ['9.50', None], ['2024-01-02', '2024-01-03'], [None, 'gift']
+        ])
+
+        content = QueryJSONRenderer().render({'question': "Orders?", 'result': self.result}, None, {'layout': 'rows'})
+        self.assertEqual(content, b'{"question":"Orders?","result":{"columns":["id","price","ordered_on","note"],'
+                                  b'"rows":[[1,"9.50","2024-01-02",null],[2,null,"2024-01-03","gift"]],"total_rows":2,'
+                                  b'"is_truncated":false,"estimated_total_rows":null}}')
+        self.assertEqual(
+            ResultCSVRenderer().render({'result': self.result}),
+            b'id,price,ordered_on,note\r\n1,9.50,2024-01-02,\r\n2,,2024-01-03,gift\r\n'
+        )
+
+    def test_arrow_stream_keeps_column_types(self):
+        import pyarrow
+        import pyarrow.ipc
+
+        content = ResultArrowRenderer().render({'question': "Orders?", 'sql_query': "SELECT 1", 'result': self.result})
+
+        table = pyarrow.ipc.open_stream(content).read_all()
+        self.assertEqual(table.column_names, ['id', 'price', 'ordered_on', 'note'])
+        self.assertEqual(
+            [str(field.type) for field in table.schema], ['int64', 'decimal128(3, 2)', 'date32[day]', 'string']
+        )
+        self.assertEqual(table.to_pydict(), {
+            'id': [1, 2], 'price': [Decimal('9.50'), None], 'ordered_on': [date(2024, 1, 2), date(2024, 1, 3)],
+            'note': [None, 'gift'],
+        })
+        self.assertEqual(table.schema.metadata, {b'question': b"Orders?", b'sql_query': b"SELECT 1"})
+
+    def test_decimals_keep_their_precision(self):
+        result = Result(columns=['amount'], rows=[[Decimal('12345678901234567.89')]], total_rows=1)
+
+        content = QueryJSONRenderer().render({'result': result}, None, {'layout': 'rows'})
+        self.assertEqual(json.loads(content)['result']['rows'], [['12345678901234567.89']])
+
+    def test_compression_follows_accept_encoding(self):
+        self.assertEqual(accepted_encoding("gzip, deflate, br, zstd"), 'zstd')
+        self.assertEqual(accepted_encoding("gzip;q=0.8, zstd;q=0"), 'gzip')
+        self.assertIsNone(accepted_encoding("identity"))
+
+    @patch.dict('os.environ', {'RESPONSE_COMPRESSION_MIN_BYTES': '0'})
+    def test_only_api_results_are_compressed(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from .middleware import CompressionMiddleware
+        request_factory = RequestFactory(HTTP_ACCEPT_ENCODING='gzip')
+        body = b'{"rows": [' + b'[1, "2024-01-02"], ' * 100 + b'[2, null]]}'
+
+        for path, content_type, compressed in [
+            ('/api/query/', 'application/json', True),
+            ('/api/query/', 'text/csv; charset=utf-8', True),
+            ('/api/query/', 'text/html; charset=utf-8', False),
+            ('/', 'text/html; charset=utf-8', False),
+            ('/admin/login/', 'application/json', False),
+        ]:
+            with self.subTest(path=path, content_type=content_type):
+                middleware = CompressionMiddleware(lambda request: HttpResponse(body, content_type=content_type))
+                response = middleware(request_factory.get(path))
+                self.assertEqual(response.get('Content-Encoding'), 'gzip' if compressed else None)
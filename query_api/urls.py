@@ -1,6 +1,16 @@
 from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
+
 from . import views
 
 urlpatterns = [
     path('query/', views.QueryAPIView.as_view(), name='query'),
+    path('query/batch/', views.QueryBatchAPIView.as_view(), name='query-batch'),
+    path('query/export/', views.QueryExportAPIView.as_view(), name='query-export'),
+    path('query/async/', csrf_exempt(views.AsyncQueryAPIView.as_view()), name='query-async'),
+    path('query/stream/', views.QueryStreamView.as_view(), name='query-stream'),
+    path('query/async/stream/', views.AsyncQueryStreamView.as_view(), name='query-async-stream'),
+    path('jobs/', views.QueryJobAPIView.as_view(), name='query-jobs'),
+    path('jobs/<uuid:job_id>/', views.QueryJobStatusAPIView.as_view(), name='query-job'),
+    path('jobs/<uuid:job_id>/result/', views.QueryJobResultAPIView.as_view(), name='query-job-result'),
 ]
\ No newline at end of file
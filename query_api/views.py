@@ -1,15 +1,44 @@
+import json
+import logging
 import os
+import threading
+import time
 
-from rest_framework.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views import View
+from rest_framework.exceptions import NotAcceptable, ValidationError
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.request import Request
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from rest_framework import status
 
-from sql_agent.exceptions import DatabaseFailure, AgentFailure
-from sql_agent.orchestrator import SyncAgent
+from sql_agent.exceptions import DatabaseFailure, AgentFailure, QueryTimeout, QueryCancelled, Overloaded
+from sql_agent.llm_scheduler import LLMRequest
+from sql_agent.metrics import metrics_registry
+from sql_agent.repositories.exceptions import QueryCancelledError, QueryTimeoutError, RepositoryException
+from sql_agent.registry import get_agent_registry, get_async_agent_registry
 
-from .serializers import QueryRequestSerializer, QueryResponseSerializer
+from .disconnect import disconnect_watcher
+from .exports import EXPORT_CONTENT_TYPES, EXPORT_ENCODERS, SSE_CONTENT_TYPE, sse_event
+from .jobs import JobInterrupted, JobWorkerPool
+from .models import JobStatus, QueryJob
+from .renderers import RESULT_RENDERERS, QueryJSONRenderer, result_data
+from .serializers import (
+    QueryRequestSerializer, QueryResponseSerializer, QueryExportRequestSerializer, QueryJobRequestSerializer,
+    QueryJobSerializer, QueryBatchRequestSerializer, QueryResultRequestSerializer,
+)
+
+logger = logging.getLogger(__name__)
+
+# Status of requests whose client disconnected before the response, as logged by nginx
+CLIENT_CLOSED_REQUEST = 499
+
+_job_worker_pool = None
+_job_worker_pool_lock = threading.Lock()
 
 
 def get_db_connection_url():
@@ -17,16 +46,184 @@ def get_db_connection_url():
     return f"postgresql://{os.environ.get('DB_USER', 'postgres')}:{os.environ.get('DB_PASSWORD', 'postgres')}@{os.environ.get('DB_HOST', 'db')}:{os.environ.get('DB_PORT', '5432')}/{os.environ.get('DB_NAME', 'querycraft_db')}"
 
 
+def get_response_metadata(sql_agent, answer):
+    """Describe how the answer was produced: question cache tier, LLM generations, local repairs, request coalescing, LLM scheduling and result cache statistics."""
+    result_cache = sql_agent.repository.result_cache
+    single_flight = sql_agent.single_flight
+    llm_scheduler = sql_agent.llm_scheduler
+    return {
+        'question_cache': answer.get("cache_hit"),
+        'generations': answer.get("total_generations"),
+        'repairs': answer.get("total_repairs"),
+        'coalescing': single_flight.stats() if single_flight else None,
+        'llm_scheduler': llm_scheduler.stats() if llm_scheduler else None,
+        'result_cache': {'hit': answer["result"].cache_hit, **result_cache.stats()} if result_cache else None,
+    }
+
+
+def answer_data(sql_agent, question, answer, layout='rows'):
+    """
+    Payload of an answered question, its result encoded with ``result_data`` in ``layout``, or kept as the ``Result``
+    for the renderers of ``QueryAPIView`` when ``layout`` is None.
+    """
+    result = answer["result"]
+    return {
+        'question': question,
+        'sql_query': answer["sql_query"],
+        'result': result if layout is None else result_data(result, layout),
+        'error': None,
+        'metadata': get_response_metadata(sql_agent, answer),
+    }
+
+
+def get_llm_request(request, priority='interactive'):
+    """Client, priority and deadline the LLM scheduler admits the LLM calls of an API request with."""
+    deadline = float(os.environ.get('REQUEST_DEADLINE', 60))
+    return LLMRequest(
+        client=request.META.get('HTTP_X_CLIENT_ID') or request.META.get('REMOTE_ADDR'),
+        priority=priority,
+        deadline=time.monotonic() + deadline if deadline else None,
+    )
+
+
+def answer_event(sql_agent, question, event, data):
+    """Encode a progress event of ``agent.stream`` as a Server-Sent Event; the answer becomes a ``result`` event."""
+    if event != "answer":
+        return sse_event(event, data)
+    return sse_event("result", answer_data(sql_agent, question, data))
+
+
+def describe_error(error):
+    """Error message and HTTP status the API responds with when answering a question failed."""
+    if isinstance(error, Overloaded):
+        return str(error), status.HTTP_429_TOO_MANY_REQUESTS
+    if isinstance(error, (QueryTimeout, QueryTimeoutError)):
+        return str(error), status.HTTP_504_GATEWAY_TIMEOUT
+    if isinstance(error, (QueryCancelled, QueryCancelledError)):
+        return str(error), CLIENT_CLOSED_REQUEST
+    # Repository errors reach the API from statements run outside the agent, e.g. the stream of an export
+    if isinstance(error, (DatabaseFailure, AgentFailure, RepositoryException)):
+        return str(error), status.HTTP_500_INTERNAL_SERVER_ERROR
+    return "An unexpected error occurred. Please contact support.", status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def error_headers(error) -> dict:
+    """Headers of the response to a failed question: when to retry one the LLM scheduler rejected."""
+    return {'Retry-After': str(error.retry_after)} if isinstance(error, Overloaded) else {}
+
+
+def error_event(question, error):
+    """Encode a failure while streaming an answer as an ``error`` event, with the status the JSON API responds with."""
+    message, code = describe_error(error)
+    data = {**QueryResponseSerializer({'question': question, 'error': message}).data, 'status': code}
+    if isinstance(error, Overloaded):
+        data['retry_after'] = error.retry_after
+    return sse_event("error", data)
+
+
+def batch_answer_data(sql_agent, batch_answer):
+    """Payload of one answer of a batch: the ``/api/query/`` response together with its status code."""
+    if batch_answer.error is not None:
+        message, code = describe_error(batch_answer.error)
+        return {**QueryResponseSerializer({'question': batch_answer.question, 'error': message}).data, 'status': code}
+    return {**answer_data(sql_agent, batch_answer.question, batch_answer.answer), 'status': status.HTTP_200_OK}
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type=SSE_CONTENT_TYPE)
+    # Deliver every event immediately, also behind buffering reverse proxies
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def get_agent_options():
+    """Table names and schema options of the agents answering API questions."""
+    return {
+        'db_table_names': ('orders', 'products', 'customers'),
+        'schema_top_k': int(os.environ.get('SCHEMA_TOP_K', 8)),
+        'schema_format': os.environ.get('SCHEMA_FORMAT', 'ddl'),
+        'schema_token_budget': int(os.environ.get('SCHEMA_TOKEN_BUDGET', 0)) or None,
+        'statement_timeout': float(os.environ.get('STATEMENT_TIMEOUT', 30)) or None,
+        'validation_mode': os.environ.get('VALIDATION_MODE', 'parse'),
+        'max_plan_cost': float(os.environ.get('PLAN_MAX_COST', 0)) or None,
+        'max_plan_rows': int(os.environ.get('PLAN_MAX_ROWS', 0)) or None,
+        'max_repairs': int(os.environ.get('MAX_REPAIRS', 2)),
+        'generation_candidates': int(os.environ.get('GENERATION_CANDIDATES', 1)),
+        'coalesce_requests': bool(int(os.environ.get('COALESCE_REQUESTS', 1))),
+        'coalesce_timeout': float(os.environ.get('COALESCE_TIMEOUT', 0)) or None,
+    }
+
+
+def answer_job(job, stopped: threading.Event):
+    """
+    Answer the question of a job like ``QueryAPIView``, returning the response payload and its HTTP status.
+
+    While the LLM scheduler queue is full the question is retried for up to ``JOB_MAX_WAIT`` seconds; when the
+    worker pool stops in the meantime, the job is given up with ``JobInterrupted`` and queued again.
+    """
+    sql_agent = get_agent_registry().get_agent(db_connection_url=get_db_connection_url(), **get_agent_options())
+    # Jobs have no deadline in the LLM scheduler queue; they wait for it, or for it to have room again
+    llm_request = LLMRequest(client=job.client, priority=job.priority)
+    deadline = time.monotonic() + float(os.environ.get('JOB_MAX_WAIT', 600))
+    while True:
+        try:
+            answer = sql_agent.ask(question=job.question, llm_request=llm_request)
+            break
+        except Overloaded as e:
+            retry_after = e.retry_after or 1
+            if time.monotonic() + retry_after > deadline:
+                message, code = describe_error(e)
+                return QueryResponseSerializer({'question': job.question, 'error': message}).data, code
+            if stopped.wait(retry_after):
+                raise JobInterrupted(f"Job {job.id} was interrupted while waiting for the LLM scheduler")
+        except Exception as e:
+            message, code = describe_error(e)
+            return QueryResponseSerializer({'question': job.question, 'error': message}).data, code
+
+    return answer_data(sql_agent, job.question, answer), status.HTTP_200_OK
+
+
+def get_job_worker_pool():
+    """
+    The job worker pool of this process, or None when ``JOB_WORKERS`` is 0; started by the WSGI or ASGI application
+    when the server starts, or else by the first job submitted.
+    """
+    global _job_worker_pool
+    with _job_worker_pool_lock:
+        if _job_worker_pool is None and int(os.environ.get('JOB_WORKERS', 2)) > 0:
+            _job_worker_pool = JobWorkerPool.from_env(answer_job)
+            _job_worker_pool.start()
+        return _job_worker_pool
+
+
+def job_response_data(job):
+    """Status of a job with the URLs to poll it."""
+    return {
+        **QueryJobSerializer(job).data,
+        'status_url': reverse('query-job', args=[job.id]),
+        'result_url': reverse('query-job-result', args=[job.id]),
+    }
+
+
 class QueryAPIView(APIView):
     """
     API endpoint using Django REST Framework Class Based Views to handle natural language queries.
     Receives a JSON with the user's question and returns the result.
+
+    The result is rendered as typed JSON (in the ``layout`` of the request), CSV or an Arrow IPC stream, as
+    negotiated by the ``Accept`` header.
     """
     permission_classes = [AllowAny]
+    renderer_classes = RESULT_RENDERERS
+    layout = 'rows'
+
+    def get_renderer_context(self):
+        return {**super().get_renderer_context(), 'layout': self.layout}
 
     def post(self, request):
         # Validate the request data using the serializer
-        serializer = QueryRequestSerializer(data=request.data)
+        serializer = QueryResultRequestSerializer(data=request.data)
 
         try:
             serializer.is_valid(raise_exception=True)
@@ -36,37 +233,327 @@ class QueryAPIView(APIView):
             )
 
         question = serializer.validated_data['question']
+        self.layout = serializer.validated_data['layout']
 
-        # Create a SQL agent with DB connection and table information
-        sql_agent = SyncAgent.with_connection_url(
-            db_connection_url=get_db_connection_url(),
-            db_table_names=('orders', 'products', 'customers')
+        # Get the long-lived SQL agent for this DB connection and table information
+        sql_agent = get_agent_registry().get_agent(db_connection_url=get_db_connection_url(), **get_agent_options())
+
+        try:
+            # The LLM call and the running statement are cancelled when the client disconnects
+            with disconnect_watcher.watch(request) as cancel_token:
+                answer = sql_agent.ask(
+                    question=question, cancel_token=cancel_token, llm_request=get_llm_request(request)
+                )
+        except Exception as e:
+            # Rejected by the LLM scheduler, cancelled because the client went away, timed out or failed
+            message, code = describe_error(e)
+            return Response(
+                QueryResponseSerializer({'question': question, 'error': message}).data,
+                status=code,
+                headers=error_headers(e)
+            )
+
+        # The renderer encodes the result directly in the negotiated format
+        return Response(answer_data(sql_agent, question, answer, layout=None), status=status.HTTP_200_OK)
+
+
+class QueryExportAPIView(APIView):
+    """
+    API endpoint streaming the complete result of a natural language query as NDJSON or CSV.
+
+    The agent answers the question while fetching a single row, then the full result is streamed
+    through a server-side cursor, so memory stays flat and the first rows are sent as soon as
+    the database produces them.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        serializer = QueryExportRequestSerializer(data=request.data)
+
+        try:
+            serializer.is_valid(raise_exception=True)
+        except ValidationError as e:
+            return Response(
+                QueryResponseSerializer({'error': str(e)}).data, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        question = serializer.validated_data['question']
+        export_format = serializer.validated_data['format']
+
+        sql_agent = get_agent_registry().get_agent(db_connection_url=get_db_connection_url(), **get_agent_options())
+
+        try:
+            # Generate and check the query against the database without materializing its result
+            answer = sql_agent.ask(question=question, max_rows=1, llm_request=get_llm_request(request))
+
+            stream = sql_agent.repository.stream_query(
+                answer["sql_query"], batch_size=int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+            )
+            columns = next(stream)
+        except Exception as e:
+            message, code = describe_error(e)
+            return Response(
+                QueryResponseSerializer({'question': question, 'error': message}).data,
+                status=code,
+                headers=error_headers(e)
+            )
+
+        response = StreamingHttpResponse(
+            EXPORT_ENCODERS[export_format](columns, stream), content_type=EXPORT_CONTENT_TYPES[export_format]
         )
+        response['Content-Disposition'] = f'attachment; filename="query.{export_format}"'
+        return response
+
+
+class QueryBatchAPIView(APIView):
+    """
+    API endpoint answering a batch of natural language questions in a single request.
+
+    The schema is loaded once for the batch, identical questions are answered once and at most
+    ``BATCH_CONCURRENCY`` questions are answered at a time. Answers are returned in the order of the questions,
+    each with the ``/api/query/`` payload and its status code; with ``"stream": true`` they are streamed as NDJSON
+    lines, tagged with the ``index`` of their question, as soon as each one completes.
+    """
+    permission_classes = [AllowAny]
+    renderer_classes = [QueryJSONRenderer]
+
+    def post(self, request):
+        serializer = QueryBatchRequestSerializer(data=request.data)
 
         try:
-            answer = sql_agent.ask(question=question)
-        except (DatabaseFailure, AgentFailure) as e:
-            # Handle known agent/database errors
+            serializer.is_valid(raise_exception=True)
+        except ValidationError as e:
             return Response(
-                QueryResponseSerializer(
-                    {'question': question, 'error': str(e)}
-                ).data,
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                QueryResponseSerializer({'error': str(e)}).data, status=status.HTTP_400_BAD_REQUEST
             )
+
+        questions = serializer.validated_data['questions']
+        sql_agent = get_agent_registry().get_agent(db_connection_url=get_db_connection_url(), **get_agent_options())
+        # Batch questions give way to interactive ones in the LLM scheduler, and wait for it without a deadline
+        llm_request = LLMRequest(client=get_llm_request(request).client, priority='batch')
+        max_concurrency = int(os.environ.get('BATCH_CONCURRENCY', 4))
+
+        if serializer.validated_data['stream']:
+            def lines():
+                encoder = DjangoJSONEncoder()
+                try:
+                    for index, batch_answer in sql_agent.iter_many(
+                            questions, max_concurrency=max_concurrency, llm_request=llm_request):
+                        yield encoder.encode({'index': index, **batch_answer_data(sql_agent, batch_answer)}) + "\n"
+                except Exception as e:
+                    message, code = describe_error(e)
+                    yield encoder.encode({'error': message, 'status': code}) + "\n"
+
+            return StreamingHttpResponse(lines(), content_type=EXPORT_CONTENT_TYPES['ndjson'])
+
+        try:
+            answers = sql_agent.ask_many(questions, max_concurrency=max_concurrency, llm_request=llm_request)
         except Exception as e:
-            # Handle unexpected errors
+            # Loading the schema for the batch failed
+            message, code = describe_error(e)
+            return Response(QueryResponseSerializer({'error': message}).data, status=code)
+
+        return Response(
+            {'answers': [batch_answer_data(sql_agent, batch_answer) for batch_answer in answers]},
+            status=status.HTTP_200_OK
+        )
+
+
+class AsyncQueryAPIView(View):
+    """
+    Async variant of ``QueryAPIView`` for ASGI deployments (``querycraft.asgi``), with the same result formats.
+    The LLM and database round trips are awaited on the event loop instead of blocking a worker thread.
+    """
+
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse(
+                QueryResponseSerializer({'error': "Request body must be valid JSON"}).data,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            renderer, media_type = DefaultContentNegotiation().select_renderer(
+                Request(request), [renderer_class() for renderer_class in RESULT_RENDERERS]
+            )
+        except NotAcceptable as e:
+            return JsonResponse(
+                QueryResponseSerializer({'error': str(e.detail)}).data, status=status.HTTP_406_NOT_ACCEPTABLE
+            )
+
+        serializer = QueryResultRequestSerializer(data=data)
+
+        try:
+            serializer.is_valid(raise_exception=True)
+        except ValidationError as e:
+            return JsonResponse(
+                QueryResponseSerializer({'error': str(e)}).data, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        question = serializer.validated_data['question']
+
+        # Get the long-lived async SQL agent of the running event loop
+        sql_agent = get_async_agent_registry().get_agent(
+            db_connection_url=get_db_connection_url(), **get_agent_options()
+        )
+
+        try:
+            # Django cancels this task when the client disconnects; the agent then cancels the running statement
+            answer = await sql_agent.ask(question=question, llm_request=get_llm_request(request))
+        except Exception as e:
+            message, code = describe_error(e)
+            return JsonResponse(
+                QueryResponseSerializer({'question': question, 'error': message}).data,
+                status=code,
+                headers=error_headers(e)
+            )
+
+        content_type = renderer.media_type + (f'; charset={renderer.charset}' if renderer.charset else '')
+        response = HttpResponse(status=status.HTTP_200_OK, content_type=content_type)
+        response.content = renderer.render(
+            answer_data(sql_agent, question, answer, layout=None), media_type,
+            {'layout': serializer.validated_data['layout'], 'response': response}
+        )
+        return response
+
+
+class QueryStreamView(View):
+    """
+    Server-Sent Events endpoint reporting the progress of a question while it is answered.
+
+    ``GET /api/query/stream/?question=...`` emits ``token`` events with the SQL as the LLM generates it,
+    ``sql_generation`` / ``repair`` events with each complete query, ``validation`` and ``execution`` events,
+    and a final ``result`` event with the same payload as ``/api/query/``, or an ``error`` event.
+    """
+
+    def get(self, request):
+        serializer = QueryRequestSerializer(data=request.GET)
+
+        try:
+            serializer.is_valid(raise_exception=True)
+        except ValidationError as e:
+            return JsonResponse(
+                QueryResponseSerializer({'error': str(e)}).data, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        question = serializer.validated_data['question']
+        sql_agent = get_agent_registry().get_agent(db_connection_url=get_db_connection_url(), **get_agent_options())
+        llm_request = get_llm_request(request)
+
+        def events():
+            try:
+                with disconnect_watcher.watch(request) as cancel_token:
+                    for event, data in sql_agent.stream(
+                            question=question, cancel_token=cancel_token, llm_request=llm_request
+                    ):
+                        yield answer_event(sql_agent, question, event, data)
+            except Exception as e:
+                logger.exception("Failed to stream the answer to %r", question)
+                yield error_event(question, e)
+
+        return event_stream_response(events())
+
+
+class AsyncQueryStreamView(View):
+    """
+    Async variant of ``QueryStreamView`` for ASGI deployments; the running query is cancelled when the client
+    disconnects.
+    """
+
+    async def get(self, request):
+        serializer = QueryRequestSerializer(data=request.GET)
+
+        try:
+            serializer.is_valid(raise_exception=True)
+        except ValidationError as e:
+            return JsonResponse(
+                QueryResponseSerializer({'error': str(e)}).data, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        question = serializer.validated_data['question']
+        sql_agent = get_async_agent_registry().get_agent(
+            db_connection_url=get_db_connection_url(), **get_agent_options()
+        )
+        llm_request = get_llm_request(request)
+
+        async def events():
+            try:
+                async for event, data in sql_agent.stream(question=question, llm_request=llm_request):
+                    yield answer_event(sql_agent, question, event, data)
+            except Exception as e:
+                logger.exception("Failed to stream the answer to %r", question)
+                yield error_event(question, e)
+
+        return event_stream_response(events())
+
+
+class QueryJobAPIView(APIView):
+    """
+    API endpoint submitting a question to be answered in the background, for questions that may take longer
+    than a client or proxy is willing to keep a request open.
+
+    Responds with ``202 Accepted`` and the id of the job; its status and result are polled with
+    ``QueryJobStatusAPIView`` and ``QueryJobResultAPIView``.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        serializer = QueryJobRequestSerializer(data=request.data)
+
+        try:
+            serializer.is_valid(raise_exception=True)
+        except ValidationError as e:
             return Response(
-                QueryResponseSerializer(
-                    {'question': question, 'error': "An unexpected error occurred. Please contact support."}
-                ).data,
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                QueryResponseSerializer({'error': str(e)}).data, status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Format and return the successful response
-        response_serializer = QueryResponseSerializer({
-            'question': question,
-            'sql_query': answer["sql_query"],
-            'result': answer["result"],
-        })
+        job = QueryJob.objects.create(
+            question=serializer.validated_data['question'],
+            priority=serializer.validated_data['priority'],
+            client=get_llm_request(request).client,
+        )
+
+        job_worker_pool = get_job_worker_pool()
+        if job_worker_pool:
+            job_worker_pool.notify()
+
+        data = job_response_data(job)
+        return Response(data, status=status.HTTP_202_ACCEPTED, headers={'Location': data['status_url']})
+
+
+class QueryJobStatusAPIView(APIView):
+    """API endpoint returning the status of a job."""
+    permission_classes = [AllowAny]
+
+    def get(self, request, job_id):
+        job = QueryJob.objects.filter(id=job_id).first()
+        if job is None:
+            return Response({'error': "Job not found, or its result expired"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job_response_data(job), status=status.HTTP_200_OK)
+
+
+class QueryJobResultAPIView(APIView):
+    """
+    API endpoint returning the result of a finished job with the payload and status of ``/api/query/``.
+    Responds with ``202 Accepted`` and the job status while the job is queued or running.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, job_id):
+        job = QueryJob.objects.filter(id=job_id).first()
+        if job is None:
+            return Response({'error': "Job not found, or its result expired"}, status=status.HTTP_404_NOT_FOUND)
+        if job.status not in (JobStatus.SUCCEEDED, JobStatus.FAILED):
+            return Response(job_response_data(job), status=status.HTTP_202_ACCEPTED)
+        return Response(job.response, status=job.response_status)
+
+
+class MetricsView(View):
+    """
+    Prometheus scrape endpoint: ``GET /metrics`` returns the metrics of this process in the text exposition format.
+    """
 
-        return Response(response_serializer.data, status=status.HTTP_200_OK)
+    def get(self, request):
+        return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
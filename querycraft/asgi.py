@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "querycraft.settings")
 
 application = get_asgi_application()
+
+# Answer the queued jobs, and recover the jobs of a process that died, as soon as the server starts
+from query_api.views import get_job_worker_pool  # noqa: E402
+
+get_job_worker_pool()
@@ -18,8 +18,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from query_api.views import MetricsView
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path('api/', include('query_api.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('', include('ui.urls')),  # Include UI app URLs for frontend
 ]
@@ -0,0 +1,80 @@
+import contextlib
+import logging
+import threading
+from typing import Callable
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from sql_agent.exceptions import QueryCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class CancellationToken:
+    """
+    Lets another thread or task cancel the database statement running on behalf of a request.
+
+    Repositories register a driver specific cancel callback for the duration of each statement;
+    ``cancel`` marks the token and invokes the callbacks registered at that moment.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Cancel the running statement, if any, and every statement started later with this token"""
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = list(self._callbacks)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Failed to cancel the running statement")
+
+    @contextlib.contextmanager
+    def on_cancel(self, callback: Callable[[], None]):
+        """Invoke ``callback`` if the token is cancelled while the block runs"""
+        with self._lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self._callbacks.append(callback)
+        if cancelled:
+            callback()
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+class CancellationCallback(BaseCallbackHandler):
+    """
+    Stops an LLM call of a cancelled request: before it is sent, or at the next token the model streams, which
+    closes the connection to the LLM server so that it stops generating.
+    """
+
+    raise_error = True
+
+    def __init__(self, token: CancellationToken):
+        self.token = token
+
+    def _check(self):
+        if self.token.cancelled:
+            raise QueryCancelled("The LLM call was cancelled")
+
+    def on_llm_start(self, *args, **kwargs):
+        self._check()
+
+    def on_chat_model_start(self, *args, **kwargs):
+        self._check()
+
+    def on_llm_new_token(self, *args, **kwargs):
+        self._check()
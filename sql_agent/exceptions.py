@@ -6,3 +6,22 @@ class DatabaseFailure(Exception):
 class AgentFailure(Exception):
     """Raised when can not answer the question"""
     pass
+
+
+class QueryTimeout(Exception):
+    """Raised when the query exceeded its execution deadline"""
+    pass
+
+
+class QueryCancelled(Exception):
+    """Raised when the query was cancelled, e.g. because the client disconnected"""
+    pass
+
+
+class Overloaded(Exception):
+    """Raised when the LLM backend is too busy to answer the question within its deadline"""
+
+    def __init__(self, message: str, retry_after: int = None):
+        super().__init__(message)
+        # Seconds after which a retry is likely to be admitted
+        self.retry_after = retry_after
@@ -1,15 +1,184 @@
+import asyncio
+import contextlib
+import functools
 import logging
+import time
+from concurrent.futures import as_completed
 
-from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.runnables.config import ContextThreadPoolExecutor, merge_configs
+from langgraph.config import get_stream_writer
 from langgraph.graph import StateGraph, END
 
-from sql_agent.exceptions import AgentFailure, DatabaseFailure
-from sql_agent.models import State, Result, ValidationResult
-from sql_agent.repositories.exceptions import ValidationError, DatabaseError
+from sql_agent.cancellation import CancellationCallback, CancellationToken
+from sql_agent.exceptions import AgentFailure, DatabaseFailure, QueryTimeout, QueryCancelled
+from sql_agent.metrics import LLM_CALL_DURATION, NODE_DURATION
+from sql_agent.models import State, ValidationResult, QueryPlan
+from sql_agent.repositories.base import BaseDatabaseRepository
+from sql_agent.repositories.exceptions import ValidationError, DatabaseError, QueryTimeoutError, QueryCancelledError
+from sql_agent.schema_rendering import get_schema_renderer
+from sql_agent.schema_retrieval import select_tables
 from sql_agent.sql_coder.generator import sql_generator, Query, Feedback, sql_corrector
+from sql_agent.sql_repair import repair_query
 
 logger = logging.getLogger(__name__)
 
+# Sampling temperature of the candidates after the first, greedy one when generating several candidates per round
+CANDIDATE_TEMPERATURE = 0.8
+
+
+def prepare_schema(state: State, config: RunnableConfig, repository: BaseDatabaseRepository):
+    """Select the tables relevant to the question and render their schema for the prompt"""
+    db_table_names = config["configurable"]["db_table_names"]
+    schema_top_k = config["configurable"].get("schema_top_k")
+
+    # Prune the schema to the tables relevant to the question once; correction rounds reuse the selection
+    selected_tables = state.selected_tables
+    if selected_tables is None:
+        if schema_top_k and len(db_table_names) > schema_top_k:
+            tables = repository.get_table_metadata(tuple(db_table_names))
+            selected_tables = select_tables(state.question, tables, schema_top_k)
+        else:
+            selected_tables = list(db_table_names)
+
+    # Render the current database schema of the selected tables within the prompt token budget
+    renderer = get_schema_renderer(config["configurable"].get("schema_format", "ddl"))
+    rendered_schema = renderer.render(
+        repository, tuple(selected_tables), config["configurable"].get("schema_token_budget")
+    )
+    return selected_tables, rendered_schema
+
+
+def generation_inputs(state: State, database_schema: str):
+    """Pick the generator or, after a failed attempt, the corrector together with its inputs"""
+    if state.validation_result:
+        return sql_corrector, Feedback(
+            database_schema=database_schema,
+            question=state.question,
+            sql_query=state.sql_query,
+            feedback=state.validation_result.feedback
+        )
+    return sql_generator, Query(database_schema=database_schema, question=state.question)
+
+
+def generation_update(sql_query: str, selected_tables, rendered_schema, validation: ValidationResult = None):
+    return {
+        "sql_query": sql_query,
+        "selected_tables": selected_tables,
+        "schema_tokens": rendered_schema.tokens,
+        "schema_tokens_saved": rendered_schema.tokens_saved,
+        # Candidates are validated while generating; a single generated query still has to be validated
+        "validation_result": validation,
+        "total_generations": 1
+    }
+
+
+def call_llm(config: RunnableConfig, invoke, inputs, call_config: RunnableConfig = None):
+    """
+    Call the LLM once the scheduler of the config, if any, admits the call of this request
+
+    The call stops early once the ``cancel_token`` of the request is cancelled, e.g. when its client disconnected.
+    """
+    cancel_token = config["configurable"].get("cancel_token")
+    if cancel_token is not None:
+        # Keeps the callbacks of the node, so that the call still reports to the tracer
+        call_config = merge_configs(
+            call_config or RunnableConfig(), RunnableConfig(callbacks=[CancellationCallback(cancel_token)])
+        )
+    args = (inputs,) if call_config is None else (inputs, call_config)
+
+    scheduler = config["configurable"].get("llm_scheduler")
+    if scheduler is None:
+        return timed_llm_call(invoke, *args)
+    with scheduler.slot(config["configurable"].get("llm_request")):
+        return timed_llm_call(invoke, *args)
+
+
+async def acall_llm(config: RunnableConfig, ainvoke, *args):
+    """Async variant of ``call_llm``"""
+    scheduler = config["configurable"].get("llm_scheduler")
+    if scheduler is None:
+        return await atimed_llm_call(ainvoke, *args)
+    async with scheduler.aslot(config["configurable"].get("llm_request")):
+        return await atimed_llm_call(ainvoke, *args)
+
+
+def timed_llm_call(invoke, *args):
+    started = time.perf_counter()
+    try:
+        return invoke(*args)
+    finally:
+        LLM_CALL_DURATION.observe(time.perf_counter() - started)
+
+
+async def atimed_llm_call(ainvoke, *args):
+    started = time.perf_counter()
+    try:
+        return await ainvoke(*args)
+    finally:
+        LLM_CALL_DURATION.observe(time.perf_counter() - started)
+
+
+def candidate_config(index: int) -> RunnableConfig:
+    """Sampling settings of a candidate: the first one is greedy, the others sample with different seeds"""
+    if index == 0:
+        return RunnableConfig(configurable={"temperature": 0.0})
+    return RunnableConfig(configurable={"temperature": CANDIDATE_TEMPERATURE, "seed": index})
+
+
+def first_valid_candidate(runnable, inputs, config: RunnableConfig):
+    """
+    Generate several candidates concurrently and return the first one to pass validation with its validation result
+
+    Candidates are validated as they arrive; once one is valid, candidates that have not started are cancelled and
+    the pending LLM calls are stopped at their next token. When no candidate is valid, the first one is returned with
+    its validation feedback for repair or correction.
+    """
+    candidates = config["configurable"]["generation_candidates"]
+    # The LLM calls of the candidates are stopped once the request is cancelled too
+    request_token = config["configurable"].get("cancel_token")
+    candidates_token = CancellationToken()
+    candidates_config = {**config, "configurable": {**config["configurable"], "cancel_token": candidates_token}}
+    # Copies the context of the node, so that LLM calls report to the same callbacks
+    executor = ContextThreadPoolExecutor(max_workers=candidates)
+    with request_token.on_cancel(candidates_token.cancel) if request_token else contextlib.nullcontext():
+        futures = {
+            executor.submit(call_llm, candidates_config, runnable.invoke, inputs, candidate_config(index)): index
+            for index in range(candidates)
+        }
+        try:
+            failed = {}
+            for future in as_completed(futures):
+                sql_query = future.result()
+                validation = check_query(sql_query, config)
+                if validation.is_valid:
+                    return sql_query, validation
+                failed[futures[future]] = (sql_query, validation)
+            return failed[min(failed)]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            candidates_token.cancel()
+
+
+async def afirst_valid_candidate(runnable, inputs, config: RunnableConfig):
+    """Async variant of ``first_valid_candidate``; candidates are validated concurrently and the rest cancelled"""
+    async def attempt(index):
+        sql_query = await acall_llm(config, runnable.ainvoke, inputs, candidate_config(index))
+        return index, sql_query, await acheck_query(sql_query, config)
+
+    tasks = [asyncio.create_task(attempt(index)) for index in range(config["configurable"]["generation_candidates"])]
+    try:
+        failed = {}
+        for next_done in asyncio.as_completed(tasks):
+            index, sql_query, validation = await next_done
+            if validation.is_valid:
+                return sql_query, validation
+            failed[index] = (sql_query, validation)
+        return failed[min(failed)]
+    finally:
+        for task in tasks:
+            task.cancel()
+
 
 def sql_generation_node(state: State, config: RunnableConfig):
     """Generate SQL query from natural language question using Ollama"""
@@ -19,80 +188,272 @@ def sql_generation_node(state: State, config: RunnableConfig):
 
     # Get repository from config
     repository = config["configurable"]["repository"]
-    db_table_names = config["configurable"]["db_table_names"]
 
-    # Get the current database schema using repository
-    database_schema = repository.get_table_schema(db_table_names)
+    selected_tables, rendered_schema = prepare_schema(state, config, repository)
+    runnable, inputs = generation_inputs(state, rendered_schema.text)
+    if config["configurable"].get("generation_candidates", 1) > 1:
+        sql_query, validation = first_valid_candidate(runnable, inputs, config)
+        return generation_update(sql_query, selected_tables, rendered_schema, validation)
+    sql_query = call_llm(config, runnable.invoke, inputs)
 
-    if state.validation_result:
-        sql_query = sql_corrector.invoke(Feedback(
-            database_schema=database_schema,
-            question=state.question,
-            sql_query=state.sql_query,
-            feedback=state.validation_result.feedback
-        ))
-    else:
-        sql_query = sql_generator.invoke(Query(database_schema=database_schema, question=state.question))
+    return generation_update(sql_query, selected_tables, rendered_schema)
 
-    return {"sql_query": sql_query, "total_generations": 1}
 
+async def asql_generation_node(state: State, config: RunnableConfig):
+    """Async variant of ``sql_generation_node`` for an ``AsyncDatabaseRepository``"""
 
-def validation_node(state: State, config: RunnableConfig):
-    """Validate the generated SQL query using repository"""
+    if state.total_generations >= config["configurable"]["max_generations"]:
+        raise AgentFailure("Agent could not answer the question")
+
+    repository = config["configurable"]["repository"]
+
+    # Schema preparation only reaches the database on schema cache misses; its queries are awaited
+    selected_tables, rendered_schema = await repository.run_sync(
+        prepare_schema, state, config, repository.repository
+    )
+    runnable, inputs = generation_inputs(state, rendered_schema.text)
+    if config["configurable"].get("generation_candidates", 1) > 1:
+        sql_query, validation = await afirst_valid_candidate(runnable, inputs, config)
+        return generation_update(sql_query, selected_tables, rendered_schema, validation)
+    sql_query = await acall_llm(config, runnable.ainvoke, inputs)
+
+    return generation_update(sql_query, selected_tables, rendered_schema)
+
+
+def check_query_plan(plan: QueryPlan, config: RunnableConfig):
+    """Reject plans whose estimated cost or intermediate row count exceed the configured thresholds"""
+    max_plan_cost = config["configurable"].get("max_plan_cost")
+    max_plan_rows = config["configurable"].get("max_plan_rows")
+
+    problems = []
+    if max_plan_cost and plan.total_cost is not None and plan.total_cost > max_plan_cost:
+        problems.append(f"estimated cost {plan.total_cost:.0f} exceeds the limit of {max_plan_cost:.0f}")
+    if max_plan_rows and plan.max_rows is not None and plan.max_rows > max_plan_rows:
+        problems.append(
+            f"a plan step processes an estimated {plan.max_rows} rows, more than the limit of {max_plan_rows}"
+        )
+
+    if problems:
+        raise ValidationError(
+            f"The query is too expensive to run: {'; '.join(problems)}. Rewrite it to read fewer rows, "
+            f"for example by adding missing join conditions, more selective filters or aggregation.\n"
+            f"Query plan:\n{plan.summary}"
+        )
+
+
+def check_query(sql_query: str, config: RunnableConfig) -> ValidationResult:
+    """Validate a query using the repository of the config"""
+    repository = config["configurable"]["repository"]
+    try:
+        repository.validate_query(sql_query, config["configurable"]["db_table_names"])
+        if config["configurable"].get("validation_mode") == "explain":
+            # Planner errors and expensive plans are sent back for correction without executing the query
+            plan = repository.explain_query(
+                sql_query,
+                config["configurable"].get("max_rows", 1000),
+                timeout=config["configurable"].get("statement_timeout")
+            )
+            check_query_plan(plan, config)
+        validation = ValidationResult(is_valid=True)
+    except ValidationError as e:
+        validation = ValidationResult(is_valid=False, feedback=str(e))
+    except QueryTimeoutError as e:
+        raise QueryTimeout(str(e))
+    except DatabaseError as e:
+        raise DatabaseFailure(f"Database error during query validation: {str(e)}")
+    return validation
+
+
+async def acheck_query(sql_query: str, config: RunnableConfig) -> ValidationResult:
+    """Async variant of ``check_query``"""
     repository = config["configurable"]["repository"]
     try:
-        repository.validate_query(state.sql_query)
+        await repository.validate_query(sql_query, config["configurable"]["db_table_names"])
+        if config["configurable"].get("validation_mode") == "explain":
+            plan = await repository.explain_query(
+                sql_query,
+                config["configurable"].get("max_rows", 1000),
+                timeout=config["configurable"].get("statement_timeout")
+            )
+            check_query_plan(plan, config)
         validation = ValidationResult(is_valid=True)
     except ValidationError as e:
         validation = ValidationResult(is_valid=False, feedback=str(e))
-    return {"validation_result": validation}
+    except QueryTimeoutError as e:
+        raise QueryTimeout(str(e))
+    except DatabaseError as e:
+        raise DatabaseFailure(f"Database error during query validation: {str(e)}")
+    return validation
+
+
+def validation_node(state: State, config: RunnableConfig):
+    """Validate the generated SQL query using repository"""
+    return {"validation_result": check_query(state.sql_query, config)}
+
+
+async def avalidation_node(state: State, config: RunnableConfig):
+    """Async variant of ``validation_node``"""
+    return {"validation_result": await acheck_query(state.sql_query, config)}
 
 
 def execution_node(state: State, config: RunnableConfig):
     """Execute the validated SQL query against the database"""
+    get_stream_writer()({"event": "execution", "sql_query": state.sql_query})
     try:
         repository = config["configurable"]["repository"]
         max_rows = config["configurable"].get("max_rows", 1000)
 
         # Execute the query using repository
-        columns, rows = repository.execute_query(state.sql_query, max_rows)
-
-        return {
-            "result": Result(
-                columns=columns,
-                rows=rows,
-                total_rows=len(rows)
-            )
-        }
+        return {"result": repository.execute_query(
+            state.sql_query,
+            max_rows,
+            timeout=config["configurable"].get("statement_timeout"),
+            cancel_token=config["configurable"].get("cancel_token")
+        )}
 
     except ValidationError as e:  # Specific exception for query validation errors
         return {"validation_result": ValidationResult(is_valid=False, feedback=str(e))}
+    except QueryTimeoutError as e:  # Not fed back to the LLM; a rewrite is unlikely to make the query fast enough
+        raise QueryTimeout(str(e))
+    except QueryCancelledError as e:
+        raise QueryCancelled(str(e))
     except DatabaseError as e:
         raise DatabaseFailure(f"Database error during query execution: {str(e)}")
     except Exception as e:
         raise Exception(f"Unexpected error during query execution: {str(e)}")
 
 
+async def aexecution_node(state: State, config: RunnableConfig):
+    """Async variant of ``execution_node``"""
+    get_stream_writer()({"event": "execution", "sql_query": state.sql_query})
+    try:
+        repository = config["configurable"]["repository"]
+        max_rows = config["configurable"].get("max_rows", 1000)
+
+        return {"result": await repository.execute_query(
+            state.sql_query,
+            max_rows,
+            timeout=config["configurable"].get("statement_timeout"),
+            cancel_token=config["configurable"].get("cancel_token")
+        )}
+
+    except ValidationError as e:
+        return {"validation_result": ValidationResult(is_valid=False, feedback=str(e))}
+    except QueryTimeoutError as e:  # Not fed back to the LLM; a rewrite is unlikely to make the query fast enough
+        raise QueryTimeout(str(e))
+    except QueryCancelledError as e:
+        raise QueryCancelled(str(e))
+    except DatabaseError as e:
+        raise DatabaseFailure(f"Database error during query execution: {str(e)}")
+    except Exception as e:
+        raise Exception(f"Unexpected error during query execution: {str(e)}")
+
+
+def repair_update(state: State, tables, dialect: str):
+    """
+    Rewrite the failed query with the local repair rules; an empty update, or one keeping the failed validation
+    result with the repair hints added to its feedback, leaves it to the LLM corrector
+    """
+    repair = repair_query(state.sql_query, state.validation_result.feedback, dialect, tables)
+    if repair is None:
+        return {}
+    update = {}
+    if repair.rules:
+        logger.info("Repaired query locally with rules: %s", ", ".join(repair.rules))
+        update = {"sql_query": repair.sql_query, "total_repairs": 1}
+    if repair.hints:
+        # Guesses such as a similarly named column are not executed, the corrector decides with the question at hand
+        feedback = "\n".join([state.validation_result.feedback or "", *repair.hints]).strip()
+        return {**update, "validation_result": ValidationResult(is_valid=False, feedback=feedback)}
+    # The repaired query has not been validated yet
+    return {**update, "validation_result": None}
+
+
+def repair_node(state: State, config: RunnableConfig):
+    """Try cheap deterministic rewrites of a failed query before asking the LLM to correct it"""
+    if state.total_repairs >= config["configurable"].get("max_repairs", 0):
+        return {}
+
+    repository = config["configurable"]["repository"]
+    try:
+        tables = repository.get_table_metadata(tuple(config["configurable"]["db_table_names"]))
+    except DatabaseError:
+        logger.warning("Skipping local query repair, table metadata is unavailable", exc_info=True)
+        return {}
+    return repair_update(state, tables, repository.sql_dialect)
+
+
+async def arepair_node(state: State, config: RunnableConfig):
+    """Async variant of ``repair_node``"""
+    if state.total_repairs >= config["configurable"].get("max_repairs", 0):
+        return {}
+
+    repository = config["configurable"]["repository"]
+    try:
+        tables = await repository.get_table_metadata(tuple(config["configurable"]["db_table_names"]))
+    except DatabaseError:
+        logger.warning("Skipping local query repair, table metadata is unavailable", exc_info=True)
+        return {}
+    return repair_update(state, tables, repository.sql_dialect)
+
+
+def route_generation(state: State):
+    if state.validation_result is None:
+        return "validation"
+    return "execution" if state.validation_result.is_valid else "repair"
+
+
+def timed_node(name: str, func, afunc) -> RunnableLambda:
+    """Node running ``func`` or ``afunc`` and recording their duration, including failed runs, as ``name``"""
+    @functools.wraps(func)
+    def node(state: State, config: RunnableConfig):
+        started = time.perf_counter()
+        try:
+            return func(state, config)
+        finally:
+            NODE_DURATION.observe(time.perf_counter() - started, name)
+
+    @functools.wraps(afunc)
+    async def anode(state: State, config: RunnableConfig):
+        started = time.perf_counter()
+        try:
+            return await afunc(state, config)
+        finally:
+            NODE_DURATION.observe(time.perf_counter() - started, name)
+
+    return RunnableLambda(node, afunc=anode)
+
+
 def create_graph():
     """Create and compile the LangGraph workflow"""
     # Create a state graph
     graph = StateGraph(State)
 
-    # Add nodes
-    graph.add_node("sql_generation", sql_generation_node)
-    graph.add_node("validation", validation_node)
-    graph.add_node("execution", execution_node)
+    # Add nodes; ``invoke`` runs the sync implementations (SyncAgent) and ``ainvoke`` the async ones (AsyncAgent),
+    # both recording the node duration metric
+    graph.add_node("sql_generation", timed_node("sql_generation", sql_generation_node, asql_generation_node))
+    graph.add_node("validation", timed_node("validation", validation_node, avalidation_node))
+    graph.add_node("execution", timed_node("execution", execution_node, aexecution_node))
+    graph.add_node("repair", timed_node("repair", repair_node, arepair_node))
 
-    # Set entry point
-    graph.set_entry_point("sql_generation")
+    # Set entry point; questions answered from the query cache start with their SQL and skip generation
+    graph.set_conditional_entry_point(lambda state: "validation" if state.sql_query else "sql_generation")
 
-    # Add conditional edges
+    # Add conditional edges; failed queries are first repaired locally, then corrected by the LLM
     graph.add_conditional_edges("validation",
-                                lambda state: "execution" if state.validation_result.is_valid else "sql_generation")
-    graph.add_conditional_edges("execution", lambda state: END if state.result else "sql_generation")
+                                lambda state: "execution" if state.validation_result.is_valid else "repair")
+    graph.add_conditional_edges("execution", lambda state: END if state.result else "repair")
+    graph.add_conditional_edges("repair",
+                                lambda state: "validation" if state.validation_result is None else "sql_generation")
 
-    # Add edges
-    graph.add_edge("sql_generation", "validation")
+    # Generated queries are validated next, unless they were validated as candidates already
+    graph.add_conditional_edges("sql_generation", route_generation)
 
     # Compile the workflow
     return graph.compile()
+
+
+@functools.cache
+def get_graph():
+    """Return the process-wide compiled workflow; compiled graphs hold no per-request state and are safe to share"""
+    return create_graph()
@@ -0,0 +1,213 @@
+import asyncio
+import contextlib
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, NamedTuple, Optional
+
+from sql_agent.exceptions import Overloaded
+
+# Queued LLM calls are admitted by priority first, lower values first
+PRIORITIES = {
+    "interactive": 0,
+    "batch": 1,
+}
+
+# Weight of the latest call in the moving average of the LLM call duration
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class LLMRequest(NamedTuple):
+    """Who an LLM call is made for: the client it is fairly shared with, its priority and deadline"""
+    client: Optional[str] = None
+    priority: str = "interactive"
+    # time.monotonic() value after which the answer is of no use anymore
+    deadline: Optional[float] = None
+
+
+class _Waiter:
+    def __init__(self, request: LLMRequest, sequence: int, wake: Callable[[], None]):
+        self.client = request.client
+        self.priority = PRIORITIES[request.priority]
+        self.sequence = sequence
+        self.wake = wake
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class LLMScheduler:
+    """
+    Admission control for calls to the LLM backend, shared by sync and async agents of a process.
+
+    At most ``max_concurrency`` calls run at once, matching the parallelism of the Ollama server. Further calls
+    wait in a queue of at most ``max_queue`` calls; a freed slot goes to the waiting call with the best priority,
+    then to the client with the fewest running calls, then to the longest waiting one. Calls that would wait past
+    the deadline of their request are rejected right away with ``Overloaded``, whose ``retry_after`` estimates
+    when the queue will have room, instead of tying up a web worker until it times out.
+    """
+
+    def __init__(self, max_concurrency: int = 1, max_queue: int = 32, service_time: float = 5.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        # Moving average of the duration of an LLM call, used to estimate queue waits
+        self.service_time = service_time
+        self.running = 0
+        self._running_by_client = defaultdict(int)
+        self._queue = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+
+    @classmethod
+    def from_env(cls):
+        """Factory method creating a scheduler configured from environment variables, or None when disabled"""
+        max_concurrency = int(os.environ.get('LLM_MAX_CONCURRENCY', 1))
+        if max_concurrency <= 0:
+            return None
+        return cls(
+            max_concurrency=max_concurrency,
+            max_queue=int(os.environ.get('LLM_MAX_QUEUE', 32)),
+            service_time=float(os.environ.get('LLM_SERVICE_TIME', 5)),
+        )
+
+    @contextlib.contextmanager
+    def slot(self, request: LLMRequest = None):
+        """Hold one of the concurrent LLM call slots for the duration of the block, waiting for it if necessary"""
+        request = request or LLMRequest()
+        event = threading.Event()
+        waiter = self._enqueue(request, event.set)
+        if waiter is not None:
+            timeout = None if request.deadline is None else max(request.deadline - time.monotonic(), 0)
+            if not event.wait(timeout) and not self._abandon(waiter):
+                raise self._timed_out()
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(request.client, started)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, request: LLMRequest = None):
+        """Async variant of ``slot``; a call cancelled while waiting leaves the queue"""
+        request = request or LLMRequest()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            # Slots are released from any thread or event loop
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enqueue(request, wake)
+        if waiter is not None:
+            timeout = None if request.deadline is None else max(request.deadline - time.monotonic(), 0)
+            try:
+                await asyncio.wait_for(granted, timeout)
+            except TimeoutError:
+                if not self._abandon(waiter):
+                    raise self._timed_out()
+            except asyncio.CancelledError:
+                if self._abandon(waiter):
+                    self._release(request.client)
+                raise
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(request.client, started)
+
+    def stats(self) -> dict:
+        """Running and queued calls, admission counters and queue time of admitted calls"""
+        with self._lock:
+            return {
+                "running": self.running,
+                "waiting": len(self._queue),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "queue_seconds_total": self.queue_seconds,
+                "queue_seconds_max": self.max_queue_seconds,
+                "service_time": self.service_time,
+            }
+
+    def _enqueue(self, request: LLMRequest, wake: Callable[[], None]) -> Optional[_Waiter]:
+        """Take a free slot, returning None, or queue the call and return its waiter"""
+        if request.priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{request.priority}', expected one of: {', '.join(PRIORITIES)}")
+
+        with self._lock:
+            if self.running < self.max_concurrency:
+                self._start(request.client)
+                return None
+
+            priority = PRIORITIES[request.priority]
+            ahead = sum(1 for waiter in self._queue if waiter.priority <= priority)
+            wait = self._estimate_wait(ahead)
+            if len(self._queue) >= self.max_queue or (
+                    request.deadline is not None and time.monotonic() + wait > request.deadline):
+                self.rejected += 1
+                raise Overloaded(
+                    f"The SQL generator is busy: {len(self._queue)} requests are waiting, the estimated wait is "
+                    f"{wait:.0f} seconds", retry_after=math.ceil(self._estimate_wait(len(self._queue)))
+                )
+
+            self._sequence += 1
+            waiter = _Waiter(request, self._sequence, wake)
+            self._queue.append(waiter)
+            self.queued += 1
+            return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """Remove a waiter that gives up from the queue; returns whether it was granted a slot in the meantime"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._queue.remove(waiter)
+            return False
+
+    def _timed_out(self) -> Overloaded:
+        with self._lock:
+            self.rejected += 1
+            retry_after = math.ceil(self._estimate_wait(len(self._queue)))
+        return Overloaded("The SQL generator is busy and the request deadline passed", retry_after=retry_after)
+
+    def _release(self, client: Optional[str], started: float = None):
+        """Free the slot of a call that ran since ``started``, or was granted a slot it did not use, for the next one"""
+        with self._lock:
+            self.running -= 1
+            self._running_by_client[client] -= 1
+            if not self._running_by_client[client]:
+                del self._running_by_client[client]
+            if started is not None:
+                duration = time.monotonic() - started
+                self.service_time += SERVICE_TIME_SMOOTHING * (duration - self.service_time)
+
+            while self._queue and self.running < self.max_concurrency:
+                # Best priority first, then the client with the fewest running calls, then first come first served
+                waiter = min(
+                    self._queue,
+                    key=lambda queued: (queued.priority, self._running_by_client.get(queued.client, 0), queued.sequence)
+                )
+                self._queue.remove(waiter)
+                waiter.granted = True
+                self._start(waiter.client)
+                waited = time.monotonic() - waiter.enqueued
+                self.queue_seconds += waited
+                self.max_queue_seconds = max(self.max_queue_seconds, waited)
+                waiter.wake()
+
+    def _start(self, client: Optional[str]):
+        self.running += 1
+        self._running_by_client[client] += 1
+        self.admitted += 1
+
+    def _estimate_wait(self, ahead: int) -> float:
+        """Expected seconds until a call with ``ahead`` calls queued before it gets a slot"""
+        return (ahead // self.max_concurrency + 1) * self.service_time
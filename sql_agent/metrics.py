@@ -0,0 +1,206 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Histogram buckets of durations, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Histogram buckets of connection pool checkout waits, in seconds
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+# Shards of finished threads are folded together once a metric has this many shards
+MAX_SHARDS = 64
+
+# A metric family produced by a collector: name, type, help text and samples of (labels, value)
+MetricFamily = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+class _Metric:
+    """
+    Metric whose values are sharded per thread: a thread only ever updates its own shard, so recording a value takes
+    no lock. Scrapes merge the shards and fold those of finished threads into a single retired shard.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, dict]] = []
+        self._retired: dict = {}
+        self._lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                if len(self._shards) >= MAX_SHARDS:
+                    self._retire_finished()
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _retire_finished(self):
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self._merge(self._retired, values)
+        self._shards = alive
+
+    def collect(self) -> dict:
+        """Values of all threads by label values"""
+        with self._lock:
+            self._retire_finished()
+            merged = {}
+            self._merge(merged, self._retired)
+            for _, values in self._shards:
+                # Copying a dict is atomic, the owning thread may keep updating it
+                self._merge(merged, values.copy())
+        return merged
+
+    def _merge(self, target: dict, values: dict):
+        raise NotImplementedError
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def _labels(self, labelvalues: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, labelvalues))
+
+
+class Counter(_Metric):
+    """Monotonically increasing value, e.g. a number of events"""
+
+    type = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        values = self._shard()
+        values[labelvalues] = values.get(labelvalues, 0) + amount
+
+    def _merge(self, target: dict, values: dict):
+        for labelvalues, value in values.items():
+            target[labelvalues] = target.get(labelvalues, 0) + value
+
+    def samples(self):
+        for labelvalues, value in sorted(self.collect().items()):
+            yield self.name, self._labels(labelvalues), value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets, with their sum and count"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues: str):
+        values = self._shard()
+        counts = values.get(labelvalues)
+        if counts is None:
+            # Observations per bucket, the last one unbounded, followed by the sum of the observed values
+            counts = values[labelvalues] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, target: dict, values: dict):
+        for labelvalues, counts in values.items():
+            merged = target.setdefault(labelvalues, [0] * (len(self.buckets) + 2))
+            for index, count in enumerate(list(counts)):
+                merged[index] += count
+
+    def samples(self):
+        for labelvalues, counts in sorted(self.collect().items()):
+            labels = self._labels(labelvalues)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """Metrics of the process, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[MetricFamily]]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricFamily]]):
+        """Add a callable producing metric families at scrape time, e.g. from the statistics of a cache"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines += _header(metric.name, metric.type, metric.documentation)
+            lines += [_sample(name, labels, value) for name, labels, value in metric.samples()]
+        for collector in collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines += _header(name, metric_type, documentation)
+                lines += [_sample(name, labels, value) for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+
+def _header(name: str, metric_type: str, documentation: str) -> List[str]:
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+
+
+def _sample(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        escaped = (str(labelvalue).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+                   for labelvalue in labels.values())
+        name += "{" + ",".join(f'{label}="{labelvalue}"' for label, labelvalue in zip(labels, escaped)) + "}"
+    return f"{name} {_format_value(value)}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+metrics_registry = MetricsRegistry()
+
+NODE_DURATION = metrics_registry.register(Histogram(
+    "querycraft_node_duration_seconds", "Duration of the agent graph nodes", ("node",)
+))
+LLM_CALL_DURATION = metrics_registry.register(Histogram(
+    "querycraft_llm_call_duration_seconds", "Duration of LLM calls, without the wait for an LLM scheduler slot"
+))
+LLM_TOKENS = metrics_registry.register(Counter(
+    "querycraft_llm_tokens_total", "Tokens of LLM prompts and completions", ("kind",)
+))
+GENERATIONS = metrics_registry.register(Histogram(
+    "querycraft_generations_per_question", "LLM generation rounds needed to answer a question",
+    buckets=(0, 1, 2, 3, 4, 5, 8)
+))
+DB_CHECKOUT_WAIT = metrics_registry.register(Histogram(
+    "querycraft_db_pool_checkout_wait_seconds", "Time spent getting a connection from the database pool",
+    buckets=CHECKOUT_BUCKETS
+))
+RESULT_ROWS = metrics_registry.register(Histogram(
+    "querycraft_result_rows", "Rows returned per answered question", buckets=(0, 1, 10, 100, 1000, 10000, 100000)
+))
@@ -1,4 +1,4 @@
-from typing import List, Any, Annotated
+from typing import List, Any, Annotated, Optional
 
 from pydantic import BaseModel
 from operator import add
@@ -8,6 +8,9 @@ class Result(BaseModel):
     columns: List[str]
     rows: List[List[Any]]
     total_rows: int
+    is_truncated: bool = False
+    estimated_total_rows: Optional[int] = None
+    cache_hit: bool = False
 
 
 class ValidationResult(BaseModel):
@@ -15,10 +18,37 @@ class ValidationResult(BaseModel):
     feedback: str = None
 
 
+class QueryPlan(BaseModel):
+    total_cost: Optional[float] = None
+    max_rows: Optional[int] = None
+    summary: str = ""
+
+
+class ColumnInfo(BaseModel):
+    name: str
+    type: str
+    nullable: bool = True
+    primary_key: bool = False
+    foreign_key: Optional[str] = None
+    enum_values: Optional[List[str]] = None
+    comment: Optional[str] = None
+
+
+class TableInfo(BaseModel):
+    name: str
+    columns: List[ColumnInfo]
+    comment: Optional[str] = None
+
+
 class State(BaseModel):
     question: str
+    selected_tables: List[str] = None
+    schema_tokens: int = None
+    schema_tokens_saved: int = None
+    cache_hit: str = None
     sql_query: str = None
-    validation_result: ValidationResult = None
+    validation_result: Optional[ValidationResult] = None
     result: Result = None
     error: str = None
     total_generations: Annotated[int, add] = 0
+    total_repairs: Annotated[int, add] = 0
@@ -1,29 +1,169 @@
-from typing import Tuple
+import asyncio
+import contextlib
+import copy
+import math
+from concurrent.futures import as_completed
+from typing import Any, AsyncIterator, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 
 from langchain_core.runnables import RunnableConfig
-from langfuse.langchain import CallbackHandler
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 
-from sql_agent.graph import create_graph
+from sql_agent.cancellation import CancellationToken
+from sql_agent.exceptions import QueryTimeout
+from sql_agent.graph import get_graph
+from sql_agent.llm_scheduler import LLMRequest, LLMScheduler
+from sql_agent.metrics import GENERATIONS, RESULT_ROWS
 from sql_agent.models import State
+from sql_agent.query_cache import CacheHit, QueryCache, cache_namespace, normalize_question
+from sql_agent.repositories.async_repository import AsyncDatabaseRepository
 from sql_agent.repositories.base import BaseDatabaseRepository
-from .repositories.factory import get_repository_for_url
+from sql_agent.repositories.schema_cache import SchemaCache
+from sql_agent.single_flight import AsyncSingleFlight, FlightTimeout, SingleFlight
+from sql_agent.tracing import Trace, Tracer
+from .repositories.factory import get_repository_for_url, get_async_repository_for_url
 
+# LangGraph stream modes of ``stream``: LLM tokens, node updates, events written by nodes and the final state
+STREAM_MODES = ["messages", "updates", "custom", "values"]
+
+
+class BatchAnswer(NamedTuple):
+    """Answer to one question of a batch: the answer state, or the exception answering the question failed with"""
+    question: str
+    answer: Optional[State] = None
+    error: Optional[Exception] = None
+
+
+def progress_events(mode: str, chunk) -> Iterator[Tuple[str, dict]]:
+    """Translate a LangGraph stream part into the progress events of ``stream``"""
+    if mode == "messages":
+        message, metadata = chunk
+        if metadata.get("langgraph_node") == "sql_generation" and message.content:
+            yield "token", {"text": message.content}
+    elif mode == "custom":
+        yield chunk["event"], {key: value for key, value in chunk.items() if key != "event"}
+    elif mode == "updates":
+        for node, update in chunk.items():
+            if not update:
+                continue
+            if node in ("sql_generation", "repair"):
+                yield node, {"sql_query": update["sql_query"]}
+            if update.get("validation_result") is not None:
+                yield "validation", update["validation_result"].model_dump()
+
+
+class BaseAgent:
+    """Configuration, query cache and request coalescing shared by the sync and async agents"""
+
+    single_flight_class = SingleFlight
 
-class SyncAgent:
     def __init__(
             self,
-            repository: BaseDatabaseRepository,
+            repository,
             db_table_names: Tuple[str, ...],
             max_generations: int = 3,
-            callback_handler=None,
-            max_rows: int = 1000
+            tracer: Tracer = None,
+            max_rows: int = 1000,
+            graph=None,
+            schema_top_k: int = 8,
+            schema_format: str = "ddl",
+            schema_token_budget: int = None,
+            query_cache: QueryCache = None,
+            statement_timeout: float = None,
+            validation_mode: str = "parse",
+            max_plan_cost: float = None,
+            max_plan_rows: int = None,
+            max_repairs: int = 2,
+            generation_candidates: int = 1,
+            coalesce_requests: bool = True,
+            coalesce_timeout: float = None,
+            llm_scheduler: LLMScheduler = None
     ):
-        self.callback_handler = callback_handler or CallbackHandler()
+        # Questions are traced only when a tracer is set and samples them
+        self.tracer = tracer
         self.repository = repository
-        self.graph = create_graph()
+        self.graph = graph or get_graph()
         self.db_table_names = db_table_names
         self.max_generations = max_generations
         self.max_rows = max_rows
+        self.schema_top_k = schema_top_k
+        self.schema_format = schema_format
+        self.schema_token_budget = schema_token_budget
+        self.query_cache = query_cache
+        self.statement_timeout = statement_timeout
+        self.validation_mode = validation_mode
+        self.max_plan_cost = max_plan_cost
+        self.max_plan_rows = max_plan_rows
+        self.max_repairs = max_repairs
+        self.generation_candidates = generation_candidates
+        # Concurrent identical questions share one answer; followers wait at most ``coalesce_timeout`` seconds for it
+        self.single_flight = self.single_flight_class() if coalesce_requests else None
+        self.coalesce_timeout = coalesce_timeout
+        self.llm_scheduler = llm_scheduler
+
+    def _initial_state(self, question, cache_hit) -> State:
+        # On a cache hit the graph starts at validation with the cached SQL instead of calling the LLM
+        if cache_hit:
+            return State(question=question, sql_query=cache_hit.sql_query, cache_hit=cache_hit.tier)
+        return State(question=question)
+
+    def _config(self, max_rows: int = None, cancel_token: CancellationToken = None,
+                llm_request: LLMRequest = None, callbacks: list = None) -> RunnableConfig:
+        return RunnableConfig(
+            callbacks=callbacks,
+            configurable={
+                "repository": self.repository,
+                "db_table_names": self.db_table_names,
+                "max_generations": self.max_generations,
+                "max_rows": self.max_rows if max_rows is None else max_rows,
+                "schema_top_k": self.schema_top_k,
+                "schema_format": self.schema_format,
+                "schema_token_budget": self.schema_token_budget,
+                "statement_timeout": self.statement_timeout,
+                "validation_mode": self.validation_mode,
+                "max_plan_cost": self.max_plan_cost,
+                "max_plan_rows": self.max_plan_rows,
+                "max_repairs": self.max_repairs,
+                "generation_candidates": self.generation_candidates,
+                "cancel_token": cancel_token,
+                "llm_scheduler": self.llm_scheduler,
+                "llm_request": llm_request
+            }
+        )
+
+    def _trace(self, question):
+        if self.tracer is None:
+            return contextlib.nullcontext(Trace(question, None))
+        return self.tracer.trace(question)
+
+    def _flight_key(self, question, max_rows):
+        # The agent already stands for one connection, table set and configuration
+        return normalize_question(question), max_rows
+
+    def _coalesce_timeout(self) -> QueryTimeout:
+        return QueryTimeout(
+            f"Timed out after {self.coalesce_timeout} seconds waiting for an identical question to be answered"
+        )
+
+    def _cache_entry(self, fingerprint, question) -> Tuple[str, str, Optional[CacheHit]]:
+        namespace = cache_namespace(self.repository.database_identity, self.db_table_names)
+        fingerprint = str(fingerprint)
+        return namespace, fingerprint, self.query_cache.get(namespace, fingerprint, question)
+
+    def _remember(self, namespace, fingerprint, question, cache_hit, answer):
+        # Remember SQL that answered the question unless it is already cached verbatim under this question
+        if self.query_cache and answer.get("result") is not None:
+            if not (cache_hit and cache_hit.tier == "exact" and cache_hit.sql_query == answer["sql_query"]):
+                self.query_cache.put(namespace, fingerprint, question, answer["sql_query"])
+
+    @staticmethod
+    def _record_metrics(answer):
+        GENERATIONS.observe(answer.get("total_generations", 0))
+        if answer.get("result") is not None:
+            RESULT_ROWS.observe(answer["result"].total_rows)
+
+
+class SyncAgent(BaseAgent):
+    repository: BaseDatabaseRepository
 
     @classmethod
     def with_connection_url(cls, db_connection_url: str, db_table_names: Tuple[str, ...], **kwargs):
@@ -32,19 +172,201 @@ class SyncAgent:
         repository = get_repository_for_url(db_connection_url)
         return cls(repository=repository, db_table_names=db_table_names, **kwargs)
 
-    def ask(self, question) -> State:
-        initial_state = State(
-            question=question
-        )
-        return self.graph.invoke(
-            input=initial_state,
-            config=RunnableConfig(
-                callbacks=[self.callback_handler],
-                configurable={
-                    "repository": self.repository,
-                    "db_table_names": self.db_table_names,
-                    "max_generations": self.max_generations,
-                    "max_rows": self.max_rows
-                }
+    def ask(self, question, max_rows: int = None, cancel_token: CancellationToken = None,
+            llm_request: LLMRequest = None) -> State:
+        """
+        Answer a question; concurrent identical questions are answered once and share the answer
+
+        ``llm_request`` tells the LLM scheduler who the question is asked for, with which priority and deadline;
+        a question that joins an identical one in flight is answered with the ``llm_request`` of that question.
+        Cancelling ``cancel_token`` stops waiting for the answer, which is cancelled, together with its running
+        statement, only when every question waiting for it is cancelled.
+        """
+        if self.single_flight is None:
+            return self._ask(question, max_rows, cancel_token, llm_request)
+        try:
+            return self.single_flight.do(
+                self._flight_key(question, max_rows),
+                lambda flight_token: self._ask(question, max_rows, flight_token, llm_request),
+                self.coalesce_timeout,
+                cancel_token
             )
-        )
+        except FlightTimeout as e:
+            raise self._coalesce_timeout() from e
+
+    def _lookup_cache(self, question) -> Tuple[Optional[str], Optional[str], Optional[CacheHit]]:
+        """Cache namespace and schema fingerprint of the question and its cached SQL, if any"""
+        if not self.query_cache:
+            return None, None, None
+        return self._cache_entry(self.repository.get_schema_fingerprint(self.db_table_names), question)
+
+    def _ask(self, question, max_rows: int = None, cancel_token: CancellationToken = None,
+             llm_request: LLMRequest = None) -> State:
+        namespace, fingerprint, cache_hit = self._lookup_cache(question)
+
+        with self._trace(question) as trace:
+            answer = trace.answer = self.graph.invoke(
+                input=self._initial_state(question, cache_hit),
+                config=self._config(max_rows, cancel_token, llm_request, trace.callbacks)
+            )
+
+        self._remember(namespace, fingerprint, question, cache_hit, answer)
+        self._record_metrics(answer)
+        return answer
+
+    def ask_many(self, questions: Sequence[str], max_rows: int = None, max_concurrency: int = 4,
+                 llm_request: LLMRequest = None) -> List[BatchAnswer]:
+        """Answer a batch of questions like ``iter_many``, returning the answers in the order of ``questions``"""
+        answers = [None] * len(questions)
+        for index, answer in self.iter_many(questions, max_rows, max_concurrency, llm_request):
+            answers[index] = answer
+        return answers
+
+    def iter_many(self, questions: Sequence[str], max_rows: int = None, max_concurrency: int = 4,
+                  llm_request: LLMRequest = None) -> Iterator[Tuple[int, BatchAnswer]]:
+        """
+        Answer a batch of questions, yielding ``(index, answer)`` pairs in the order the answers complete
+
+        The schema of the tables is loaded once and every question of the batch is answered against that snapshot.
+        Identical questions (after normalization) are answered once, at most ``max_concurrency`` questions are
+        answered at a time, and a question that fails does not stop the others: its answer carries the exception.
+        Questions not started yet are cancelled when the iteration is stopped.
+        """
+        batch_agent = copy.copy(self)
+        batch_agent.repository = self.repository.with_schema_cache(SchemaCache(ttl=math.inf))
+        table_names = tuple(self.db_table_names)
+        batch_agent.repository.get_schema_fingerprint(table_names)
+        batch_agent.repository.get_table_metadata(table_names)
+        batch_agent.repository.get_table_schema(table_names)
+
+        indexes = {}
+        for index, question in enumerate(questions):
+            indexes.setdefault(self._flight_key(question, max_rows), []).append(index)
+
+        executor = ContextThreadPoolExecutor(max_workers=max_concurrency)
+        futures = {
+            executor.submit(batch_agent.ask, questions[group[0]], max_rows, None, llm_request): group
+            for group in indexes.values()
+        }
+        try:
+            for future in as_completed(futures):
+                error = future.exception()
+                for index in futures[future]:
+                    yield index, BatchAnswer(questions[index], None if error else future.result(), error)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stream(self, question, max_rows: int = None, cancel_token: CancellationToken = None,
+               llm_request: LLMRequest = None) -> Iterator[Tuple[str, Any]]:
+        """
+        Answer a question like ``ask``, yielding ``(event, data)`` progress events while the graph runs
+
+        Events are ``token`` (generated SQL text), ``sql_generation`` and ``repair`` (a complete query),
+        ``validation``, ``execution`` (the query started running) and finally ``answer`` with the answer state.
+        """
+        namespace, fingerprint, cache_hit = self._lookup_cache(question)
+
+        answer = None
+        with self._trace(question) as trace:
+            for mode, chunk in self.graph.stream(
+                    input=self._initial_state(question, cache_hit),
+                    config=self._config(max_rows, cancel_token, llm_request, trace.callbacks),
+                    stream_mode=STREAM_MODES
+            ):
+                if mode == "values":
+                    answer = trace.answer = chunk
+                else:
+                    yield from progress_events(mode, chunk)
+
+        self._remember(namespace, fingerprint, question, cache_hit, answer)
+        self._record_metrics(answer)
+        yield "answer", answer
+
+
+class AsyncAgent(BaseAgent):
+    """
+    Agent answering questions on the event loop: LLM calls and database round trips are awaited, so a single
+    process keeps many questions in flight without a thread per question.
+    """
+
+    repository: AsyncDatabaseRepository
+    single_flight_class = AsyncSingleFlight
+
+    @classmethod
+    def with_connection_url(cls, db_connection_url: str, db_table_names: Tuple[str, ...], **kwargs):
+        """Factory method to create AsyncAgent with a connection URL."""
+
+        repository = get_async_repository_for_url(db_connection_url)
+        return cls(repository=repository, db_table_names=db_table_names, **kwargs)
+
+    async def ask(self, question, max_rows: int = None, cancel_token: CancellationToken = None,
+                  llm_request: LLMRequest = None) -> State:
+        """
+        Answer a question; concurrent identical questions are answered once and share the answer
+
+        The shared answer is cancelled, together with its running statement, only when every question waiting
+        for it is cancelled.
+        """
+        if self.single_flight is None:
+            return await self._ask(question, max_rows, cancel_token, llm_request)
+        try:
+            return await self.single_flight.do(
+                self._flight_key(question, max_rows),
+                lambda: self._ask(question, max_rows, cancel_token, llm_request),
+                self.coalesce_timeout
+            )
+        except FlightTimeout as e:
+            raise self._coalesce_timeout() from e
+
+    async def _lookup_cache(self, question) -> Tuple[Optional[str], Optional[str], Optional[CacheHit]]:
+        """Async variant of ``SyncAgent._lookup_cache``"""
+        if not self.query_cache:
+            return None, None, None
+        return self._cache_entry(await self.repository.get_schema_fingerprint(self.db_table_names), question)
+
+    async def _ask(self, question, max_rows: int = None, cancel_token: CancellationToken = None,
+                   llm_request: LLMRequest = None) -> State:
+        namespace, fingerprint, cache_hit = await self._lookup_cache(question)
+
+        cancel_token = cancel_token or CancellationToken()
+        try:
+            with self._trace(question) as trace:
+                answer = trace.answer = await self.graph.ainvoke(
+                    input=self._initial_state(question, cache_hit),
+                    config=self._config(max_rows, cancel_token, llm_request, trace.callbacks)
+                )
+        except asyncio.CancelledError:
+            # The request was aborted, e.g. the client disconnected: stop statements still running in driver threads
+            cancel_token.cancel()
+            raise
+
+        self._remember(namespace, fingerprint, question, cache_hit, answer)
+        self._record_metrics(answer)
+        return answer
+
+    async def stream(self, question, max_rows: int = None, cancel_token: CancellationToken = None,
+                     llm_request: LLMRequest = None) -> AsyncIterator[Tuple[str, Any]]:
+        """Async variant of ``SyncAgent.stream``"""
+        namespace, fingerprint, cache_hit = await self._lookup_cache(question)
+
+        cancel_token = cancel_token or CancellationToken()
+        answer = None
+        try:
+            with self._trace(question) as trace:
+                async for mode, chunk in self.graph.astream(
+                        input=self._initial_state(question, cache_hit),
+                        config=self._config(max_rows, cancel_token, llm_request, trace.callbacks),
+                        stream_mode=STREAM_MODES
+                ):
+                    if mode == "values":
+                        answer = trace.answer = chunk
+                    else:
+                        for event in progress_events(mode, chunk):
+                            yield event
+        except asyncio.CancelledError:
+            cancel_token.cancel()
+            raise
+
+        self._remember(namespace, fingerprint, question, cache_hit, answer)
+        self._record_metrics(answer)
+        yield "answer", answer
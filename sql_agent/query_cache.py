@@ -0,0 +1,249 @@
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Optional
+
+Vector = Dict[int, float]
+
+_WORD_PATTERN = re.compile(r"\w+")
+_LITERAL_PATTERN = re.compile(r"\d+(?:\.\d+)?|'[^']*'|\"[^\"]*\"")
+_NEGATIONS = frozenset({"no", "not", "never", "without", "except", "excluding", "none"})
+# Words choosing the order or the end of a ranking: "most" and "fewest" questions read alike but want opposite SQL
+_ORDERINGS = frozenset({
+    "asc", "ascending", "desc", "descending", "increasing", "decreasing",
+    "most", "least", "fewest", "more", "less", "fewer",
+    "top", "bottom", "first", "last",
+    "min", "minimum", "max", "maximum", "highest", "lowest", "largest", "smallest", "biggest",
+    "earliest", "latest", "oldest", "newest", "best", "worst", "cheapest",
+})
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question for exact matching: unicode form, case, whitespace and trailing punctuation"""
+    question = unicodedata.normalize("NFKC", question).casefold()
+    return " ".join(question.split()).rstrip("?.!; ")
+
+
+def literal_signature(question: str) -> tuple:
+    """
+    Return the numbers, quoted strings, negations and ordering words of a question
+
+    Rephrasings only share SQL when these agree, so "orders in 2023" never reuses the SQL of "orders in 2024",
+    nor "revenue descending" the SQL of "revenue ascending".
+    """
+    normalized = normalize_question(question)
+    words = set(_WORD_PATTERN.findall(normalized))
+    literals = sorted(_LITERAL_PATTERN.findall(normalized))
+    return tuple(literals), tuple(sorted(_NEGATIONS & words)), tuple(sorted(_ORDERINGS & words))
+
+
+class HashedNgramEmbedder:
+    """Embeds text as an L2-normalized sparse vector of hashed character n-grams of its words"""
+
+    def __init__(self, dimensions: int = 4096, n: int = 3):
+        self.dimensions = dimensions
+        self.n = n
+
+    def __call__(self, text: str) -> Vector:
+        vector: Dict[int, float] = {}
+        for word in _WORD_PATTERN.findall(normalize_question(text)):
+            padded = f" {word} "
+            for i in range(max(len(padded) - self.n + 1, 1)):
+                bucket = zlib.crc32(padded[i:i + self.n].encode()) % self.dimensions
+                vector[bucket] = vector.get(bucket, 0.0) + 1.0
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {bucket: weight / norm for bucket, weight in vector.items()}
+
+
+def cosine_similarity(a: Vector, b: Vector) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(bucket, 0.0) for bucket, weight in a.items())
+
+
+class CacheHit(NamedTuple):
+    sql_query: str
+    tier: str
+    similarity: float
+
+
+class _Entry(NamedTuple):
+    question: str
+    sql_query: str
+    vector: Vector
+    signature: tuple
+    created_at: float
+
+
+class QueryCache:
+    """
+    Two-tier cache mapping questions to previously successful SQL queries.
+
+    Entries are scoped by a namespace (database and tables) and the schema fingerprint of that namespace.
+    The exact tier matches normalized questions; the similarity tier, only enabled with a ``similarity_threshold``,
+    brute-forces cosine similarity over embedded questions of the same namespace whose literal signatures agree. Entries expire after ``ttl`` seconds, the least recently used
+    ones are evicted beyond ``max_entries``, and a new schema fingerprint drops every entry of the namespace.
+    When ``path`` is set, entries are written through to a SQLite file and reloaded on start-up.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 1024,
+            ttl: float = 7 * 24 * 3600,
+            similarity_threshold: Optional[float] = None,
+            path: str = None,
+            embedder: Callable[[str], Vector] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder or HashedNgramEmbedder()
+        self.hits = {"exact": 0, "similar": 0}
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._fingerprints: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._store = None
+        if path:
+            self._open_store(path)
+
+    @classmethod
+    def from_env(cls):
+        """Factory method to create the cache from environment variables; returns None when disabled"""
+        if not int(os.environ.get('QUERY_CACHE_ENABLED', 1)):
+            return None
+        return cls(
+            max_entries=int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', 1024)),
+            ttl=float(os.environ.get('QUERY_CACHE_TTL', 7 * 24 * 3600)),
+            similarity_threshold=float(os.environ.get('QUERY_CACHE_SIMILARITY', 0)) or None,
+            path=os.environ.get('QUERY_CACHE_PATH') or None,
+        )
+
+    def get(self, namespace: str, fingerprint: str, question: str) -> Optional[CacheHit]:
+        """Return the cached SQL for the question or a similar one, or None on a miss"""
+        normalized = normalize_question(question)
+        now = time.time()
+
+        with self._lock:
+            self._check_fingerprint(namespace, fingerprint)
+
+            entry = self._entries.get((namespace, normalized))
+            if entry is not None and now - entry.created_at < self.ttl:
+                self._entries.move_to_end((namespace, normalized))
+                self.hits["exact"] += 1
+                return CacheHit(entry.sql_query, "exact", 1.0)
+
+        if self.similarity_threshold is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        vector = self.embedder(question)
+        signature = literal_signature(question)
+        best_key, best_similarity = None, self.similarity_threshold
+
+        with self._lock:
+            for key, entry in self._entries.items():
+                if key[0] != namespace or entry.signature != signature or now - entry.created_at >= self.ttl:
+                    continue
+                similarity = cosine_similarity(vector, entry.vector)
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits["similar"] += 1
+            return CacheHit(self._entries[best_key].sql_query, "similar", best_similarity)
+
+    def put(self, namespace: str, fingerprint: str, question: str, sql_query: str):
+        """Cache the SQL query that successfully answered the question"""
+        normalized = normalize_question(question)
+        entry = _Entry(normalized, sql_query, self.embedder(question), literal_signature(question), time.time())
+
+        with self._lock:
+            self._check_fingerprint(namespace, fingerprint)
+            self._entries[(namespace, normalized)] = entry
+            self._entries.move_to_end((namespace, normalized))
+            self._persist(namespace, fingerprint, entry)
+
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            self._delete(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._fingerprints.clear()
+            if self._store is not None:
+                self._store.execute("DELETE FROM query_cache")
+                self._store.commit()
+
+    def _check_fingerprint(self, namespace: str, fingerprint: str):
+        # A different schema fingerprint means the schema changed; SQL cached for the old schema is dropped
+        if self._fingerprints.get(namespace) == fingerprint:
+            return
+        if namespace in self._fingerprints:
+            for key in [key for key in self._entries if key[0] == namespace]:
+                del self._entries[key]
+            if self._store is not None:
+                self._store.execute("DELETE FROM query_cache WHERE namespace = ?", (namespace,))
+                self._store.commit()
+        self._fingerprints[namespace] = fingerprint
+
+    def _open_store(self, path: str):
+        self._store = sqlite3.connect(path, check_same_thread=False)
+        self._store.execute("""
+            CREATE TABLE IF NOT EXISTS query_cache (
+                namespace TEXT NOT NULL,
+                question TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                sql_query TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (namespace, question)
+            )
+        """)
+        self._store.execute("DELETE FROM query_cache WHERE created_at < ?", (time.time() - self.ttl,))
+        self._store.commit()
+
+        rows = self._store.execute(
+            "SELECT namespace, question, fingerprint, sql_query, created_at FROM query_cache ORDER BY created_at"
+        ).fetchall()
+        for namespace, question, fingerprint, sql_query, created_at in rows[-self.max_entries:]:
+            # Entries persisted under an older fingerprint are dropped by _check_fingerprint on first access
+            if self._fingerprints.setdefault(namespace, fingerprint) != fingerprint:
+                continue
+            self._entries[(namespace, question)] = _Entry(
+                question, sql_query, self.embedder(question), literal_signature(question), created_at
+            )
+
+    def _persist(self, namespace: str, fingerprint: str, entry: _Entry):
+        if self._store is None:
+            return
+        self._store.execute(
+            "INSERT OR REPLACE INTO query_cache (namespace, question, fingerprint, sql_query, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (namespace, entry.question, fingerprint, entry.sql_query, entry.created_at)
+        )
+        self._store.commit()
+
+    def _delete(self, keys):
+        for key in keys:
+            self._entries.pop(key, None)
+        if self._store is not None and keys:
+            self._store.executemany("DELETE FROM query_cache WHERE namespace = ? AND question = ?", keys)
+            self._store.commit()
+
+
+def cache_namespace(database_identity, table_names) -> str:
+    """Namespace of cache entries for a database and a set of tables"""
+    return json.dumps([str(database_identity), sorted(table_names)])
@@ -0,0 +1,266 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import weakref
+from typing import Dict, Tuple
+
+from sql_agent.graph import get_graph
+from sql_agent.llm_scheduler import LLMScheduler
+from sql_agent.metrics import metrics_registry
+from sql_agent.orchestrator import BaseAgent, SyncAgent, AsyncAgent
+from sql_agent.query_cache import QueryCache
+from sql_agent.repositories.base import BaseDatabaseRepository
+from sql_agent.repositories.factory import get_repository_for_url, get_async_repository_for_url
+from sql_agent.repositories.result_cache import ResultCache
+from sql_agent.repositories.schema_cache import schema_cache
+from sql_agent.tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class AgentRegistry:
+    """
+    Thread-safe, process-wide registry of long-lived agents and repositories.
+
+    Repositories (and therefore pooled engines) are keyed by connection URL and shared
+    between agents; agents are keyed by connection URL, table names and agent options.
+    All agents share the single compiled graph returned by ``get_graph``, as well as the
+    query cache, result cache, LLM scheduler and tracer of the registry.
+    """
+
+    agent_class = SyncAgent
+    repository_factory = staticmethod(get_repository_for_url)
+
+    def __init__(
+            self,
+            pool_size: int = 5,
+            max_overflow: int = 10,
+            pool_pre_ping: bool = True,
+            pool_recycle: int = 1800,
+            pool_timeout: int = 30,
+            query_cache: QueryCache = None,
+            result_cache: ResultCache = None,
+            llm_scheduler: LLMScheduler = None,
+            tracer: Tracer = None
+    ):
+        self.engine_options = {
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "pool_pre_ping": pool_pre_ping,
+            "pool_recycle": pool_recycle,
+            "pool_timeout": pool_timeout,
+        }
+        self.query_cache = query_cache
+        self.result_cache = result_cache
+        self.llm_scheduler = llm_scheduler
+        self.tracer = tracer
+        self._repositories: Dict[str, BaseDatabaseRepository] = {}
+        self._agents: Dict[tuple, BaseAgent] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Factory method to create a registry configured from environment variables."""
+        return cls(
+            pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+            max_overflow=int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10)),
+            pool_pre_ping=bool(int(os.environ.get('DB_POOL_PRE_PING', 1))),
+            pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+            query_cache=QueryCache.from_env(),
+            result_cache=ResultCache.from_env(),
+            llm_scheduler=LLMScheduler.from_env(),
+            tracer=Tracer.from_env(),
+        )
+
+    def get_repository(self, db_connection_url: str) -> BaseDatabaseRepository:
+        """Return the shared repository for a connection URL, creating its engine on first use."""
+        with self._lock:
+            return self._get_repository(db_connection_url)
+
+    def get_agent(self, db_connection_url: str, db_table_names: Tuple[str, ...], **kwargs):
+        """Return the shared agent for a connection URL and table names, creating it on first use."""
+        key = (db_connection_url, tuple(db_table_names), tuple(sorted(kwargs.items())))
+        with self._lock:
+            agent = self._agents.get(key)
+            if agent is None:
+                agent = self.agent_class(
+                    repository=self._get_repository(db_connection_url),
+                    db_table_names=tuple(db_table_names),
+                    graph=get_graph(),
+                    query_cache=self.query_cache,
+                    llm_scheduler=self.llm_scheduler,
+                    tracer=self.tracer,
+                    **kwargs
+                )
+                self._agents[key] = agent
+            return agent
+
+    def shutdown(self):
+        """Drop all agents and dispose every pooled engine."""
+        with self._lock:
+            repositories = list(self._repositories.values())
+            self._repositories.clear()
+            self._agents.clear()
+
+        for repository in repositories:
+            try:
+                repository.dispose()
+            except Exception:
+                logger.exception("Failed to dispose repository engine")
+
+        if self.tracer is not None:
+            self.tracer.flush()
+
+    def collect_metrics(self):
+        """Metric families of the statistics kept by the caches, the LLM scheduler and the agents' single flights"""
+        hits = [({"cache": "schema"}, schema_cache.hits)]
+        misses = [({"cache": "schema"}, schema_cache.misses)]
+        if self.query_cache is not None:
+            hits += [({"cache": "question", "tier": tier}, count) for tier, count in self.query_cache.hits.items()]
+            misses.append(({"cache": "question"}, self.query_cache.misses))
+        if self.result_cache is not None:
+            stats = self.result_cache.stats()
+            hits.append(({"cache": "result"}, stats["hits"]))
+            misses.append(({"cache": "result"}, stats["misses"]))
+            yield "querycraft_result_cache_bytes", "gauge", "Estimated size of the cached results", [
+                ({}, stats["bytes"])
+            ]
+        yield "querycraft_cache_hits_total", "counter", "Lookups answered from a cache", hits
+        yield "querycraft_cache_misses_total", "counter", "Lookups a cache could not answer", misses
+
+        if self.llm_scheduler is not None:
+            stats = self.llm_scheduler.stats()
+            yield "querycraft_llm_calls_running", "gauge", "LLM calls holding a scheduler slot", [
+                ({}, stats["running"])
+            ]
+            yield "querycraft_llm_calls_waiting", "gauge", "LLM calls queued for a scheduler slot", [
+                ({}, stats["waiting"])
+            ]
+            yield "querycraft_llm_calls_total", "counter", "LLM calls by admission outcome", [
+                ({"outcome": outcome}, stats[outcome]) for outcome in ("admitted", "queued", "rejected")
+            ]
+            yield "querycraft_llm_queue_seconds_total", "counter", "Time admitted LLM calls spent queued", [
+                ({}, stats["queue_seconds_total"])
+            ]
+
+        if self.tracer is not None:
+            stats = self.tracer.stats()
+            yield "querycraft_traces_total", "counter", "Questions traced by sampling and records of unsampled " \
+                "failed or slow questions by outcome", [
+                    ({"outcome": outcome}, stats[outcome]) for outcome in ("sampled", "captured", "dropped", "exported")
+                ]
+
+        with self._lock:
+            flights = [agent.single_flight for agent in self._agents.values() if agent.single_flight is not None]
+        totals = {"executions": 0, "coalesced": 0, "timeouts": 0}
+        for flight in flights:
+            stats = flight.stats()
+            for outcome in totals:
+                totals[outcome] += stats[outcome]
+        yield "querycraft_questions_total", "counter", "Questions answered by running the agent or by joining an " \
+            "identical one in flight", [({"outcome": outcome}, count) for outcome, count in totals.items()]
+
+    def _get_repository(self, db_connection_url: str) -> BaseDatabaseRepository:
+        repository = self._repositories.get(db_connection_url)
+        if repository is None:
+            repository = self.repository_factory(
+                db_connection_url, result_cache=self.result_cache, **self.engine_options
+            )
+            self._repositories[db_connection_url] = repository
+        return repository
+
+
+class AsyncAgentRegistry(AgentRegistry):
+    """
+    Registry of ``AsyncAgent`` instances and async repositories for one event loop.
+
+    Async engines hand out connections bound to the event loop that opened them, so each running loop gets
+    its own registry (see ``get_async_agent_registry``), which disposes its engines when the loop stops; caches,
+    the LLM scheduler and the tracer are shared process-wide.
+    """
+
+    agent_class = AsyncAgent
+    repository_factory = staticmethod(get_async_repository_for_url)
+
+    async def ashutdown(self):
+        """Drop all agents and dispose every async engine."""
+        with self._lock:
+            repositories = list(self._repositories.values())
+            self._repositories.clear()
+            self._agents.clear()
+
+        for repository in repositories:
+            try:
+                await repository.dispose()
+            except Exception:
+                logger.exception("Failed to dispose repository engine")
+
+    async def ashutdown_with_loop(self):
+        """
+        Wait until the running event loop stops, then ``ashutdown``.
+
+        ``asyncio.run``, which also runs the short-lived loop of each async view served under WSGI, and uvicorn
+        cancel the pending tasks before closing their loop, so the engines are disposed while the loop still runs.
+        """
+        try:
+            await asyncio.get_running_loop().create_future()
+        except asyncio.CancelledError:
+            await self.ashutdown()
+            raise
+
+
+_registry = None
+_registry_lock = threading.Lock()
+_async_registries: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncAgentRegistry]" = \
+    weakref.WeakKeyDictionary()
+
+
+def get_agent_registry() -> AgentRegistry:
+    """Return the process-wide agent registry, configured from environment variables."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = AgentRegistry.from_env()
+    return _registry
+
+
+def get_async_agent_registry() -> AsyncAgentRegistry:
+    """Return the async agent registry of the running event loop, sharing the caches of the process registry."""
+    loop = asyncio.get_running_loop()
+    registry = _async_registries.get(loop)
+    if registry is None:
+        process_registry = get_agent_registry()
+        registry = AsyncAgentRegistry(
+            query_cache=process_registry.query_cache,
+            result_cache=process_registry.result_cache,
+            llm_scheduler=process_registry.llm_scheduler,
+            tracer=process_registry.tracer,
+            **process_registry.engine_options
+        )
+        _async_registries[loop] = registry
+        # Kept on the registry, the loop only holds a weak reference to its tasks
+        registry.shutdown_task = loop.create_task(registry.ashutdown_with_loop())
+    return registry
+
+
+def collect_registry_metrics():
+    """Metric families of the process-wide registry, once it exists"""
+    registry = _registry
+    return registry.collect_metrics() if registry is not None else []
+
+
+metrics_registry.register_collector(collect_registry_metrics)
+
+
+@atexit.register
+def shutdown_agent_registry():
+    """Dispose the process-wide registry; runs automatically at interpreter exit."""
+    global _registry
+    with _registry_lock:
+        registry, _registry = _registry, None
+    if registry is not None:
+        registry.shutdown()
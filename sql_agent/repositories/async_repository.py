@@ -0,0 +1,126 @@
+from typing import Hashable, List, Optional, Tuple
+
+from sqlalchemy import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.util import greenlet_spawn
+
+from sql_agent.cancellation import CancellationToken
+from sql_agent.models import Result, TableInfo, QueryPlan
+from .base import BaseDatabaseRepository
+from .exceptions import DatabaseError
+from .factory import get_repository_class
+from .result_cache import ResultCache
+
+# Async driver used for each database backend
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+class AsyncDatabaseRepository:
+    """
+    Async variant of a database repository, backed by SQLAlchemy's async engine (asyncpg / aiosqlite).
+
+    The dialect specific logic of the wrapped repository is reused as is: it runs on the event loop on top of
+    the async engine's ``sync_engine``, where every database round trip is awaited on the async driver instead
+    of blocking a thread. Schema, fingerprint and result caches are therefore shared with sync repositories.
+    """
+
+    def __init__(self, engine: AsyncEngine, repository: BaseDatabaseRepository):
+        self.engine = engine
+        self.repository = repository
+
+    @classmethod
+    def from_connection_url(cls, connection_url: str, result_cache: ResultCache = None, **engine_options):
+        """
+        Factory method to create an async repository from a (sync or async) connection URL
+
+        Args:
+            connection_url: SQLAlchemy database URL; the driver is replaced by the async driver of its backend
+            result_cache: Optional cache of query results
+            **engine_options: Extra keyword arguments passed to ``create_async_engine``
+        """
+        url = make_url(connection_url)
+        backend = url.get_backend_name()
+        if backend not in ASYNC_DRIVERS:
+            raise ValueError(f"No async driver available for '{backend}' databases")
+        url = url.set(drivername=ASYNC_DRIVERS[backend])
+
+        if backend == "sqlite" and url.database in (None, "", ":memory:"):
+            # In-memory databases use a StaticPool holding their single connection
+            for option in ("pool_size", "max_overflow", "pool_timeout"):
+                engine_options.pop(option, None)
+
+        engine = create_async_engine(url, **engine_options)
+        repository_class = get_repository_class(connection_url)
+        return cls(engine=engine, repository=repository_class(engine=engine.sync_engine, result_cache=result_cache))
+
+    @property
+    def database_identity(self) -> Hashable:
+        return self.repository.database_identity
+
+    @property
+    def sql_dialect(self) -> Optional[str]:
+        return self.repository.sql_dialect
+
+    @property
+    def result_cache(self) -> ResultCache:
+        return self.repository.result_cache
+
+    async def run_sync(self, func, *args, **kwargs):
+        """
+        Run repository code written against the sync API on the event loop
+
+        Database I/O performed by ``func`` through ``self.repository`` is awaited on the async driver.
+        """
+        try:
+            return await greenlet_spawn(func, *args, **kwargs)
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Database error: {str(e)}")
+
+    async def execute_query(self, query: str, max_rows: int = 1000, timeout: float = None,
+                            cancel_token: CancellationToken = None) -> Result:
+        """
+        Execute a query and return results
+
+        Cancelling the awaiting task cancels the running statement as well.
+        """
+        return await self.run_sync(self.repository.execute_query, query, max_rows, timeout, cancel_token)
+
+    async def explain_query(self, query: str, max_rows: int = None, timeout: float = None) -> QueryPlan:
+        """
+        Plan a query without executing it, inside a read-only transaction
+        """
+        return await self.run_sync(self.repository.explain_query, query, max_rows, timeout)
+
+    async def validate_query(self, query: str, table_names: Tuple[str, ...] = None):
+        """
+        Validate a query for safety, raising an exception if validation fails
+        """
+        await self.run_sync(self.repository.validate_query, query, table_names)
+
+    async def get_table_schema(self, table_names: Tuple[str, ...]) -> str:
+        """
+        Get DDL statements for specified tables
+        """
+        return await self.run_sync(self.repository.get_table_schema, table_names)
+
+    async def get_schema_fingerprint(self, table_names: Tuple[str, ...]) -> Hashable:
+        """
+        Get a value that changes whenever the schema of the specified tables changes
+        """
+        return await self.run_sync(self.repository.get_schema_fingerprint, table_names)
+
+    async def get_table_metadata(self, table_names: Tuple[str, ...]) -> List[TableInfo]:
+        """
+        Get structured column, key and comment information for specified tables
+        """
+        return await self.run_sync(self.repository.get_table_metadata, table_names)
+
+    async def dispose(self):
+        """
+        Close all pooled connections held by the async engine
+        """
+        await self.engine.dispose()
@@ -1,65 +1,346 @@
+import contextlib
+import copy
+import re
+import time
 from abc import ABC, abstractmethod
-from typing import List, Any, Tuple
-from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
-from sqlalchemy.exc import SQLAlchemyError, ProgrammingError, IntegrityError, DataError, OperationalError
+from typing import List, Any, Tuple, Hashable, Iterator, Optional
+from sqlalchemy import create_engine, text, MetaData, CheckConstraint, Enum
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError, ProgrammingError, IntegrityError, DataError, OperationalError
 
-from .exceptions import ValidationError, DatabaseError
+from sql_agent.cancellation import CancellationToken
+from sql_agent.metrics import DB_CHECKOUT_WAIT
+from sql_agent.models import TableInfo, ColumnInfo, Result, QueryPlan
+from .exceptions import (
+    RepositoryException, ValidationError, DatabaseError, QueryTimeoutError, QueryCancelledError
+)
+from .query_wrapping import limit_query
+from .sql_validation import schema_from_metadata, validate_read_only_query
+from .result_cache import ResultCache, normalize_sql, estimate_size
+from .schema_cache import SchemaCache, schema_cache as default_schema_cache
+
+# Matches CHECK constraints restricting a column to a list of literals, e.g. ``"status" IN ('a', 'b')``
+# or PostgreSQL's normalized ``status::text = ANY (ARRAY['a'::character varying, ...])``
+_CHECK_IN_PATTERN = re.compile(r'^[\s(]*"?(\w+)"?\)?(?:::\w+(?: \w+)?)?\s*(?:IN|=\s*ANY)\s*\(', re.IGNORECASE)
+_LITERAL_PATTERN = re.compile(r"'((?:[^']|'')*)'")
 
 
 class BaseDatabaseRepository(ABC):
-    def __init__(self, engine: Engine):
+    # sqlglot dialect used to parse generated queries
+    sql_dialect: Optional[str] = None
+
+    def __init__(self, engine: Engine, schema_cache: SchemaCache = None, result_cache: ResultCache = None):
         self.engine = engine
+        self.schema_cache = schema_cache or default_schema_cache
+        self.result_cache = result_cache
+
+    def with_schema_cache(self, schema_cache: SchemaCache) -> "BaseDatabaseRepository":
+        """
+        Copy of the repository sharing its engine and result cache, caching schema information in ``schema_cache``
+        """
+        repository = copy.copy(self)
+        repository.schema_cache = schema_cache
+        return repository
+
+    @property
+    def database_identity(self) -> Hashable:
+        """
+        Identity of the target database, shared by every repository pointing at it regardless of the driver
+        """
+        url = self.engine.url.set(drivername=self.engine.url.get_backend_name())
+        return url.render_as_string(hide_password=True)
 
     @classmethod
-    def from_connection_url(cls, connection_url: str):
+    def from_connection_url(cls, connection_url: str, result_cache: ResultCache = None, **engine_options):
         """
         Factory method to create repository from connection URL
+
+        Args:
+            connection_url: SQLAlchemy database URL
+            result_cache: Optional cache of query results
+            **engine_options: Extra keyword arguments passed to ``create_engine``
+                (e.g. ``pool_size``, ``max_overflow``, ``pool_pre_ping``, ``pool_recycle``)
+        """
+        engine = create_engine(connection_url, **engine_options)
+        return cls(engine=engine, result_cache=result_cache)
+
+    def dispose(self):
+        """
+        Close all pooled connections held by the repository engine
         """
-        engine = create_engine(connection_url)
-        return cls(engine=engine)
+        self.engine.dispose()
 
-    def execute_query(self, query: str, max_rows: int = 1000) -> Tuple[List[str], List[List[Any]]]:
+    def execute_query(
+            self,
+            query: str,
+            max_rows: int = 1000,
+            timeout: float = None,
+            cancel_token: CancellationToken = None
+    ) -> Result:
         """
         Execute a query and return results
+
+        With a result cache, results are reused until the tables read by the query change.
+
+        Args:
+            query: SQL query to execute
+            max_rows: Maximum number of rows returned
+            timeout: Statement timeout in seconds, or None for no limit
+            cancel_token: Token through which another thread can cancel the running statement
         """
         try:
-            with self.engine.connect() as conn:
-                from sqlalchemy import text
-                result = conn.execute(text(query))
-                columns = result.keys()
-                rows = result.fetchmany(max_rows)
-                return list(columns), [list(row) for row in rows]
-        except (ProgrammingError, IntegrityError, DataError, OperationalError) as e:
-            raise ValidationError(str(e))
+            with self._connect() as conn:
+                if self.result_cache is None:
+                    return self._execute(conn, query, max_rows, timeout, cancel_token)
+
+                # The change token is taken before executing, so a concurrent write can only cause a later miss
+                key = (self.database_identity, normalize_sql(query), max_rows)
+                change_token = self._table_change_token(conn, query)
+                cached = self.result_cache.get(key, change_token)
+                if cached is not None:
+                    return cached.model_copy(update={"cache_hit": True})
+
+                result = self._execute(conn, query, max_rows, timeout, cancel_token)
+                self.result_cache.put(key, change_token, result, estimate_size(result.rows))
+                return result
         except SQLAlchemyError as e:
-            raise DatabaseError(f"Database error: {str(e)}")
+            raise self._translate_error(e, timeout, cancel_token)
+
+    def _translate_error(self, error: SQLAlchemyError, timeout: float = None,
+                         cancel_token: CancellationToken = None) -> RepositoryException:
+        if isinstance(error, DBAPIError) and self._is_cancellation(error):
+            if cancel_token is not None and cancel_token.cancelled:
+                return QueryCancelledError("Query was cancelled")
+            return QueryTimeoutError(f"Query exceeded the statement timeout of {timeout} seconds")
+        if isinstance(error, (ProgrammingError, IntegrityError, DataError, OperationalError)):
+            return ValidationError(str(error))
+        return DatabaseError(f"Database error: {str(error)}")
+
+    def _execute(self, conn: Connection, query: str, max_rows: int, timeout: float = None,
+                 cancel_token: CancellationToken = None) -> Result:
+        # The database stops after max_rows + 1 rows, and may choose a fast-start plan; the extra row tells
+        # whether the result was truncated. As the result is bounded, it is fetched in a single round trip.
+        limited_query = limit_query(query, max_rows + 1)
+        with self._statement_guard(conn, timeout, cancel_token):
+            result = conn.execute(text(limited_query))
+            columns = list(result.keys())
+            rows = [list(row) for row in result.fetchmany(max_rows + 1)]
+
+        is_truncated = len(rows) > max_rows
+        return Result(
+            columns=columns,
+            rows=rows[:max_rows],
+            total_rows=min(len(rows), max_rows),
+            is_truncated=is_truncated,
+            estimated_total_rows=self._estimate_row_count(conn, query) if is_truncated else None,
+        )
+
+    def _estimate_row_count(self, conn: Connection, query: str) -> Optional[int]:
+        """
+        Return the planner's estimate of the number of rows produced by the unlimited query, if available
+        """
+        return None
+
+    @contextlib.contextmanager
+    def _statement_guard(self, conn: Connection, timeout: Optional[float], cancel_token: Optional[CancellationToken]):
+        """
+        Apply the statement timeout and the cancellation callback to the statements executed in the block
+        """
+        yield
+
+    def _is_cancellation(self, error: DBAPIError) -> bool:
+        """
+        Whether the error was raised because the statement timed out or was cancelled
+        """
+        return False
+
+    def stream_query(self, query: str, batch_size: int = 1000) -> Iterator[List]:
+        """
+        Execute a query and stream its complete result through a server-side cursor
+
+        The first item is the list of column names, followed by batches of rows. Batches grow from a single
+        row up to ``batch_size``, so the first row is available as soon as the database produces it while
+        memory stays bounded by ``batch_size`` rows regardless of the result size. The connection is held
+        until the generator is exhausted or closed.
+        """
+        try:
+            with self._connect() as conn:
+                result = conn.execute(
+                    text(query), execution_options={"stream_results": True, "max_row_buffer": batch_size}
+                )
+                yield list(result.keys())
+
+                size = 1
+                while batch := result.fetchmany(size):
+                    yield [list(row) for row in batch]
+                    size = min(size * 10, batch_size)
+        except SQLAlchemyError as e:
+            raise self._translate_error(e)
+
+    def explain_query(self, query: str, max_rows: int = None, timeout: float = None) -> QueryPlan:
+        """
+        Plan a query without executing it, inside a read-only transaction
+
+        Planner errors, e.g. syntax errors, unknown tables or columns and type mismatches, raise ValidationError.
+
+        Args:
+            query: SQL query to plan
+            max_rows: When given, the row limit ``execute_query`` pushes into the query is applied first,
+                so the plan is the one that would actually run
+            timeout: Statement timeout in seconds, or None for no limit
+        """
+        if max_rows is not None:
+            query = limit_query(query, max_rows + 1)
+        try:
+            with self._connect() as conn:
+                return self._explain(conn, query, timeout)
+        except SQLAlchemyError as e:
+            raise self._translate_error(e, timeout)
 
-    def validate_query(self, query: str):
+    def validate_query(self, query: str, table_names: Tuple[str, ...] = None):
         """
         Validate a query for safety, raising an exception if validation fails
+
+        The query is parsed in the dialect of the database and must be a single read-only statement.
+        When ``table_names`` are given, the tables and columns it references are resolved against the
+        cached metadata of those tables, without a database round trip while the schema cache is warm.
         """
-        if not query:
+        if not query or not query.strip():
             raise ValidationError("Empty SQL query")
 
-        sql_upper = query.upper()
-        if 'SELECT' not in sql_upper or 'FROM' not in sql_upper:
-            raise ValidationError("Generated query does not contain SELECT and FROM clauses")
+        schema = None
+        if table_names:
+            schema = schema_from_metadata(self.get_table_metadata(tuple(table_names)), self.sql_dialect)
+        validate_read_only_query(query, self.sql_dialect, schema)
 
-        dangerous_keywords = ['DROP', 'DELETE', 'UPDATE', 'INSERT', 'CREATE', 'ALTER', 'TRUNCATE', 'GRANT', 'REVOKE']
-        for keyword in dangerous_keywords:
-            if keyword in sql_upper:
-                raise ValidationError(f"Generated query contains potentially dangerous keyword: {keyword}")
-
-    @abstractmethod
     def get_table_schema(self, table_names: Tuple[str, ...]) -> str:
         """
         Get DDL statements for specified tables
-        
+
+        Results are served from the shared schema cache and only reloaded when the
+        schema fingerprint of the database changed.
+
         Args:
             table_names: Tuple of table names to get schema for
-            
+
         Returns:
             String containing DDL statements
         """
-        pass
\ No newline at end of file
+        table_names = tuple(table_names)
+        return self.schema_cache.get_or_load(
+            self.database_identity,
+            ("ddl", table_names),
+            fingerprint=lambda: self._with_connection(self._schema_fingerprint, table_names),
+            loader=lambda: self._with_connection(self._load_table_schema, table_names),
+        )
+
+    def get_schema_fingerprint(self, table_names: Tuple[str, ...]) -> Hashable:
+        """
+        Get a value that changes whenever the schema of the specified tables changes
+
+        Served from the schema cache, so it only reaches the database once the cache TTL expired.
+        """
+        table_names = tuple(table_names)
+        fingerprint = lambda: self._with_connection(self._schema_fingerprint, table_names)
+        return self.schema_cache.get_or_load(
+            self.database_identity, ("fingerprint", table_names), fingerprint=fingerprint, loader=fingerprint
+        )
+
+    def get_table_metadata(self, table_names: Tuple[str, ...]) -> List[TableInfo]:
+        """
+        Get structured column, key and comment information for specified tables
+
+        Results share the schema cache and its invalidation with ``get_table_schema``.
+
+        Args:
+            table_names: Tuple of table names to get metadata for
+
+        Returns:
+            List of table descriptions in the order of ``table_names``
+        """
+        table_names = tuple(table_names)
+        return self.schema_cache.get_or_load(
+            self.database_identity,
+            ("metadata", table_names),
+            fingerprint=lambda: self._with_connection(self._schema_fingerprint, table_names),
+            loader=lambda: self._with_connection(self._load_table_metadata, table_names),
+        )
+
+    def _load_table_metadata(self, conn: Connection, table_names: Tuple[str, ...]) -> List[TableInfo]:
+        metadata = MetaData()
+        metadata.reflect(bind=conn, only=list(table_names))
+
+        tables = []
+        for table_name in table_names:
+            table = metadata.tables[table_name]
+            enum_values = self._check_constraint_enums(table)
+            columns = [
+                ColumnInfo(
+                    name=column.name,
+                    type=str(column.type.compile(self.engine.dialect)),
+                    nullable=column.nullable,
+                    primary_key=column.primary_key,
+                    foreign_key=next((fk.target_fullname for fk in column.foreign_keys), None),
+                    enum_values=list(column.type.enums) if isinstance(column.type, Enum) else enum_values.get(column.name),
+                    comment=column.comment,
+                )
+                for column in table.columns
+            ]
+            tables.append(TableInfo(name=table.name, columns=columns, comment=table.comment))
+        return tables
+
+    @staticmethod
+    def _check_constraint_enums(table) -> dict:
+        enums = {}
+        for constraint in table.constraints:
+            if not isinstance(constraint, CheckConstraint):
+                continue
+            sqltext = str(constraint.sqltext)
+            match = _CHECK_IN_PATTERN.match(sqltext)
+            if match:
+                values = [value.replace("''", "'") for value in _LITERAL_PATTERN.findall(sqltext[match.end():])]
+                if values:
+                    enums[match.group(1)] = values
+        return enums
+
+    def _connect(self) -> Connection:
+        """Check a connection out of the engine's pool, recording how long that took"""
+        started = time.perf_counter()
+        conn = self.engine.connect()
+        DB_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+        return conn
+
+    def _with_connection(self, func, *args):
+        try:
+            with self._connect() as conn:
+                return func(conn, *args)
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Database error: {str(e)}")
+
+    @abstractmethod
+    def _schema_fingerprint(self, conn: Connection, table_names: Tuple[str, ...]) -> Hashable:
+        """
+        Return a cheap value that changes whenever DDL affecting the given tables is applied
+        """
+        pass
+
+    @abstractmethod
+    def _table_change_token(self, conn: Connection, query: str) -> Hashable:
+        """
+        Return a value that changes whenever data in the tables read by the query changes
+        """
+        pass
+
+    @abstractmethod
+    def _explain(self, conn: Connection, query: str, timeout: Optional[float]) -> QueryPlan:
+        """
+        Plan the query in a read-only transaction and summarize the plan
+        """
+        pass
+
+    @abstractmethod
+    def _load_table_schema(self, conn: Connection, table_names: Tuple[str, ...]) -> str:
+        """
+        Build DDL statements for specified tables by introspecting the database
+        """
+        pass
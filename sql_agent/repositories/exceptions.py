@@ -11,3 +11,13 @@ class ValidationError(RepositoryException):
 class DatabaseError(RepositoryException):
     """Exception raised when a database operation fails."""
     pass
+
+
+class QueryTimeoutError(RepositoryException):
+    """Exception raised when a query exceeds its statement timeout."""
+    pass
+
+
+class QueryCancelledError(RepositoryException):
+    """Exception raised when a running query is cancelled."""
+    pass
@@ -1,12 +1,20 @@
-def get_repository_for_url(connection_url: str):
-    """Factory function to get the appropriate repository based on the connection URL."""
-    if connection_url.startswith("postgresql"):
-        from sql_agent.repositories.postgres_repository import PostgreSQLRepository
-        return PostgreSQLRepository.from_connection_url(connection_url)
-    elif connection_url.startswith("sqlite"):
+def get_repository_class(connection_url: str):
+    """Return the repository class handling the database dialect of the connection URL."""
+    if connection_url.startswith("sqlite"):
         from sql_agent.repositories.sqlite_repository import SQLiteRepository
-        return SQLiteRepository.from_connection_url(connection_url)
+        return SQLiteRepository
     else:
-        # Default to a more generic repository or raise an exception
+        # PostgreSQL, and the default for any other URL
         from sql_agent.repositories.postgres_repository import PostgreSQLRepository
-        return PostgreSQLRepository.from_connection_url(connection_url)
\ No newline at end of file
+        return PostgreSQLRepository
+
+
+def get_repository_for_url(connection_url: str, **engine_options):
+    """Factory function to get the appropriate repository based on the connection URL."""
+    return get_repository_class(connection_url).from_connection_url(connection_url, **engine_options)
+
+
+def get_async_repository_for_url(connection_url: str, **engine_options):
+    """Factory function to get an async repository, backed by SQLAlchemy's async engine, for the connection URL."""
+    from sql_agent.repositories.async_repository import AsyncDatabaseRepository
+    return AsyncDatabaseRepository.from_connection_url(connection_url, **engine_options)
@@ -1,25 +1,137 @@
-import functools
-from typing import List, Any, Tuple
-from sqlalchemy import MetaData, text
+import contextlib
+import re
+from typing import Tuple, Hashable, Optional
+from sqlalchemy import MetaData, text, bindparam
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
 from sqlalchemy.sql.ddl import CreateTable
 
+from sql_agent.cancellation import CancellationToken
+from sql_agent.models import QueryPlan
 from sql_agent.repositories.base import BaseDatabaseRepository
 
+# Transaction ids of the catalog rows describing the tables change whenever DDL touches them
+# (ALTER/CREATE/DROP, constraint and comment changes), while statistics updates are applied in place.
+SCHEMA_FINGERPRINT_QUERY = text("""
+    SELECT md5(coalesce(string_agg(
+        c.oid::text || ':' || c.xmin::text
+        || '|' || coalesce((SELECT string_agg(a.attnum::text || ':' || a.xmin::text, ',' ORDER BY a.attnum)
+                            FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0), '')
+        || '|' || coalesce((SELECT string_agg(k.oid::text || ':' || k.xmin::text, ',' ORDER BY k.oid)
+                            FROM pg_constraint k WHERE k.conrelid = c.oid), '')
+        || '|' || coalesce((SELECT string_agg(d.objsubid::text || ':' || d.xmin::text, ',' ORDER BY d.objsubid)
+                            FROM pg_description d WHERE d.objoid = c.oid AND d.classoid = 'pg_class'::regclass), ''),
+        ',' ORDER BY c.oid), ''))
+    FROM pg_class c
+    WHERE c.relname = ANY(:table_names) AND pg_table_is_visible(c.oid)
+""").bindparams(bindparam("table_names"))
+
+# Per-table modification counters of every table named in the query, plus the current snapshot which changes
+# whenever a writing transaction starts or ends. Statistics are flushed by writing backends with a delay of up
+# to several seconds, so only the snapshot makes the token strict.
+TABLE_CHANGE_QUERY = text("""
+    SELECT pg_current_snapshot()::text,
+           coalesce(string_agg(
+               relid::text || ':' || n_tup_ins || ':' || n_tup_upd || ':' || n_tup_del
+               || ':' || pg_relation_filenode(relid), ',' ORDER BY relid), '')
+    FROM pg_stat_user_tables
+    WHERE relname = ANY(:names)
+""").bindparams(bindparam("names"))
+
+_IDENTIFIER_PATTERN = re.compile(r"\w+")
+
+# Maximum number of plan nodes included in plan summaries
+PLAN_SUMMARY_MAX_LINES = 40
+
+# SQLSTATE of statements aborted by statement_timeout or a cancel request
+QUERY_CANCELED = "57014"
+
 
 class PostgreSQLRepository(BaseDatabaseRepository):
-    @functools.lru_cache(maxsize=128)
-    def get_table_schema(self, table_names: Tuple[str, ...]) -> str:
+    sql_dialect = "postgres"
+
+    def _schema_fingerprint(self, conn: Connection, table_names: Tuple[str, ...]) -> Hashable:
+        return conn.execute(SCHEMA_FINGERPRINT_QUERY, {"table_names": list(table_names)}).scalar()
+
+    def _table_change_token(self, conn: Connection, query: str) -> Hashable:
+        # Every identifier in the query is a candidate table name; unknown names simply match nothing
+        identifiers = set(_IDENTIFIER_PATTERN.findall(query))
+        names = list(identifiers | {identifier.lower() for identifier in identifiers})
+        snapshot, counters = conn.execute(TABLE_CHANGE_QUERY, {"names": names}).one()
+        return (snapshot, counters) if self.result_cache.strict else counters
+
+    @contextlib.contextmanager
+    def _statement_guard(self, conn: Connection, timeout: Optional[float], cancel_token: Optional[CancellationToken]):
+        if timeout:
+            # Scoped to the current transaction, so the pooled connection keeps its default afterwards
+            conn.execute(text(f"SET LOCAL statement_timeout = {max(int(timeout * 1000), 1)}"))
+
+        # psycopg2 sends a protocol level cancel request, the equivalent of pg_cancel_backend() for this backend.
+        # Async drivers have no blocking cancel; asyncpg cancels the statement when the awaiting task is cancelled.
+        cancel = getattr(conn.connection.dbapi_connection, "cancel", None)
+        if cancel_token is None or cancel is None:
+            yield
+            return
+        with cancel_token.on_cancel(cancel):
+            yield
+
+    def _is_cancellation(self, error: DBAPIError) -> bool:
+        # query_canceled, raised for both statement timeouts and cancel requests
+        return QUERY_CANCELED in (getattr(error.orig, "pgcode", None), getattr(error.orig, "sqlstate", None))
+
+    def _explain(self, conn: Connection, query: str, timeout: Optional[float]) -> QueryPlan:
+        # EXPLAIN without ANALYZE never runs the query; the read-only transaction also rules out side effects
+        # of functions evaluated while planning
+        conn.execute(text("SET TRANSACTION READ ONLY"))
+        with self._statement_guard(conn, timeout, None):
+            plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query.strip().rstrip(';')}")).scalar()[0]["Plan"]
+
+        lines = []
+        self._summarize_plan(plan, 0, lines)
+        return QueryPlan(
+            total_cost=plan["Total Cost"],
+            max_rows=self._max_plan_rows(plan),
+            summary="\n".join(lines[:PLAN_SUMMARY_MAX_LINES]),
+        )
+
+    @classmethod
+    def _summarize_plan(cls, node: dict, depth: int, lines: list):
+        label = node["Node Type"]
+        if "Relation Name" in node:
+            label += f" on {node['Relation Name']}"
+        condition = node.get("Hash Cond") or node.get("Merge Cond") or node.get("Join Filter")
+        if condition:
+            label += f" [{condition}]"
+        lines.append(f"{'  ' * depth}{label} (cost={node['Total Cost']:.0f} rows={node['Plan Rows']})")
+        for child in node.get("Plans", []):
+            cls._summarize_plan(child, depth + 1, lines)
+
+    @classmethod
+    def _max_plan_rows(cls, node: dict) -> int:
+        return max([node["Plan Rows"]] + [cls._max_plan_rows(child) for child in node.get("Plans", [])])
+
+    def _estimate_row_count(self, conn: Connection, query: str) -> Optional[int]:
+        try:
+            # A savepoint keeps the transaction usable if the planner rejects the statement
+            with conn.begin_nested():
+                plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query.strip().rstrip(';')}")).scalar()
+        except SQLAlchemyError:
+            return None
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def _load_table_schema(self, conn: Connection, table_names: Tuple[str, ...]) -> str:
         """
-        Get DDL statements for specified tables using caching for performance
+        Get DDL statements for specified tables
         """
         metadata = MetaData()
-        ddl_statements = []
 
-        # Reflect each table individually
+        # Reflect all tables at once; SQLAlchemy batches columns, keys and indexes of every
+        # requested table into a constant number of catalog queries
+        metadata.reflect(bind=conn, only=list(table_names))
+
+        ddl_statements = []
         for table_name in table_names:
-            metadata.reflect(bind=self.engine, only=[table_name])
-            table = metadata.tables[table_name]
-            ddl = str(CreateTable(table).compile(self.engine))
+            ddl = str(CreateTable(metadata.tables[table_name]).compile(self.engine))
             ddl_statements.append(ddl.strip() + ";")
 
-        return "\n\n".join(ddl_statements)
\ No newline at end of file
+        return "\n\n".join(ddl_statements)
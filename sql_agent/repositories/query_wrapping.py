@@ -0,0 +1,24 @@
+import re
+
+# String literals, quoted identifiers and comments, which must not be mistaken for SQL keywords
+_LITERAL_OR_COMMENT = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/", re.DOTALL)
+_ROW_LIMITING_CLAUSE = re.compile(r"\b(?:LIMIT|OFFSET|FETCH)\b", re.IGNORECASE)
+
+
+def has_row_limit(query: str) -> bool:
+    """Whether the query already limits its rows with LIMIT, OFFSET or FETCH (at any nesting level)"""
+    return bool(_ROW_LIMITING_CLAUSE.search(_LITERAL_OR_COMMENT.sub(" ", query)))
+
+
+def limit_query(query: str, limit: int) -> str:
+    """
+    Push a row limit into a query so the database stops producing rows beyond ``limit``
+
+    The limit is appended to the statement, after its ORDER BY if any, on its own line so that a trailing
+    line comment cannot swallow it. Queries that already limit their rows are wrapped as a subquery instead,
+    which keeps their own limit and offset intact.
+    """
+    query = query.strip().rstrip(";").rstrip()
+    if has_row_limit(query):
+        return f"SELECT * FROM (\n{query}\n) AS limited_query\nLIMIT {int(limit)}"
+    return f"{query}\nLIMIT {int(limit)}"
@@ -0,0 +1,99 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, NamedTuple, Optional
+
+_QUOTED_OR_WHITESPACE = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+")
+
+
+def normalize_sql(query: str) -> str:
+    """Collapse whitespace outside quoted literals and identifiers and drop trailing semicolons"""
+    normalized = _QUOTED_OR_WHITESPACE.sub(lambda m: m.group(1) or " ", query)
+    return normalized.strip().rstrip(";").strip()
+
+
+def estimate_size(value: Any) -> int:
+    """Approximate the memory held by a query result in bytes"""
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class _Entry(NamedTuple):
+    value: Any
+    change_token: Hashable
+    size: int
+    created_at: float
+
+
+class ResultCache:
+    """
+    Opt-in, memory-bounded LRU cache of query results.
+
+    Entries are keyed by database identity, normalized SQL and ``max_rows``, and carry the change token
+    of the tables the query reads (see ``BaseDatabaseRepository._table_change_token``). A lookup only hits
+    when the current change token equals the stored one, so results are re-executed as soon as the
+    underlying tables change. ``max_age`` additionally bounds how long an entry is served.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_age: float = 3600, strict: bool = True):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.strict = strict
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Factory method to create the cache from environment variables; returns None when disabled"""
+        max_bytes = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 0))
+        if max_bytes <= 0:
+            return None
+        return cls(
+            max_bytes=max_bytes,
+            max_age=float(os.environ.get('RESULT_CACHE_MAX_AGE', 3600)),
+            strict=bool(int(os.environ.get('RESULT_CACHE_STRICT', 1))),
+        )
+
+    def get(self, key: Hashable, change_token: Hashable) -> Optional[Any]:
+        """Return the cached result for ``key`` if the tables did not change since it was stored"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.change_token != change_token or time.monotonic() - entry.created_at > self.max_age:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, key: Hashable, change_token: Hashable, value: Any, size: int):
+        """Store a result, evicting the least recently used entries beyond the memory budget"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self._entries[key] = _Entry(value, change_token, size, time.monotonic())
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def stats(self) -> dict:
+        """Hit/miss counters and memory usage of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.size,
+            }
@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, NamedTuple
+
+
+class _Entry(NamedTuple):
+    value: Any
+    fingerprint: Hashable
+    checked_at: float
+
+
+class SchemaCache:
+    """
+    Process-wide cache of schema information shared by all repository instances and threads.
+
+    Entries are keyed by database identity and a caller supplied key (e.g. the tuple of table names).
+    Within ``ttl`` seconds an entry is served without touching the database. Once the TTL expires the
+    repository computes a cheap schema fingerprint; the expensive loader only runs again when that
+    fingerprint changed, i.e. when DDL was actually applied to the database.
+    """
+
+    def __init__(self, ttl: float = 60.0, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(
+            self,
+            database_identity: Hashable,
+            key: Hashable,
+            fingerprint: Callable[[], Hashable],
+            loader: Callable[[], Any],
+    ) -> Any:
+        """
+        Return the cached value for ``key``, reloading it only when the schema fingerprint changed
+
+        Args:
+            database_identity: Identity of the database the key belongs to
+            key: Cache key within the database
+            fingerprint: Callable returning the current schema fingerprint
+            loader: Callable producing a fresh value on cache miss
+        """
+        cache_key = (database_identity, key)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and now - entry.checked_at < self.ttl:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry.value
+
+        # Fingerprint is taken before loading so that DDL racing with the load is detected on the next check
+        current_fingerprint = fingerprint()
+        if entry is not None and entry.fingerprint == current_fingerprint:
+            self._store(cache_key, entry._replace(checked_at=now), hit=True)
+            return entry.value
+
+        value = loader()
+        self._store(cache_key, _Entry(value, current_fingerprint, now), hit=False)
+        return value
+
+    def invalidate(self, database_identity: Hashable = None):
+        """Drop all entries, or only those belonging to one database"""
+        with self._lock:
+            if database_identity is None:
+                self._entries.clear()
+                return
+            for cache_key in [k for k in self._entries if k[0] == database_identity]:
+                del self._entries[cache_key]
+
+    def _store(self, cache_key, entry: _Entry, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._entries[cache_key] = entry
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+schema_cache = SchemaCache(
+    ttl=float(os.environ.get('SCHEMA_CACHE_TTL', 60)),
+    maxsize=int(os.environ.get('SCHEMA_CACHE_MAX_ENTRIES', 256)),
+)
@@ -0,0 +1,252 @@
+import functools
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.dialects.dialect import Dialect
+from sqlglot.errors import ParseError, SqlglotError
+from sqlglot.optimizer.scope import Scope, traverse_scope
+
+from sql_agent.models import TableInfo
+from .exceptions import ValidationError
+
+# Nodes that write data, change the schema or take locks, also when nested inside a read-only statement
+WRITE_NODES = (
+    exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop, exp.Alter, exp.TruncateTable,
+    exp.Grant, exp.Revoke, exp.Copy, exp.Command, exp.Into, exp.Lock,
+)
+
+# Nodes that open the scope a column belongs to
+SCOPE_NODES = (exp.Select, exp.SetOperation)
+
+# Columns every table has without declaring them
+PSEUDO_COLUMNS = {"rowid", "oid", "_rowid_", "ctid", "xmin", "xmax", "cmin", "cmax", "tableoid"}
+
+# Schemas that hold the tables addressed without a schema name
+DEFAULT_SCHEMAS = {"public", "main"}
+
+# Table names mapped to their column names and the values allowed in each column, if limited; names are normalized
+# with ``identifier_name``
+Schema = Dict[str, Dict[str, Optional[List[str]]]]
+
+_TOKEN_REPR = re.compile(r"<Token token_type: [^,]+, text: (.*?), line: .*?>")
+
+
+@functools.lru_cache(maxsize=512)
+def parse_statement(query: str, dialect: Optional[str] = None) -> exp.Expression:
+    """
+    Parse a query that must consist of exactly one statement
+
+    Parsed statements are cached, so re-validating the same SQL (e.g. on a query cache hit) skips the parser.
+    The returned tree is shared and must not be modified.
+    """
+    try:
+        statements = [statement for statement in sqlglot.parse(query, read=dialect) if statement is not None]
+    except ParseError as e:
+        raise ValidationError(f"Syntax error: {_describe_parse_error(e)}")
+    except SqlglotError as e:
+        raise ValidationError(f"Syntax error: {str(e)}")
+
+    if not statements:
+        raise ValidationError("Empty SQL query")
+    if len(statements) > 1:
+        raise ValidationError(f"Only a single SQL statement is allowed, the query contains {len(statements)}")
+    return statements[0]
+
+
+def identifier_name(identifier: exp.Identifier, dialect: Optional[str] = None) -> str:
+    """
+    Name an identifier resolves to in the dialect: unquoted identifiers are case insensitive, quoted ones keep their
+    case unless the dialect ignores it (e.g. SQLite). Without a dialect all names are lower-cased.
+    """
+    if dialect is None:
+        return identifier.name.lower()
+    return Dialect.get_or_raise(dialect).normalize_identifier(identifier.copy()).name
+
+
+def schema_from_metadata(tables: Iterable[TableInfo], dialect: Optional[str] = None) -> Schema:
+    """Index table metadata for validation: table and column names, as stored, mapped to allowed values"""
+    def name(stored: str) -> str:
+        return identifier_name(exp.to_identifier(stored, quoted=True), dialect)
+
+    return {
+        name(table.name): {name(column.name): column.enum_values for column in table.columns}
+        for table in tables
+    }
+
+
+def validate_read_only_query(query: str, dialect: Optional[str] = None, schema: Schema = None):
+    """
+    Check that a query is a single read-only statement and, optionally, that it only references known columns
+
+    Args:
+        query: SQL query to validate
+        dialect: sqlglot dialect used to parse the query, e.g. "postgres" or "sqlite"
+        schema: Tables and columns the query may reference, see ``schema_from_metadata``. When given, the
+            tables and columns referenced by the query are resolved against it, tables of other schemas (e.g.
+            ``pg_catalog``) are rejected, and string literals compared with enumerated columns must be one of
+            their values.
+
+    Raises:
+        ValidationError: With feedback describing the first problem found
+    """
+    statement = parse_statement(query, dialect)
+
+    if not isinstance(statement, exp.Query):
+        kind = statement.name if isinstance(statement, exp.Command) else statement.key
+        raise ValidationError(f"Only read-only SELECT queries are allowed, not {kind.upper()} statements")
+
+    write = statement.find(*WRITE_NODES)
+    if isinstance(write, exp.Into):
+        raise ValidationError("SELECT ... INTO creates a table and is not allowed, return the rows instead")
+    if isinstance(write, exp.Lock):
+        raise ValidationError("Row locking clauses such as FOR UPDATE are not allowed in read-only queries")
+    if write is not None:
+        raise ValidationError(f"The query contains a data modifying {write.key.upper()} statement, which is not allowed")
+
+    if schema is not None:
+        scopes = traverse_scope(statement)
+        for scope in scopes:
+            _resolve_tables(scope, schema, dialect)
+        for scope in scopes:
+            _resolve_columns(scope, schema, dialect)
+        for scope in scopes:
+            _check_enum_literals(scope, schema, dialect)
+
+
+def visible_sources(scope: Scope) -> Dict[str, Any]:
+    """Sources visible in a scope by lower-cased alias, including those of enclosing scopes"""
+    visible = {}
+    current = scope
+    while current is not None:
+        for alias, source in current.sources.items():
+            visible.setdefault(alias.lower(), source)
+        current = current.parent
+    return visible
+
+
+def own_columns(scope: Scope) -> Iterator[exp.Column]:
+    """Columns referenced by the scope itself, skipping stars"""
+    for column in scope.columns:
+        # Correlated columns of subqueries are also listed by the enclosing scope; they belong to the subquery
+        if not isinstance(column.this, exp.Star) and column.find_ancestor(*SCOPE_NODES) is scope.expression:
+            yield column
+
+
+def output_aliases(scope: Scope) -> Set[str]:
+    """Lower-cased output column aliases, which ORDER BY, GROUP BY and HAVING may refer to"""
+    if not isinstance(scope.expression, exp.Select):
+        return set()
+    return {projection.alias.lower() for projection in scope.expression.expressions if isinstance(projection, exp.Alias)}
+
+
+def is_foreign_table(source) -> bool:
+    """Whether a source is a table qualified with a schema (or catalog) other than the default one"""
+    return isinstance(source, exp.Table) and bool(
+        source.catalog or (source.db and source.db.lower() not in DEFAULT_SCHEMAS)
+    )
+
+
+def schema_table(source, dialect: Optional[str] = None) -> Optional[str]:
+    """Name of a source that is a plain table of the default schema, see ``identifier_name``, otherwise None"""
+    if not isinstance(source, exp.Table) or not isinstance(source.this, exp.Identifier) or is_foreign_table(source):
+        return None
+    return identifier_name(source.this, dialect)
+
+
+def column_table(
+        column: exp.Column, visible: Dict[str, Any], schema: Schema, dialect: Optional[str] = None
+) -> Optional[str]:
+    """Name of the schema table a column unambiguously belongs to, if any"""
+    name = identifier_name(column.this, dialect)
+    if column.table:
+        table = schema_table(visible.get(column.table.lower()), dialect)
+        return table if table in schema and name in schema[table] else None
+    tables = [
+        table for table in (schema_table(source, dialect) for source in visible.values())
+        if table in schema and name in schema[table]
+    ]
+    return tables[0] if len(set(tables)) == 1 else None
+
+
+def enum_comparisons(scope: Scope) -> Iterator[Tuple[exp.Column, exp.Literal]]:
+    """Pairs of column and string literal compared with each other by ``=``, ``<>`` or ``IN`` in the scope"""
+    for node in scope.expression.find_all(exp.EQ, exp.NEQ, exp.In):
+        if node.find_ancestor(*SCOPE_NODES) is not scope.expression:
+            continue
+        if isinstance(node, exp.In):
+            if isinstance(node.this, exp.Column):
+                for value in node.expressions:
+                    if isinstance(value, exp.Literal) and value.is_string:
+                        yield node.this, value
+            continue
+        for column, value in ((node.this, node.expression), (node.expression, node.this)):
+            if isinstance(column, exp.Column) and isinstance(value, exp.Literal) and value.is_string:
+                yield column, value
+
+
+def _resolve_tables(scope: Scope, schema: Schema, dialect: Optional[str]):
+    for source in scope.sources.values():
+        if is_foreign_table(source):
+            raise ValidationError(
+                f"Table '{source.sql(dialect=dialect)}' is outside the database schema, only its tables may be "
+                f"queried. Available tables: {', '.join(sorted(schema))}"
+            )
+        table = schema_table(source, dialect)
+        if table is not None and table not in schema:
+            raise ValidationError(
+                f"Table '{source.name}' does not exist. Available tables: {', '.join(sorted(schema))}"
+            )
+
+
+def _resolve_columns(scope: Scope, schema: Schema, dialect: Optional[str]):
+    visible = visible_sources(scope)
+    aliases = output_aliases(scope)
+
+    for column in own_columns(scope):
+        name = identifier_name(column.this, dialect)
+
+        if column.table:
+            source = visible.get(column.table.lower())
+            if source is None:
+                raise ValidationError(
+                    f"Unknown table or alias '{column.table}' in {column.sql(dialect=dialect)}. "
+                    f"Tables and aliases in scope: {', '.join(sorted(visible)) or 'none'}"
+                )
+            table = schema_table(source, dialect)
+            if table is not None and name not in schema[table] and name.lower() not in PSEUDO_COLUMNS:
+                raise ValidationError(
+                    f"Column '{column.name}' does not exist in table '{source.name}'. "
+                    f"Available columns: {', '.join(sorted(schema[table]))}"
+                )
+            continue
+
+        tables = [schema_table(source, dialect) for source in visible.values()]
+        # Columns of derived tables, CTEs and table functions are not known up front
+        if not tables or None in tables or name.lower() in aliases or name.lower() in PSEUDO_COLUMNS:
+            continue
+        if not any(name in schema[table] for table in tables):
+            hint = " String literals must use single quotes." if column.this.quoted else ""
+            available = "; ".join(f"{table}({', '.join(sorted(schema[table]))})" for table in dict.fromkeys(tables))
+            raise ValidationError(f"Column '{column.name}' does not exist.{hint} Available columns: {available}")
+
+
+def _check_enum_literals(scope: Scope, schema: Schema, dialect: Optional[str]):
+    visible = visible_sources(scope)
+    for column, value in enum_comparisons(scope):
+        table = column_table(column, visible, schema, dialect)
+        allowed = schema[table][identifier_name(column.this, dialect)] if table else None
+        if allowed and value.this not in allowed:
+            raise ValidationError(
+                f"'{value.this}' is not a possible value of {table}.{column.name}, so the comparison never "
+                f"matches. Possible values: {', '.join(allowed)}"
+            )
+
+
+def _describe_parse_error(error: ParseError) -> str:
+    if not error.errors:
+        return str(error)
+    details = error.errors[0]
+    description = _TOKEN_REPR.sub(r"'\1'", details["description"])
+    return f"{description} (line {details['line']}, column {details['col']})"
@@ -1,25 +1,125 @@
+import contextlib
 import functools
-from typing import List, Any, Tuple
-from sqlalchemy import text
+import itertools
+import time
+import weakref
+from typing import Tuple, Hashable, Optional
+from sqlalchemy import text, make_url, bindparam
+from sqlalchemy.engine import Connection, AdaptedConnection
+from sqlalchemy.exc import DBAPIError
 
+from sql_agent.cancellation import CancellationToken
+from sql_agent.models import QueryPlan
 from sql_agent.repositories.base import BaseDatabaseRepository
 
+# Number of SQLite virtual machine instructions between checks of the statement deadline
+PROGRESS_HANDLER_INSTRUCTIONS = 10000
+
+# Ids of the connections change tokens were taken on; unlike id(), never reused by a later connection
+_connection_ids = itertools.count()
+
 
 class SQLiteRepository(BaseDatabaseRepository):
-    @functools.lru_cache(maxsize=128)
-    def get_table_schema(self, table_names: Tuple[str, ...]) -> str:
+    sql_dialect = "sqlite"
+
+    @classmethod
+    def from_connection_url(cls, connection_url: str, **engine_options):
         """
-        Get DDL statements for specified tables using caching for performance
+        Factory method to create repository from connection URL
         """
-        ddl_statements = []
+        if make_url(connection_url).database in (None, "", ":memory:"):
+            # In-memory databases use a SingletonThreadPool, which has no overflow or checkout timeout
+            engine_options.pop("max_overflow", None)
+            engine_options.pop("pool_timeout", None)
+        return super().from_connection_url(connection_url, **engine_options)
+
+    @functools.cached_property
+    def database_identity(self) -> Hashable:
+        if self.engine.url.database in (None, "", ":memory:"):
+            # Every in-memory engine is its own database; forget its cache entries once the engine is gone
+            identity = f"{self.engine.url}#{id(self.engine)}"
+            weakref.finalize(self.engine, self.schema_cache.invalidate, identity)
+            return identity
+        return super().database_identity
+
+    def _schema_fingerprint(self, conn: Connection, table_names: Tuple[str, ...]) -> Hashable:
+        # Incremented by SQLite on every schema change of the database file
+        return conn.execute(text("PRAGMA schema_version")).scalar()
+
+    def _table_change_token(self, conn: Connection, query: str) -> Hashable:
+        # data_version changes with every commit of other connections and total_changes counts the changes made
+        # through this one, unlike file timestamps and sizes, which a write may leave as they were. Both are only
+        # comparable within one connection, so the token includes an id of the pooled connection.
+        connection_id = conn.connection.info.setdefault("change_token_id", next(_connection_ids))
+        data_version = conn.execute(text("PRAGMA data_version")).scalar()
+        total_changes = conn.execute(text("SELECT total_changes()")).scalar()
+        return connection_id, data_version, total_changes
+
+    @contextlib.contextmanager
+    def _statement_guard(self, conn: Connection, timeout: Optional[float], cancel_token: Optional[CancellationToken]):
+        if not timeout and cancel_token is None:
+            yield
+            return
+
+        deadline = time.monotonic() + timeout if timeout else None
+
+        def progress_handler():
+            # Called by SQLite every PROGRESS_HANDLER_INSTRUCTIONS; a true value aborts the statement
+            return (deadline is not None and time.monotonic() > deadline) or bool(cancel_token and cancel_token.cancelled)
 
-        with self.engine.connect() as conn:
-            for table_name in table_names:
-                result = conn.execute(text(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}';"))
-                row = result.fetchone()
-                if row and row[0]:
-                    ddl_statements.append(row[0].strip() + ";")
-                else:
-                    ddl_statements.append(f"-- Table {table_name} not found;")
+        dbapi_connection = conn.connection.dbapi_connection
+        if isinstance(dbapi_connection, AdaptedConnection):
+            # aiosqlite runs the sqlite3 connection in its own thread and exposes the handler as a coroutine
+            def set_progress_handler(handler, instructions):
+                dbapi_connection.run_async(lambda driver: driver.set_progress_handler(handler, instructions))
+        else:
+            set_progress_handler = dbapi_connection.set_progress_handler
+
+        set_progress_handler(progress_handler, PROGRESS_HANDLER_INSTRUCTIONS)
+        try:
+            yield
+        finally:
+            # After a cancellation the connection may already be closed, which also drops the handler
+            with contextlib.suppress(Exception):
+                set_progress_handler(None, 0)
+
+    def _explain(self, conn: Connection, query: str, timeout: Optional[float]) -> QueryPlan:
+        # query_only rejects any write for the rest of the block, including side effects while preparing
+        conn.execute(text("PRAGMA query_only = ON"))
+        try:
+            with self._statement_guard(conn, timeout, None):
+                rows = conn.execute(text(f"EXPLAIN QUERY PLAN {query.strip().rstrip(';')}")).all()
+        finally:
+            conn.execute(text("PRAGMA query_only = OFF"))
+
+        # SQLite reports the plan tree as (id, parent, unused, detail) rows without cost or row estimates
+        depths, lines = {0: -1}, []
+        for node_id, parent, _, detail in rows:
+            depths[node_id] = depths.get(parent, -1) + 1
+            lines.append(f"{'  ' * depths[node_id]}{detail}")
+        return QueryPlan(summary="\n".join(lines))
+
+    def _is_cancellation(self, error: DBAPIError) -> bool:
+        return "interrupted" in str(error.orig)
+
+    def _load_table_schema(self, conn: Connection, table_names: Tuple[str, ...]) -> str:
+        """
+        Get DDL statements for specified tables
+        """
+        # Fetch the DDL of all tables in a single round trip
+        result = conn.execute(
+            text("SELECT name, sql FROM sqlite_master WHERE type='table' AND name IN :table_names;")
+            .bindparams(bindparam("table_names", expanding=True)),
+            {"table_names": list(table_names)}
+        )
+        table_sql = {name: sql for name, sql in result}
+
+        ddl_statements = []
+        for table_name in table_names:
+            sql = table_sql.get(table_name)
+            if sql:
+                ddl_statements.append(sql.strip() + ";")
+            else:
+                ddl_statements.append(f"-- Table {table_name} not found;")
 
-        return "\n\n".join(ddl_statements)
\ No newline at end of file
+        return "\n\n".join(ddl_statements)
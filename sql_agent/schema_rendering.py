@@ -0,0 +1,191 @@
+import re
+from abc import ABC, abstractmethod
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sql_agent.models import TableInfo, ColumnInfo
+from sql_agent.repositories.base import BaseDatabaseRepository
+
+_TOKEN_PATTERN = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+
+_TYPE_ALIASES = {
+    "INTEGER": "int", "INT": "int", "BIGINT": "int", "SMALLINT": "int", "SERIAL": "int", "BIGSERIAL": "int",
+    "NUMERIC": "num", "DECIMAL": "num", "REAL": "num", "FLOAT": "num", "DOUBLE PRECISION": "num", "DOUBLE": "num",
+    "VARCHAR": "text", "CHAR": "text", "TEXT": "text", "CHARACTER VARYING": "text", "NVARCHAR": "text",
+    "BOOLEAN": "bool", "BOOL": "bool", "DATE": "date", "TIMESTAMP": "timestamp", "DATETIME": "timestamp",
+    "TIME": "time", "UUID": "uuid", "JSON": "json", "JSONB": "json",
+}
+
+# Maximum enum values shown once the renderer starts eliding details
+_ELIDED_ENUM_VALUES = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximate the number of LLM tokens in a text
+
+    Counts words, numbers and punctuation separately, which tracks BPE tokenizers closely
+    enough for budgeting schema prompts without loading the model tokenizer.
+    """
+    return len(_TOKEN_PATTERN.findall(text)) if text else 0
+
+
+class RenderedSchema(NamedTuple):
+    text: str
+    tokens: int
+    baseline_tokens: int
+
+    @property
+    def tokens_saved(self) -> int:
+        """Tokens saved compared to the full DDL of the same tables"""
+        return max(self.baseline_tokens - self.tokens, 0)
+
+
+class SchemaRenderer(ABC):
+    """Renders the schema of the selected tables into the text placed in the generation prompt."""
+
+    name: str
+
+    def render(
+            self,
+            repository: BaseDatabaseRepository,
+            table_names: Tuple[str, ...],
+            token_budget: Optional[int] = None
+    ) -> RenderedSchema:
+        """
+        Render the schema of the tables, eliding low-value details to stay within ``token_budget``
+
+        Args:
+            repository: Repository used to introspect the tables
+            table_names: Tables to render, most important first
+            token_budget: Hard upper bound on the estimated tokens of the result, or None for no limit
+
+        Raises:
+            ValueError: If even the first column of the first table does not fit in ``token_budget``
+        """
+        baseline_tokens = estimate_tokens(repository.get_table_schema(table_names))
+        text = self._render(repository, table_names, token_budget)
+        return RenderedSchema(text=text, tokens=estimate_tokens(text), baseline_tokens=baseline_tokens)
+
+    @abstractmethod
+    def _render(self, repository: BaseDatabaseRepository, table_names: Tuple[str, ...],
+                token_budget: Optional[int]) -> str:
+        pass
+
+
+class DDLSchemaRenderer(SchemaRenderer):
+    """
+    Renders ``CREATE TABLE`` statements as produced by the repository.
+
+    Over budget, trailing tables are dropped; if even the first table does not fit, the
+    compact rendering is used instead.
+    """
+
+    name = "ddl"
+
+    def _render(self, repository, table_names, token_budget):
+        ddl = repository.get_table_schema(table_names)
+        if token_budget is None or estimate_tokens(ddl) <= token_budget:
+            return ddl
+
+        statements = ddl.split("\n\n")
+        while len(statements) > 1:
+            statements.pop()
+            text = "\n\n".join(statements)
+            if estimate_tokens(text) <= token_budget:
+                return text
+        return CompactSchemaRenderer()._render(repository, table_names, token_budget)
+
+
+class CompactSchemaRenderer(SchemaRenderer):
+    """
+    Renders one line per table, e.g.
+    ``orders(id pk, customer_id→customers.id, order_date date, status enum[pending,shipped])``.
+
+    Over budget, details are elided in order of increasing value: comments, long enum lists,
+    column types, then trailing tables and finally trailing columns of the first table. A budget too small
+    for the first column of the first table is rejected.
+    """
+
+    name = "compact"
+
+    # Detail levels tried in order until the rendering fits the budget
+    LEVELS = (
+        {"comments": True, "enum_limit": None, "types": True},
+        {"comments": False, "enum_limit": None, "types": True},
+        {"comments": False, "enum_limit": _ELIDED_ENUM_VALUES, "types": True},
+        {"comments": False, "enum_limit": _ELIDED_ENUM_VALUES, "types": False},
+    )
+
+    def _render(self, repository, table_names, token_budget):
+        tables = repository.get_table_metadata(table_names)
+
+        for level in self.LEVELS:
+            text = self._render_tables(tables, **level)
+            if token_budget is None or estimate_tokens(text) <= token_budget:
+                return text
+
+        terse = self.LEVELS[-1]
+        while len(tables) > 1:
+            tables = tables[:-1]
+            text = self._render_tables(tables, **terse)
+            if estimate_tokens(text) <= token_budget:
+                return text
+
+        table = tables[0]
+        columns = list(table.columns)
+        while len(columns) > 1:
+            columns.pop()
+            text = self._render_tables([table.model_copy(update={"columns": columns})], **terse)
+            if estimate_tokens(text) <= token_budget:
+                return text
+        raise ValueError(
+            f"Schema token budget of {token_budget} is too small, rendering the smallest schema takes "
+            f"{estimate_tokens(text)} tokens"
+        )
+
+    def _render_tables(self, tables: List[TableInfo], comments: bool, enum_limit: Optional[int],
+                       types: bool) -> str:
+        lines = []
+        for table in tables:
+            columns = ", ".join(self._render_column(column, comments, enum_limit, types) for column in table.columns)
+            line = f"{table.name}({columns})"
+            if comments and table.comment:
+                line += f" -- {table.comment}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    @staticmethod
+    def _render_column(column: ColumnInfo, comments: bool, enum_limit: Optional[int], types: bool) -> str:
+        if column.primary_key:
+            text = f"{column.name} pk"
+        elif column.foreign_key:
+            text = f"{column.name}→{column.foreign_key}"
+        elif column.enum_values:
+            values = column.enum_values if enum_limit is None else column.enum_values[:enum_limit]
+            ellipsis = ",…" if len(values) < len(column.enum_values) else ""
+            text = f"{column.name} enum[{','.join(values)}{ellipsis}]"
+        elif types:
+            text = f"{column.name} {_short_type(column.type)}"
+        else:
+            text = column.name
+        if comments and column.comment:
+            text += f' "{column.comment}"'
+        return text
+
+
+def _short_type(type_name: str) -> str:
+    base = type_name.split("(", 1)[0].strip().upper()
+    return _TYPE_ALIASES.get(base, base.lower())
+
+
+SCHEMA_RENDERERS: Dict[str, SchemaRenderer] = {
+    renderer.name: renderer for renderer in (DDLSchemaRenderer(), CompactSchemaRenderer())
+}
+
+
+def get_schema_renderer(name: str) -> SchemaRenderer:
+    """Return the schema renderer registered under ``name``"""
+    try:
+        return SCHEMA_RENDERERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown schema format '{name}', expected one of: {', '.join(SCHEMA_RENDERERS)}")
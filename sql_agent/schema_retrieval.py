@@ -0,0 +1,120 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from sql_agent.models import TableInfo
+
+STOP_WORDS = frozenset({
+    "a", "all", "an", "and", "are", "as", "at", "be", "by", "each", "for", "from", "give", "how", "i", "id",
+    "in", "is", "it", "list", "me", "many", "much", "of", "on", "or", "per", "show", "than", "that", "the",
+    "their", "there", "to", "was", "were", "what", "which", "who", "with",
+})
+
+_WORD_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+# Identifier names are weighted above column names, which are weighted above free-text comments
+TABLE_NAME_WEIGHT = 3
+COLUMN_NAME_WEIGHT = 1
+
+
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    for suffix in ("ing", "ed", "es", "s"):
+        if len(word) - len(suffix) >= 3 and word.endswith(suffix) and not word.endswith("ss"):
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Split free text and snake/camel case identifiers into lower-cased, lightly stemmed terms"""
+    if not text:
+        return []
+    words = (word.lower() for word in _WORD_PATTERN.findall(text))
+    return [_stem(word) for word in words if word not in STOP_WORDS]
+
+
+class SchemaIndex:
+    """
+    Offline BM25 index over table names, column names and comments.
+
+    Tables are ranked by lexical relevance to a question, then boosted by the scores of tables
+    they are linked to through foreign keys so that join tables between relevant tables survive pruning.
+    """
+
+    def __init__(self, tables: List[TableInfo], k1: float = 1.5, b: float = 0.75, fk_boost: float = 0.5):
+        self.k1 = k1
+        self.b = b
+        self.fk_boost = fk_boost
+        self.table_names = [table.name for table in tables]
+        self.documents: Dict[str, Counter] = {table.name: Counter(self._document_terms(table)) for table in tables}
+        self.neighbors: Dict[str, set] = {table.name: set() for table in tables}
+
+        for table in tables:
+            for column in table.columns:
+                if not column.foreign_key:
+                    continue
+                target = column.foreign_key.rsplit(".", 1)[0]
+                if target in self.neighbors and target != table.name:
+                    self.neighbors[table.name].add(target)
+                    self.neighbors[target].add(table.name)
+
+        lengths = [sum(terms.values()) for terms in self.documents.values()]
+        self.average_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+        document_frequency = Counter(term for terms in self.documents.values() for term in terms)
+        total = len(self.documents)
+        self.idf = {
+            term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    @staticmethod
+    def _document_terms(table: TableInfo) -> List[str]:
+        terms = tokenize(table.name) * TABLE_NAME_WEIGHT + tokenize(table.comment)
+        for column in table.columns:
+            terms += tokenize(column.name) * COLUMN_NAME_WEIGHT + tokenize(column.comment)
+        return terms
+
+    def score(self, question: str) -> Dict[str, float]:
+        """Return the BM25 score of every table for the question"""
+        query_terms = set(tokenize(question))
+        scores = {}
+        for table_name, terms in self.documents.items():
+            length = sum(terms.values())
+            normalization = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1))
+            score = 0.0
+            for term in query_terms:
+                frequency = terms.get(term)
+                if not frequency:
+                    continue
+                score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + normalization)
+            scores[table_name] = score
+        return scores
+
+    def rank(self, question: str) -> List[Tuple[str, float]]:
+        """Return tables with a positive relevance, most relevant first, after foreign key expansion"""
+        scores = self.score(question)
+        expanded = {
+            table_name: score + self.fk_boost * max((scores[n] for n in self.neighbors[table_name]), default=0.0)
+            for table_name, score in scores.items()
+        }
+        ranked = sorted(expanded.items(), key=lambda item: item[1], reverse=True)
+        return [(table_name, score) for table_name, score in ranked if score > 0]
+
+    def select(self, question: str, top_k: int) -> List[str]:
+        """
+        Select at most ``top_k`` tables relevant to the question, keeping the original table order
+
+        Falls back to every table when nothing in the question matches the schema.
+        """
+        ranked = self.rank(question)[:top_k]
+        if not ranked:
+            return list(self.table_names)
+        selected = {table_name for table_name, _ in ranked}
+        return [table_name for table_name in self.table_names if table_name in selected]
+
+
+def select_tables(question: str, tables: List[TableInfo], top_k: int) -> List[str]:
+    """Select the ``top_k`` tables most relevant to the question"""
+    return SchemaIndex(tables).select(question, top_k)
@@ -0,0 +1,180 @@
+import asyncio
+import contextlib
+import functools
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+from sql_agent.cancellation import CancellationToken
+from sql_agent.exceptions import QueryCancelled
+
+T = TypeVar("T")
+
+
+class FlightTimeout(TimeoutError):
+    """Raised when a coalesced caller stops waiting for the call it joined"""
+    pass
+
+
+class _Call:
+    def __init__(self):
+        self.future: Future = Future()
+        self.cancel_token = CancellationToken()
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single execution whose result every caller shares.
+
+    The first caller of a key (the leader) runs the call in its own thread, with a ``CancellationToken`` of the
+    call; callers arriving while it runs (followers) wait for its result or exception until their own
+    ``cancel_token`` is cancelled or their own timeout passes. A cancelled leader stops waiting too but keeps running
+    the call for the followers; the call is cancelled once no caller waits for it anymore.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key: Hashable, func: Callable[[CancellationToken], T], timeout: float = None,
+           cancel_token: CancellationToken = None) -> T:
+        """
+        Return the result of ``func``, or of the in-flight call of ``key`` waiting at most ``timeout`` seconds
+
+        ``func`` is called with the token of the shared call. A follower raises ``QueryCancelled`` when its
+        ``cancel_token`` is cancelled before the result is ready.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+            call.waiters += 1
+
+        if leader:
+            return self._lead(key, call, func, cancel_token)
+        return self._follow(key, call, timeout, cancel_token)
+
+    def _lead(self, key: Hashable, call: _Call, func: Callable[[CancellationToken], T],
+              cancel_token: Optional[CancellationToken]) -> T:
+        leave = functools.partial(self._leave, key, call)
+        with cancel_token.on_cancel(leave) if cancel_token is not None else contextlib.nullcontext():
+            try:
+                result = func(call.cancel_token)
+            except BaseException as e:
+                self._forget(key, call)
+                call.future.set_exception(e)
+                raise
+            self._forget(key, call)
+            call.future.set_result(result)
+            return result
+
+    def _follow(self, key: Hashable, call: _Call, timeout: Optional[float],
+                cancel_token: Optional[CancellationToken]) -> T:
+        done = threading.Event()
+        call.future.add_done_callback(lambda _: done.set())
+        try:
+            with cancel_token.on_cancel(done.set) if cancel_token is not None else contextlib.nullcontext():
+                done.wait(timeout)
+            if call.future.done():
+                return call.future.result()
+            if cancel_token is not None and cancel_token.cancelled:
+                raise QueryCancelled("The request was cancelled while waiting for the answer to an identical one")
+            with self._lock:
+                self.timeouts += 1
+            raise FlightTimeout(f"Gave up waiting for the in-flight call after {timeout} seconds")
+        finally:
+            self._leave(key, call)
+
+    def _leave(self, key: Hashable, call: _Call):
+        with self._lock:
+            call.waiters -= 1
+            abandoned = not call.waiters and not call.future.done()
+            if abandoned and self._calls.get(key) is call:
+                # Later callers start a call of their own instead of joining the cancelled one
+                del self._calls[key]
+        if abandoned:
+            call.cancel_token.cancel()
+
+    def _forget(self, key: Hashable, call: _Call):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+
+    def stats(self) -> dict:
+        """Numbers of executed calls, of calls served by joining an in-flight one and of followers that timed out"""
+        with self._lock:
+            return {
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "in_flight": len(self._calls),
+            }
+
+
+class _AsyncCall:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    Async variant of ``SingleFlight`` for one event loop.
+
+    The shared call runs as a task of its own, so it keeps running for the remaining callers when the task of the
+    caller that started it is cancelled; it is cancelled once no caller waits for it anymore.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _AsyncCall] = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]], timeout: float = None) -> T:
+        """Return the result of ``func``, or of the in-flight call of ``key`` waiting at most ``timeout`` seconds"""
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(func()))
+            call.task.add_done_callback(lambda task: self._finish(key, call))
+            self.executions += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(call.task), None if leader else timeout)
+        except TimeoutError:
+            if call.task.done():
+                raise
+            self.timeouts += 1
+            raise FlightTimeout(f"Gave up waiting for the in-flight call after {timeout} seconds")
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+
+    def stats(self) -> dict:
+        """Numbers of executed calls, of calls served by joining an in-flight one and of followers that timed out"""
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "in_flight": len(self._calls),
+        }
+
+    def _finish(self, key: Hashable, call: _AsyncCall):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Retrieve the exception of calls nobody waited for until the end, so it is not reported as unhandled
+        if not call.task.cancelled():
+            call.task.exception()
@@ -3,9 +3,11 @@ from typing import TypedDict
 
 from langchain_core.messages import AIMessage
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import chain
+from langchain_core.runnables import chain, ConfigurableField
 from langchain_ollama import ChatOllama
 
+from sql_agent.metrics import LLM_TOKENS
+
 
 class Query(TypedDict):
     question: str
@@ -33,14 +35,28 @@ def sql_correction_prompt_template(inputs: Feedback):
     return prompt.invoke(inputs)
 
 
+# Closes the SQL in the prompt templates; inference stops as soon as the model emits it
+SQL_STOP_SEQUENCE = '</sql>'
+
+
 @chain
 def parse(ai_message: AIMessage) -> str:
-    return ai_message.content.split('</sql>')[0].strip()
+    # Ollama reports the token counts of each call in the usage metadata of its message
+    usage = ai_message.usage_metadata
+    if usage:
+        LLM_TOKENS.inc("prompt", amount=usage.get("input_tokens", 0))
+        LLM_TOKENS.inc("completion", amount=usage.get("output_tokens", 0))
+    return ai_message.content.split(SQL_STOP_SEQUENCE)[0].strip()
 
 
+# Sampling can be set per call, e.g. to generate diverse candidates: {"configurable": {"temperature": 0.8, "seed": 1}}
 model = ChatOllama(
     model=os.environ.get('OLLAMA_MODEL'),
-    base_url=os.environ.get('OLLAMA_BASE_URL')
+    base_url=os.environ.get('OLLAMA_BASE_URL'),
+    stop=[SQL_STOP_SEQUENCE]
+).configurable_fields(
+    temperature=ConfigurableField(id="temperature"),
+    seed=ConfigurableField(id="seed")
 )
 
 sql_generator = sql_generation_prompt_template | model | parse
@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import PrivateAttr
+
+from sql_agent import graph
+from .generator import parse, sql_correction_prompt_template, sql_generation_prompt_template
+
+# The question as the prompt templates quote it
+_PROMPT_QUESTION = re.compile(r"<question>(.*?)</question>", re.DOTALL)
+
+
+def prompt_key(messages: List[BaseMessage]) -> str:
+    """Fixture key of a prompt: a hash of its messages"""
+    text = "\n".join(f"{message.type}: {message.content}" for message in messages)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _result(content: str) -> ChatResult:
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+
+class RecordingChatModel(BaseChatModel):
+    """
+    Chat model forwarding calls to ``model`` and appending each response, with its latency, to a JSONL fixture
+    that ``ReplayChatModel`` replays offline.
+    """
+
+    model: Any
+    fixture_path: str
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        started = time.perf_counter()
+        message = self.model.invoke(messages, stop=stop, **kwargs)
+        self._record(messages, message.content, time.perf_counter() - started)
+        return _result(message.content)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        started = time.perf_counter()
+        message = await self.model.ainvoke(messages, stop=stop, **kwargs)
+        self._record(messages, message.content, time.perf_counter() - started)
+        return _result(message.content)
+
+    def _record(self, messages: List[BaseMessage], content: str, latency: float):
+        entry = {
+            "key": prompt_key(messages),
+            "prompt": "\n".join(str(message.content) for message in messages),
+            "content": content,
+            "latency": latency,
+        }
+        with self._lock, open(self.fixture_path, "a", encoding="utf-8") as fixture:
+            fixture.write(json.dumps(entry) + "\n")
+
+
+class ReplayChatModel(BaseChatModel):
+    """
+    Chat model answering prompts with the responses recorded by ``RecordingChatModel``, after their recorded latency
+    multiplied by ``latency_scale`` (0 measures QueryCraft's own overhead only).
+
+    Responses recorded several times for the same prompt are replayed round robin in recording order, so a replayed
+    run is deterministic. Prompts missing from the fixture raise a ``LookupError``: the fixture has to be recorded
+    again after changes to the prompts or to the schema they include.
+    """
+
+    fixture_path: str
+    latency_scale: float = 1.0
+    _responses: Optional[Dict[str, List[dict]]] = PrivateAttr(default=None)
+    _calls: Dict[str, int] = PrivateAttr(default_factory=lambda: defaultdict(int))
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        response = self._next_response(messages)
+        time.sleep(response["latency"] * self.latency_scale)
+        return _result(response["content"])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        response = self._next_response(messages)
+        await asyncio.sleep(response["latency"] * self.latency_scale)
+        return _result(response["content"])
+
+    def _next_response(self, messages: List[BaseMessage]) -> dict:
+        key = prompt_key(messages)
+        with self._lock:
+            if self._responses is None:
+                self._responses = defaultdict(list)
+                with open(self.fixture_path, encoding="utf-8") as fixture:
+                    for line in fixture:
+                        if line.strip():
+                            entry = json.loads(line)
+                            self._responses[entry["key"]].append(entry)
+            responses = self._responses.get(key)
+            if not responses:
+                raise LookupError(f"No response recorded for this prompt in {self.fixture_path}")
+            response = responses[self._calls[key] % len(responses)]
+            self._calls[key] += 1
+            return response
+
+
+class StubChatModel(BaseChatModel):
+    """
+    Chat model standing in for Ollama in load tests: answers after a log-normally distributed delay with mean
+    ``latency`` seconds and shape ``jitter``, with the SQL of ``answers`` for the question of the prompt, or
+    ``default_sql``.
+    """
+
+    latency: float = 1.0
+    jitter: float = 0.0
+    answers: Dict[str, str] = {}
+    default_sql: str = "SELECT COUNT(*) FROM orders"
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self._delay())
+        return _result(self._answer(messages))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self._delay())
+        return _result(self._answer(messages))
+
+    def _delay(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        if self.jitter <= 0:
+            return self.latency
+        return random.lognormvariate(math.log(self.latency) - self.jitter ** 2 / 2, self.jitter)
+
+    def _answer(self, messages: List[BaseMessage]) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+        question = _PROMPT_QUESTION.search(prompt)
+        return self.answers.get(question.group(1).strip() if question else None, self.default_sql)
+
+
+@contextlib.contextmanager
+def use_chat_model(model: BaseChatModel):
+    """Answer the LLM calls of the agent graph with ``model`` instead of the Ollama model within the block"""
+    previous = graph.sql_generator, graph.sql_corrector
+    graph.sql_generator = sql_generation_prompt_template | model | parse
+    graph.sql_corrector = sql_correction_prompt_template | model | parse
+    try:
+        yield
+    finally:
+        graph.sql_generator, graph.sql_corrector = previous
@@ -0,0 +1,330 @@
+import difflib
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError, SqlglotError
+from sqlglot.optimizer.scope import traverse_scope
+from sqlglot.tokens import Tokenizer
+
+from sql_agent.models import TableInfo
+from sql_agent.repositories.sql_validation import (
+    column_table, enum_comparisons, output_aliases, own_columns, schema_from_metadata, schema_table, visible_sources,
+    DEFAULT_SCHEMAS,
+)
+
+# sqlcoder writes PostgreSQL; queries other databases reject as invalid syntax are translated from it
+GENERATED_SQL_DIALECT = "postgres"
+
+# Minimum similarity for suggesting the only similar name in the schema for an unknown identifier
+CLOSE_MATCH_CUTOFF = 0.8
+
+# Database errors that translating the query to the dialect of the database may fix
+_DIALECT_ERROR = re.compile(r"syntax error|unrecognized token|no such function", re.IGNORECASE)
+_FENCE = re.compile(r"^\s*```\w*\s*$", re.MULTILINE)
+_SQL_TAG = re.compile(r"</?sql>", re.IGNORECASE)
+_STATEMENT_START = re.compile(r"^\s*(?:SELECT|WITH)\b", re.IGNORECASE | re.MULTILINE)
+_SENTENCE_START = re.compile(r"[A-Z][a-z]+\b")
+_UNQUOTED_IDENTIFIER = re.compile(r"[a-z_][a-z0-9_]*")
+_VALUE_SEPARATORS = re.compile(r"[\s_-]+")
+
+
+class Repair(NamedTuple):
+    sql_query: str
+    rules: List[str]
+    # Likely fixes that are guesses, e.g. a similarly named column, left for the corrector to decide on
+    hints: List[str]
+
+
+def repair_query(sql_query: str, feedback: str, dialect: Optional[str], tables: List[TableInfo]) -> Optional[Repair]:
+    """
+    Rewrite a query that failed validation or execution with deterministic rules, without calling the LLM
+
+    Text rules drop markdown, prose and extra statements around the query; the remaining rules rewrite the
+    parsed query against the schema of ``tables``. The result still has to pass validation and execution.
+    Rewrites are only made when they cannot change the meaning of the query; likely fixes that are guesses are
+    returned as hints for the corrector instead.
+
+    Args:
+        sql_query: Query that failed
+        feedback: Validation or database error message of the failure
+        dialect: sqlglot dialect of the database
+        tables: Metadata of the tables the query may use
+
+    Returns:
+        The rewritten query, the names of the rules that changed it and hints for the corrector, or None when no
+        rule applies
+    """
+    original = (sql_query or "").strip()
+    text = extract_sql(original)
+    rules = ["extract_sql"] if text != original else []
+    if not text:
+        return None
+
+    # Syntax the database rejects may be PostgreSQL syntax that sqlglot can translate
+    read = dialect
+    if dialect != GENERATED_SQL_DIALECT and _DIALECT_ERROR.search(feedback or ""):
+        read = GENERATED_SQL_DIALECT
+
+    statement, text, rule = _leading_statement(text, read)
+    if statement is None and read != dialect:
+        read = dialect
+        statement, text, rule = _leading_statement(text, read)
+    if rule:
+        rules.append(rule)
+    if not isinstance(statement, exp.Query):
+        return Repair(text, rules, []) if rules and text != original else None
+
+    rewritten = False
+    if read != dialect and not _same_tokens(statement.sql(dialect=dialect), text, dialect):
+        rules.append("dialect")
+        rewritten = True
+
+    hints = []
+    for name, apply_rule in REPAIR_RULES.items():
+        if apply_rule(statement, tables, hints):
+            rules.append(name)
+            rewritten = True
+
+    repaired = statement.sql(dialect=dialect) if rewritten else text
+    if not rules or _same_tokens(repaired, original, dialect):
+        return Repair(original, [], hints) if hints else None
+    return Repair(repaired, rules, hints)
+
+
+def extract_sql(text: str) -> str:
+    """Strip markdown fences, <sql> tags and prose preceding the statement from a model answer"""
+    text = _SQL_TAG.sub("", _FENCE.sub("", text))
+    start = _STATEMENT_START.search(text)
+    return (text[start.start():] if start else text).strip()
+
+
+def fix_identifiers(statement: exp.Expression, tables: List[TableInfo], hints: List[str]) -> bool:
+    """
+    Rename unknown tables and columns to the schema name differing only in case; the only similar name of other
+    unknown names is suggested in ``hints``, as it may not be the one the question is about
+    """
+    table_names = {table.name.lower(): table.name for table in tables}
+    column_names = {table.name.lower(): {column.name.lower(): column.name for column in table.columns}
+                    for table in tables}
+    changed = False
+
+    # Tables first, together with columns qualified by the name of a renamed table
+    renamed = {}
+    cte_names = {cte.alias.lower() for cte in statement.find_all(exp.CTE)}
+    for table in statement.find_all(exp.Table):
+        if (not isinstance(table.this, exp.Identifier) or table.name.lower() in cte_names
+                or (table.db and table.db.lower() not in DEFAULT_SCHEMAS)):
+            continue
+        actual = _match_name(table.this, table_names, "Table", hints)
+        if actual:
+            if not table.alias:
+                renamed[table.name.lower()] = actual
+            table.set("this", _identifier(actual))
+            changed = True
+    for column in statement.find_all(exp.Column):
+        if column.table.lower() in renamed:
+            column.set("table", _identifier(renamed[column.table.lower()]))
+
+    for scope in traverse_scope(statement):
+        visible = visible_sources(scope)
+        aliases = output_aliases(scope)
+        for column in own_columns(scope):
+            if column.table:
+                candidates = column_names.get(schema_table(visible.get(column.table.lower())), {})
+            elif column.name.lower() in aliases:
+                continue
+            else:
+                sources = [schema_table(source) for source in visible.values()]
+                # Columns of derived tables, CTEs and table functions are not known up front
+                if not sources or None in sources:
+                    continue
+                candidates = {name: actual for table in sources for name, actual in column_names.get(table, {}).items()}
+            actual = _match_name(column.this, candidates, "Column", hints)
+            if actual:
+                column.set("this", _identifier(actual))
+                changed = True
+    return changed
+
+
+def qualify_ambiguous_columns(statement: exp.Expression, tables: List[TableInfo], hints: List[str]) -> bool:
+    """
+    Qualify unqualified columns present in several joined tables when inner join conditions equate all of them, so
+    any of the tables gives the same values; the tables of other ambiguous columns are left to the corrector
+    """
+    schema = schema_from_metadata(tables)
+    changed = False
+    for scope in traverse_scope(statement):
+        joins = scope.expression.args.get("joins") or [] if isinstance(scope.expression, exp.Select) else []
+        using = {identifier.name.lower() for join in joins for identifier in join.args.get("using") or []}
+        aliases = output_aliases(scope) | using
+        sources = [(alias, schema_table(source)) for alias, source in scope.sources.items()]
+        equated = _equated_columns(joins)
+
+        for column in own_columns(scope):
+            name = column.name.lower()
+            if column.table or name in aliases:
+                continue
+            owners = [alias for alias, table in sources if table in schema and name in schema[table]]
+            if len(owners) < 2:
+                continue
+            if len({equated.get((owner.lower(), name), owner.lower()) for owner in owners}) == 1:
+                column.set("table", _identifier(owners[0]))
+                changed = True
+            else:
+                hints.append(
+                    f"Column '{column.name}' is ambiguous, qualify it with the table it should come from: "
+                    f"{', '.join(f'{owner}.{column.name}' for owner in owners)}"
+                )
+    return changed
+
+
+def fix_enum_literals(statement: exp.Expression, tables: List[TableInfo], hints: List[str]) -> bool:
+    """Replace string literals compared with an enumerated column by the value they differ from only in spelling"""
+    schema = schema_from_metadata(tables)
+    changed = False
+    for scope in traverse_scope(statement):
+        visible = visible_sources(scope)
+        for column, value in list(enum_comparisons(scope)):
+            table = column_table(column, visible, schema)
+            allowed = schema[table][column.name.lower()] if table else None
+            if not allowed or value.this in allowed:
+                continue
+            matches = [item for item in allowed if _normalize_value(item) == _normalize_value(value.this)]
+            if len(matches) == 1:
+                value.replace(exp.Literal.string(matches[0]))
+                changed = True
+    return changed
+
+
+# Rules rewriting the parsed query, applied in order; each returns whether it changed the query and may add hints
+REPAIR_RULES: Dict[str, Callable[[exp.Expression, List[TableInfo], List[str]], bool]] = {
+    "identifiers": fix_identifiers,
+    "ambiguous_columns": qualify_ambiguous_columns,
+    "enum_literals": fix_enum_literals,
+}
+
+
+def _equated_columns(joins: List[exp.Join]) -> Dict[Tuple[str, str], str]:
+    """
+    Columns equal to a column of the same name in another table by the conditions of inner joins, as
+    ``(lower-cased alias, column name)`` mapped to the alias representing all columns equal to each other
+    """
+    representatives: Dict[Tuple[str, str], str] = {}
+
+    def find(key: Tuple[str, str]) -> str:
+        while representatives.get(key, key[0]) != key[0]:
+            key = (representatives[key], key[1])
+        return key[0]
+
+    for join in joins:
+        # Outer joins pad one side with NULLs, where the columns are not equal
+        if join.side or join.kind not in ("", "INNER") or join.args.get("on") is None:
+            continue
+        on = join.args["on"]
+        for condition in on.flatten() if isinstance(on, exp.And) else [on]:
+            left, right = condition.this, condition.expression
+            if (isinstance(condition, exp.EQ) and isinstance(left, exp.Column) and isinstance(right, exp.Column)
+                    and left.table and right.table and left.name.lower() == right.name.lower()):
+                name = left.name.lower()
+                first, second = find((left.table.lower(), name)), find((right.table.lower(), name))
+                if first != second:
+                    representatives[(second, name)] = first
+
+    return {key: find(key) for key in representatives}
+
+
+def _leading_statement(text: str, dialect: Optional[str]) -> Tuple[Optional[exp.Expression], str, Optional[str]]:
+    """
+    Parse the first statement of ``text``
+
+    Returns the statement, its SQL and the name of the rule that dropped trailing prose or further statements.
+    """
+    rule = None
+    try:
+        statements = _parse(text, dialect)
+    except ParseError as e:
+        split = _split_point(text, e)
+        if split is None:
+            return None, text, None
+        position, rule = split
+        try:
+            statements = _parse(text[:position], dialect)
+        except SqlglotError:
+            return None, text, None
+        text = text[:position].strip().rstrip(";").rstrip()
+    except SqlglotError:
+        return None, text, None
+
+    if len(statements) > 1:
+        first = next((statement for statement in statements if isinstance(statement, exp.Query)), statements[0])
+        return first, first.sql(dialect=dialect), "first_statement"
+    return (statements[0] if statements else None), text, rule
+
+
+def _split_point(text: str, error: ParseError) -> Optional[Tuple[int, str]]:
+    """Where trailing prose, or a second statement without a separating semicolon, starts according to a parse error"""
+    if not error.errors or not error.errors[0].get("line") or not error.errors[0].get("highlight"):
+        return None
+    details = error.errors[0]
+    lines = text.split("\n")
+    line_start = sum(len(line) + 1 for line in lines[:details["line"] - 1])
+    token_start = line_start + details["col"] - len(details["highlight"])
+
+    # Prose on its own line may begin with words the parser accepted, e.g. as a table alias
+    for position in dict.fromkeys((line_start, token_start)):
+        remainder = text[position:]
+        if position and _STATEMENT_START.match(remainder):
+            return position, "first_statement"
+        word = _SENTENCE_START.match(remainder)
+        if position and word and word.group().upper() not in Tokenizer.KEYWORDS:
+            return position, "trailing_text"
+    return None
+
+
+def _parse(text: str, dialect: Optional[str]) -> List[exp.Expression]:
+    return [statement for statement in sqlglot.parse(text, read=dialect) if statement is not None]
+
+
+def _same_tokens(sql: str, other: str, dialect: Optional[str]) -> bool:
+    """Whether two queries only differ in layout, keyword case, optional AS keywords and trailing semicolons"""
+    return _tokens(sql, dialect) == _tokens(other, dialect)
+
+
+def _tokens(sql: str, dialect: Optional[str]) -> Optional[List[Tuple[str, str]]]:
+    try:
+        tokens = sqlglot.tokenize(sql, read=dialect)
+    except SqlglotError:
+        return None
+    # Keywords and unquoted identifiers are case insensitive, string literals and quoted identifiers are not
+    return [
+        (token.token_type.name, token.text if token.token_type.name in ("STRING", "IDENTIFIER") else token.text.upper())
+        for token in tokens if token.token_type.name not in ("ALIAS", "SEMICOLON")
+    ]
+
+
+def _match_name(identifier: exp.Identifier, names: Dict[str, str], kind: str, hints: List[str]) -> Optional[str]:
+    """
+    Schema name an identifier should be replaced with, or None when it is fine or unknown; the only similar name of
+    an unknown ``kind`` of identifier is suggested in ``hints``
+    """
+    name = identifier.this
+    actual = names.get(name.lower())
+    if actual is None:
+        close = difflib.get_close_matches(name.lower(), names, n=2, cutoff=CLOSE_MATCH_CUTOFF)
+        if len(close) == 1:
+            hints.append(f"{kind} '{name}' does not exist, did you mean '{names[close[0]]}'?")
+        return None
+    # Case only matters for quoted identifiers and for names that must be quoted
+    if actual != name and (identifier.quoted or not _UNQUOTED_IDENTIFIER.fullmatch(actual)):
+        return actual
+    return None
+
+
+def _identifier(name: str) -> exp.Identifier:
+    return exp.to_identifier(name, quoted=not _UNQUOTED_IDENTIFIER.fullmatch(name))
+
+
+def _normalize_value(value: str) -> str:
+    return _VALUE_SEPARATORS.sub("", value.lower())
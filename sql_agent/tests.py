@@ -1,6 +1,6 @@
 import os
 import unittest
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
 from sqlalchemy import create_engine, text
 
@@ -235,3 +235,1135 @@ class TestSqlAgent(unittest.TestCase):
         except Exception as e:
             # The agent should fail after max generations of SQL with incorrect structure
             self.assertIn("could not answer the question", str(e).lower())
+
+    @patch('sql_agent.graph.sql_generator')
+    def test_schema_is_pruned_to_relevant_tables(self, mock_sql_generator):
+        mock_sql_generator.invoke.return_value = "SELECT * FROM customers"
+
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        repository = SQLiteRepository(engine=self.engine)
+
+        agent = SyncAgent(
+            repository=repository,
+            db_table_names=self.db_table_names,
+            schema_top_k=1
+        )
+
+        result = agent.ask("List the names of all customers")
+
+        # Only the customers table should be selected and passed to the generator
+        self.assertEqual(result['selected_tables'], ['customers'])
+        database_schema = mock_sql_generator.invoke.call_args.args[0]['database_schema']
+        self.assertIn("CREATE TABLE customers", database_schema)
+        self.assertNotIn("CREATE TABLE orders", database_schema)
+
+    @patch('sql_agent.graph.sql_generator')
+    def test_compact_schema_format_within_token_budget(self, mock_sql_generator):
+        mock_sql_generator.invoke.return_value = "SELECT * FROM orders"
+
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        repository = SQLiteRepository(engine=self.engine)
+
+        agent = SyncAgent(
+            repository=repository,
+            db_table_names=self.db_table_names,
+            schema_format="compact",
+            schema_token_budget=40
+        )
+
+        result = agent.ask("Show me all orders")
+
+        database_schema = mock_sql_generator.invoke.call_args.args[0]['database_schema']
+        self.assertIn("customer_id→customers.id", database_schema)
+        self.assertLessEqual(result['schema_tokens'], 40)
+        self.assertGreater(result['schema_tokens_saved'], 0)
+
+    def test_schema_token_budget_too_small_is_rejected(self):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        from sql_agent.schema_rendering import SCHEMA_RENDERERS
+        repository = SQLiteRepository(engine=self.engine)
+
+        # Even the first column of the first table, "orders(id pk)", takes more than 2 tokens
+        for renderer in SCHEMA_RENDERERS.values():
+            with self.subTest(renderer.name):
+                with self.assertRaisesRegex(ValueError, "budget of 2 is too small"):
+                    renderer.render(repository, self.db_table_names, token_budget=2)
+
+    @patch('sql_agent.graph.sql_generator')
+    def test_cached_question_skips_generation(self, mock_sql_generator):
+        mock_sql_generator.invoke.return_value = "SELECT * FROM orders"
+
+        from sql_agent.query_cache import QueryCache
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        repository = SQLiteRepository(engine=self.engine)
+
+        agent = SyncAgent(
+            repository=repository,
+            db_table_names=self.db_table_names,
+            query_cache=QueryCache(similarity_threshold=0.9)
+        )
+
+        first = agent.ask("Show me all orders")
+        exact = agent.ask("show me all orders?")
+        similar = agent.ask("Show me all the orders")
+
+        # Only the first question reaches the LLM; the others are served by the exact and similarity tiers
+        self.assertEqual(mock_sql_generator.invoke.call_count, 1)
+        self.assertIsNone(first.get('cache_hit'))
+        self.assertEqual(exact['cache_hit'], "exact")
+        self.assertEqual(similar['cache_hit'], "similar")
+        self.assertEqual(len(similar['result'].rows), 3)
+
+    @patch('sql_agent.graph.sql_generator')
+    @patch('sql_agent.graph.sql_corrector')
+    def test_statement_timeout_is_not_sent_for_correction(self, mock_sql_corrector, mock_sql_generator):
+        from sql_agent.exceptions import QueryTimeout
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+
+        # An unbounded recursive query that only the statement timeout can stop
+        mock_sql_generator.invoke.return_value = (
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c"
+        )
+        agent = SyncAgent(
+            repository=SQLiteRepository(engine=self.engine),
+            db_table_names=self.db_table_names,
+            statement_timeout=0.2
+        )
+
+        with self.assertRaises(QueryTimeout):
+            agent.ask("Count forever")
+        mock_sql_corrector.invoke.assert_not_called()
+
+    def test_running_query_is_cancelled_by_token(self):
+        import threading
+        from sql_agent.cancellation import CancellationToken
+        from sql_agent.repositories.exceptions import QueryCancelledError
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        repository = SQLiteRepository(engine=self.engine)
+        cancel_token = CancellationToken()
+        threading.Timer(0.2, cancel_token.cancel).start()
+
+        with self.assertRaises(QueryCancelledError):
+            repository.execute_query(
+                "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c",
+                cancel_token=cancel_token
+            )
+
+        # The pooled connection remains usable
+        self.assertEqual(repository.execute_query("SELECT COUNT(*) FROM orders").rows, [[3]])
+
+    def test_llm_call_stops_when_cancelled(self):
+        from langchain_core.language_models import BaseChatModel
+        from langchain_core.messages import AIMessage
+        from langchain_core.outputs import ChatGeneration, ChatResult
+        from sql_agent.cancellation import CancellationToken
+        from sql_agent.exceptions import QueryCancelled
+        from sql_agent.graph import call_llm
+        cancel_token = CancellationToken()
+        generated = []
+
+        class StreamingModel(BaseChatModel):
+            # Reports each token while generating, like ChatOllama
+            @property
+            def _llm_type(self):
+                return "streaming"
+
+            def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+                for token in ["SELECT", " *", " FROM", " orders"]:
+                    generated.append(token)
+                    if len(generated) == 2:
+                        cancel_token.cancel()
+                    run_manager.on_llm_new_token(token)
+                return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(generated)))])
+
+        config = {"configurable": {"cancel_token": cancel_token}}
+        with self.assertRaises(QueryCancelled):
+            call_llm(config, StreamingModel().invoke, "Show me all orders")
+        self.assertEqual(generated, ["SELECT", " *"])
+
+        # A call of a cancelled request is not sent at all
+        with self.assertRaises(QueryCancelled):
+            call_llm(config, StreamingModel().invoke, "Show me all orders")
+        self.assertEqual(len(generated), 2)
+
+    @patch('sql_agent.graph.sql_generator')
+    @patch('sql_agent.graph.sql_corrector')
+    def test_explain_validation_sends_planner_errors_for_correction(self, mock_sql_corrector, mock_sql_generator):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        # Parses and resolves, but SQLite has no such function
+        mock_sql_generator.invoke.return_value = "SELECT stddev(quantity) FROM orders"
+        mock_sql_corrector.invoke.return_value = "SELECT avg(quantity) FROM orders"
+        repository = SQLiteRepository(engine=self.engine)
+        agent = SyncAgent(repository=repository, db_table_names=self.db_table_names, validation_mode="explain")
+
+        with patch.object(repository, 'execute_query', wraps=repository.execute_query) as execute_query:
+            result = agent.ask("How much do order quantities vary?")
+
+        self.assertIn("no such function: stddev", mock_sql_corrector.invoke.call_args[0][0]["feedback"])
+        # Only the corrected query reaches execution
+        execute_query.assert_called_once()
+        self.assertEqual(result['sql_query'], "SELECT avg(quantity) FROM orders")
+        self.assertEqual(len(result['result'].rows), 1)
+
+    @patch('sql_agent.graph.sql_generator')
+    @patch('sql_agent.graph.sql_corrector')
+    def test_expensive_plan_is_sent_for_correction(self, mock_sql_corrector, mock_sql_generator):
+        from sql_agent.models import QueryPlan
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        mock_sql_generator.invoke.return_value = "SELECT * FROM orders, products, customers"
+        mock_sql_corrector.invoke.return_value = "SELECT * FROM orders"
+        repository = SQLiteRepository(engine=self.engine)
+        agent = SyncAgent(
+            repository=repository,
+            db_table_names=self.db_table_names,
+            validation_mode="explain",
+            max_plan_rows=1000
+        )
+        plans = [
+            QueryPlan(total_cost=13.0, max_rows=8000000, summary="Nested Loop  (cost=0..13 rows=8000000)"),
+            QueryPlan(total_cost=1.0, max_rows=3, summary="Seq Scan on orders  (cost=0..1 rows=3)"),
+        ]
+
+        with patch.object(repository, 'explain_query', side_effect=plans):
+            result = agent.ask("Show me all orders")
+
+        feedback = mock_sql_corrector.invoke.call_args[0][0]["feedback"]
+        self.assertIn("8000000 rows", feedback)
+        self.assertIn("Nested Loop", feedback)
+        self.assertEqual(result['sql_query'], "SELECT * FROM orders")
+        self.assertEqual(len(result['result'].rows), 3)
+
+    @patch('sql_agent.graph.sql_generator')
+    @patch('sql_agent.graph.sql_corrector')
+    def test_failed_query_is_repaired_without_correction(self, mock_sql_corrector, mock_sql_generator):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        # Rejected by SQLite as ambiguous, both tables have an id column equated by the join
+        mock_sql_generator.invoke.return_value = \
+            "SELECT id, quantity FROM orders o JOIN products p ON p.id = o.id WHERE p.name = 'Laptop'"
+        agent = SyncAgent(repository=SQLiteRepository(engine=self.engine), db_table_names=self.db_table_names)
+
+        result = agent.ask("Which orders are for a laptop?")
+
+        mock_sql_corrector.invoke.assert_not_called()
+        self.assertIn("o.id", result['sql_query'])
+        self.assertEqual(result['total_generations'], 1)
+        self.assertEqual(result['total_repairs'], 1)
+
+    @patch('sql_agent.graph.sql_generator')
+    @patch('sql_agent.graph.sql_corrector')
+    def test_ambiguous_column_is_sent_for_correction(self, mock_sql_corrector, mock_sql_generator):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        # Either id could be meant, the join does not equate them
+        mock_sql_generator.invoke.return_value = \
+            "SELECT id, quantity FROM orders o JOIN products p ON p.id = o.product_id WHERE p.name = 'Laptop'"
+        mock_sql_corrector.invoke.return_value = \
+            "SELECT o.id, quantity FROM orders o JOIN products p ON p.id = o.product_id WHERE p.name = 'Laptop'"
+        agent = SyncAgent(repository=SQLiteRepository(engine=self.engine), db_table_names=self.db_table_names)
+
+        result = agent.ask("Which orders are for a laptop?")
+
+        feedback = mock_sql_corrector.invoke.call_args[0][0]["feedback"]
+        self.assertIn("Column 'id' is ambiguous", feedback)
+        self.assertIn("o.id, p.id", feedback)
+        self.assertEqual(result['result'].rows, [[1, 1], [3, 1]])
+        self.assertEqual(result['total_repairs'], 0)
+
+    @patch('sql_agent.graph.sql_generator')
+    @patch('sql_agent.graph.sql_corrector')
+    def test_first_valid_candidate_is_executed(self, mock_sql_corrector, mock_sql_generator):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        # The greedy candidate references an unknown column, the sampled ones are valid
+        mock_sql_generator.invoke.side_effect = lambda inputs, config: (
+            "SELECT total FROM orders" if config["configurable"]["temperature"] == 0 else "SELECT * FROM orders"
+        )
+        agent = SyncAgent(
+            repository=SQLiteRepository(engine=self.engine),
+            db_table_names=self.db_table_names,
+            generation_candidates=3
+        )
+
+        result = agent.ask("Show me all orders")
+
+        mock_sql_corrector.invoke.assert_not_called()
+        self.assertEqual(result['sql_query'], "SELECT * FROM orders")
+        self.assertEqual(len(result['result'].rows), 3)
+        self.assertEqual(result['total_generations'], 1)
+
+    def test_pending_candidates_are_stopped(self):
+        import threading
+        import time
+        from langchain_core.language_models import BaseChatModel
+        from langchain_core.messages import AIMessage
+        from langchain_core.output_parsers import StrOutputParser
+        from langchain_core.outputs import ChatGeneration, ChatResult
+        from langchain_core.runnables import RunnableLambda
+        from sql_agent.cancellation import CancellationToken
+        from sql_agent.exceptions import QueryCancelled
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        lock = threading.Lock()
+        calls = []
+        stopped = []
+
+        class StreamingModel(BaseChatModel):
+            # The first call answers at once, the others keep streaming tokens until they are stopped
+            @property
+            def _llm_type(self):
+                return "streaming"
+
+            def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+                with lock:
+                    calls.append(messages)
+                    first = len(calls) == 1
+                if not (first and answer_first):
+                    try:
+                        for _ in range(500):
+                            run_manager.on_llm_new_token("x")
+                            time.sleep(0.01)
+                    except QueryCancelled:
+                        stopped.append(messages)
+                        raise
+                message = AIMessage(content="SELECT * FROM orders")
+                return ChatResult(generations=[ChatGeneration(message=message)])
+
+        def wait_for_stopped(count):
+            # Calls stop at their next token, after the answer or the failure of the request
+            for _ in range(100):
+                if len(stopped) >= count:
+                    break
+                time.sleep(0.01)
+            return len(stopped)
+
+        generator = RunnableLambda(lambda inputs: inputs["question"]) | StreamingModel() | StrOutputParser()
+        agent = SyncAgent(
+            repository=SQLiteRepository(engine=self.engine),
+            db_table_names=self.db_table_names,
+            generation_candidates=2
+        )
+
+        # Once a candidate is valid, the LLM call of the other one stops
+        answer_first = True
+        with patch('sql_agent.graph.sql_generator', generator):
+            result = agent.ask("Show me all orders")
+        self.assertEqual(result['sql_query'], "SELECT * FROM orders")
+        self.assertEqual(wait_for_stopped(1), 1)
+
+        # A cancelled request stops the LLM calls of all its candidates
+        answer_first = False
+        calls.clear()
+        stopped.clear()
+        cancel_token = CancellationToken()
+        threading.Timer(0.1, cancel_token.cancel).start()
+        with patch('sql_agent.graph.sql_generator', generator):
+            with self.assertRaises(QueryCancelled):
+                agent.ask("Show me all orders", cancel_token=cancel_token)
+        self.assertEqual(wait_for_stopped(2), 2)
+
+
+class TestSqlValidation(unittest.TestCase):
+    schema = {
+        "orders": {"id": None, "customer_id": None, "quantity": None, "created_date": None, "updated_at": None,
+                   "status": ["pending", "shipped", "delivered"]},
+        "customers": {"id": None, "name": None, "deleted": None},
+    }
+
+    def validate(self, query):
+        from sql_agent.repositories.sql_validation import validate_read_only_query
+        validate_read_only_query(query, "postgres", self.schema)
+
+    def test_keywords_in_identifiers_and_literals_are_allowed(self):
+        self.validate("SELECT id, updated_at, created_date FROM orders WHERE status = 'delivered'")
+        self.validate("SELECT name FROM customers WHERE name LIKE '%DROP%' OR name = 'SELECT FROM'")
+        self.validate("SELECT name FROM customers c WHERE NOT deleted AND EXISTS "
+                      "(SELECT 1 FROM orders WHERE customer_id = c.id)")
+        self.validate("WITH t AS (SELECT customer_id, COUNT(*) AS n FROM orders GROUP BY customer_id) "
+                      "SELECT name, n FROM customers JOIN t ON t.customer_id = customers.id ORDER BY n DESC")
+
+    def test_only_a_single_read_only_statement_is_allowed(self):
+        from sql_agent.repositories.exceptions import ValidationError
+        for query in (
+                "SELECT * FROM orders; DROP TABLE orders",
+                "WITH gone AS (DELETE FROM orders RETURNING *) SELECT * FROM gone",
+                "SELECT * INTO archive FROM orders",
+                "VACUUM",
+        ):
+            with self.subTest(query=query), self.assertRaises(ValidationError):
+                self.validate(query)
+
+    def test_unknown_tables_and_columns_are_reported(self):
+        from sql_agent.repositories.exceptions import ValidationError
+        with self.assertRaisesRegex(ValidationError, "Column 'total' does not exist in table 'orders'"):
+            self.validate("SELECT o.total FROM orders o")
+        with self.assertRaisesRegex(ValidationError, "Column 'amount' does not exist"):
+            self.validate("SELECT name FROM customers c WHERE EXISTS (SELECT 1 FROM orders WHERE amount > 1)")
+        with self.assertRaisesRegex(ValidationError, "Table 'order_items' does not exist"):
+            self.validate("SELECT * FROM order_items")
+
+    def test_literals_outside_enumerated_values_are_reported(self):
+        from sql_agent.repositories.exceptions import ValidationError
+        self.validate("SELECT COUNT(*) FROM orders o WHERE o.status IN ('pending', 'shipped')")
+        with self.assertRaisesRegex(ValidationError, "'Shipped' is not a possible value of orders.status"):
+            self.validate("SELECT name FROM customers c JOIN orders o ON o.customer_id = c.id WHERE status = 'Shipped'")
+
+    def test_tables_of_other_schemas_are_rejected(self):
+        from sql_agent.repositories.exceptions import ValidationError
+        self.validate("SELECT id FROM public.orders")
+        for query in (
+                "SELECT * FROM pg_catalog.pg_shadow",
+                "SELECT table_name FROM information_schema.tables",
+                "SELECT o.id FROM orders o JOIN other.customers c ON c.id = o.customer_id",
+                "SELECT * FROM postgres.public.orders",
+        ):
+            with self.subTest(query=query), self.assertRaisesRegex(ValidationError, "outside the database schema"):
+                self.validate(query)
+
+    def test_quoted_identifiers_keep_their_case(self):
+        from sql_agent.repositories.exceptions import ValidationError
+        self.validate('SELECT "name" FROM "customers" WHERE Deleted')
+        with self.assertRaisesRegex(ValidationError, "Column 'Name' does not exist"):
+            self.validate('SELECT "Name" FROM customers')
+        with self.assertRaisesRegex(ValidationError, "Table 'Orders' does not exist"):
+            self.validate('SELECT id FROM "Orders"')
+
+
+class TestSqlRepair(unittest.TestCase):
+    def setUp(self):
+        from sql_agent.models import ColumnInfo, TableInfo
+        self.tables = [
+            TableInfo(name="customers", columns=[ColumnInfo(name="id", type="INT"), ColumnInfo(name="name", type="TEXT")]),
+            TableInfo(name="orders", columns=[
+                ColumnInfo(name="id", type="INT"),
+                ColumnInfo(name="customer_id", type="INT"),
+                ColumnInfo(name="quantity", type="INT"),
+                ColumnInfo(name="status", type="TEXT", enum_values=["pending", "shipped", "delivered"]),
+            ]),
+        ]
+
+    def repair(self, query, feedback="", dialect="sqlite"):
+        from sql_agent.sql_repair import repair_query
+        return repair_query(query, feedback, dialect, self.tables)
+
+    def test_queries_are_repaired_locally(self):
+        for query, feedback, expected, rule in (
+                ("```sql\nSELECT name FROM customers\n```", "Syntax error", "SELECT name FROM customers", "extract_sql"),
+                ("SELECT name FROM customers\nThis query returns all customer names.", "Syntax error",
+                 "SELECT name FROM customers", "trailing_text"),
+                ("SELECT name FROM customers; SELECT id FROM orders", "Only a single SQL statement is allowed",
+                 "SELECT name FROM customers", "first_statement"),
+                ("SELECT name FROM customers WHERE name ILIKE 'a%'", "near \"ILIKE\": syntax error",
+                 "SELECT name FROM customers WHERE LOWER(name) LIKE LOWER('a%')", "dialect"),
+                ('SELECT name FROM "Customers"', "no such table: Customers", "SELECT name FROM customers",
+                 "identifiers"),
+                ("SELECT id FROM orders o JOIN customers c ON c.id = o.id", "ambiguous column name: id",
+                 "SELECT o.id FROM orders AS o JOIN customers AS c ON c.id = o.id", "ambiguous_columns"),
+                ("SELECT COUNT(*) FROM orders WHERE status = 'Shipped'", "'Shipped' is not a possible value",
+                 "SELECT COUNT(*) FROM orders WHERE status = 'shipped'", "enum_literals"),
+        ):
+            with self.subTest(rule=rule):
+                repair = self.repair(query, feedback)
+                self.assertEqual(repair.sql_query, expected)
+                self.assertIn(rule, repair.rules)
+                self.assertEqual(repair.hints, [])
+
+    def test_guesses_are_returned_as_hints_without_rewriting(self):
+        for query, feedback, hint in (
+                ("SELECT name FROM customer", "no such table: customer",
+                 "Table 'customer' does not exist, did you mean 'customers'?"),
+                ("SELECT quantit FROM orders", "no such column: quantit",
+                 "Column 'quantit' does not exist, did you mean 'quantity'?"),
+                ("SELECT id FROM orders o JOIN customers c ON c.id = o.customer_id", "ambiguous column name: id",
+                 "Column 'id' is ambiguous, qualify it with the table it should come from: o.id, c.id"),
+                ("SELECT id FROM customers c LEFT JOIN orders o ON o.id = c.id", "ambiguous column name: id",
+                 "Column 'id' is ambiguous, qualify it with the table it should come from: c.id, o.id"),
+        ):
+            with self.subTest(query=query):
+                repair = self.repair(query, feedback)
+                self.assertEqual(repair.sql_query, query)
+                self.assertEqual(repair.rules, [])
+                self.assertEqual(repair.hints, [hint])
+
+    def test_queries_without_a_local_fix_are_left_to_the_corrector(self):
+        for query in ("SELECT total FROM orders", "DROP TABLE orders", "SELECT name FROM customers", ""):
+            with self.subTest(query=query):
+                self.assertIsNone(self.repair(query, "Column 'total' does not exist"))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        import threading
+        import time
+        from sql_agent.single_flight import FlightTimeout, SingleFlight
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls, results = [], []
+
+        def answer(cancel_token):
+            calls.append(1)
+            release.wait(5)
+            return "answer"
+
+        def ask(timeout=None):
+            try:
+                results.append(single_flight.do("question", answer, timeout))
+            except FlightTimeout:
+                results.append("timeout")
+
+        threads = [threading.Thread(target=ask)] + [threading.Thread(target=ask) for _ in range(3)]
+        threads.append(threading.Thread(target=ask, args=(0.01,)))
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        while single_flight.stats()["coalesced"] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # The follower with a short timeout gives up on its own, the others get the answer of the single call
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), ["answer"] * 4 + ["timeout"])
+        self.assertEqual(single_flight.stats(), {"executions": 1, "coalesced": 4, "timeouts": 1, "in_flight": 0})
+
+    def test_shared_call_outlives_cancelled_callers(self):
+        import threading
+        import time
+        from sql_agent.cancellation import CancellationToken
+        from sql_agent.exceptions import QueryCancelled
+        from sql_agent.single_flight import SingleFlight
+        single_flight = SingleFlight()
+        release = threading.Event()
+        flight_tokens, results = [], {}
+
+        def answer(cancel_token):
+            flight_tokens.append(cancel_token)
+            with cancel_token.on_cancel(release.set):
+                release.wait(5)
+            if cancel_token.cancelled:
+                raise QueryCancelled("cancelled")
+            return "answer"
+
+        def ask(name, cancel_token):
+            try:
+                results[name] = single_flight.do("question", answer, None, cancel_token)
+            except QueryCancelled:
+                results[name] = "cancelled"
+
+        def start(name, coalesced):
+            cancel_token = CancellationToken()
+            thread = threading.Thread(target=ask, args=(name, cancel_token))
+            thread.start()
+            while single_flight.stats()["coalesced"] < coalesced or not flight_tokens:
+                time.sleep(0.01)
+            return thread, cancel_token
+
+        # The clients of the leader and of a follower disconnect, the remaining follower still gets the answer
+        leader, leader_token = start("leader", 0)
+        follower, follower_token = start("follower", 1)
+        other_follower, _ = start("other follower", 2)
+        leader_token.cancel()
+        follower_token.cancel()
+        follower.join(5)
+        self.assertEqual(results, {"follower": "cancelled"})
+        self.assertFalse(flight_tokens[0].cancelled)
+        release.set()
+        leader.join(5)
+        other_follower.join(5)
+        self.assertEqual(results["other follower"], "answer")
+
+        # Once every caller stopped waiting, the shared call is cancelled
+        release.clear()
+        flight_tokens.clear()
+        caller, cancel_token = start("alone", 2)
+        cancel_token.cancel()
+        caller.join(5)
+        self.assertEqual(results["alone"], "cancelled")
+        self.assertTrue(flight_tokens[0].cancelled)
+        self.assertEqual(single_flight.stats()["in_flight"], 0)
+
+
+class TestLLMScheduler(unittest.TestCase):
+    def test_slots_go_by_priority_then_fair_share(self):
+        import asyncio
+        from sql_agent.llm_scheduler import LLMRequest, LLMScheduler
+        scheduler = LLMScheduler(max_concurrency=2)
+        order = []
+
+        async def call(name, request):
+            async with scheduler.aslot(request):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        async def scenario():
+            release = asyncio.Event()
+
+            async def hold():
+                async with scheduler.aslot(LLMRequest(client="a")):
+                    await release.wait()
+
+            holder = asyncio.create_task(hold())
+            async with scheduler.aslot(LLMRequest(client="a")):
+                tasks = [
+                    asyncio.create_task(call("batch", LLMRequest(client="c", priority="batch"))),
+                    asyncio.create_task(call("a1", LLMRequest(client="a"))),
+                    asyncio.create_task(call("a2", LLMRequest(client="a"))),
+                    asyncio.create_task(call("b1", LLMRequest(client="b"))),
+                ]
+                await asyncio.sleep(0.01)
+                self.assertEqual(scheduler.stats()["waiting"], 4)
+            await asyncio.gather(*tasks)
+            release.set()
+            await holder
+
+        asyncio.run(scenario())
+
+        # Client b has no running call while client a holds a slot, batch calls wait for interactive ones
+        self.assertEqual(order, ["b1", "a1", "a2", "batch"])
+        self.assertEqual(scheduler.stats()["running"], 0)
+
+    def test_calls_that_would_miss_their_deadline_are_rejected(self):
+        import time
+        from sql_agent.exceptions import Overloaded
+        from sql_agent.llm_scheduler import LLMRequest, LLMScheduler
+        scheduler = LLMScheduler(max_concurrency=1, max_queue=4, service_time=5)
+
+        with scheduler.slot():
+            with self.assertRaises(Overloaded) as rejection:
+                with scheduler.slot(LLMRequest(deadline=time.monotonic() + 1)):
+                    pass
+            self.assertEqual(rejection.exception.retry_after, 5)
+
+        self.assertEqual(scheduler.stats()["rejected"], 1)
+        with scheduler.slot(LLMRequest(deadline=time.monotonic() + 1)):
+            self.assertEqual(scheduler.stats()["running"], 1)
+
+
+class TestAgentRegistry(unittest.TestCase):
+    def setUp(self):
+        from sql_agent.registry import AgentRegistry
+        self.registry = AgentRegistry(pool_size=2, max_overflow=1)
+
+    def tearDown(self):
+        self.registry.shutdown()
+
+    def test_agent_is_reused_for_same_url_and_tables(self):
+        first = self.registry.get_agent("sqlite:///:memory:", ('orders', 'products'))
+        second = self.registry.get_agent("sqlite:///:memory:", ('orders', 'products'))
+        other_tables = self.registry.get_agent("sqlite:///:memory:", ('customers',))
+
+        # Same key returns the same agent; different tables share the repository and the compiled graph
+        self.assertIs(first, second)
+        self.assertIsNot(first, other_tables)
+        self.assertIs(first.repository, other_tables.repository)
+        self.assertIs(first.graph, other_tables.graph)
+
+    def test_shutdown_releases_agents(self):
+        agent = self.registry.get_agent("sqlite:///:memory:", ('orders',))
+        self.registry.shutdown()
+
+        # After shutdown a fresh agent and repository are built
+        self.assertIsNot(agent, self.registry.get_agent("sqlite:///:memory:", ('orders',)))
+
+    def test_async_engines_are_disposed_with_their_event_loop(self):
+        import asyncio
+        import tempfile
+        from sqlalchemy import event
+        from sql_agent.registry import get_async_agent_registry
+        opened, closed = [], []
+
+        async def ask():
+            agent = get_async_agent_registry().get_agent(f"sqlite:///{database}", ('customers',))
+            pool = agent.repository.engine.sync_engine.pool
+            event.listen(pool, "connect", lambda *args: opened.append(1))
+            event.listen(pool, "close", lambda *args: closed.append(1))
+            await agent.repository.execute_query("SELECT 1")
+            return agent
+
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "test.db")
+            # Each run has its own loop, like async views served under WSGI
+            first, second = asyncio.run(ask()), asyncio.run(ask())
+
+        self.assertIsNot(first.repository, second.repository)
+        self.assertEqual(len(opened), 2)
+        self.assertEqual(len(closed), 2)
+
+
+class TestSchemaCache(unittest.TestCase):
+    def setUp(self):
+        from sql_agent.repositories.schema_cache import SchemaCache
+        self.engine = create_engine("sqlite:///:memory:")
+        # A zero TTL forces a fingerprint check on every lookup
+        self.cache = SchemaCache(ttl=0)
+        with self.engine.connect() as conn:
+            conn.execute(text("CREATE TABLE customers (id INT PRIMARY KEY, name VARCHAR(255));"))
+            conn.commit()
+
+    def test_schema_is_shared_between_repository_instances(self):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        first = SQLiteRepository(engine=self.engine, schema_cache=self.cache)
+        second = SQLiteRepository(engine=self.engine, schema_cache=self.cache)
+
+        schema = first.get_table_schema(('customers',))
+
+        self.assertEqual(second.get_table_schema(('customers',)), schema)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_schema_change_invalidates_cache(self):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        repository = SQLiteRepository(engine=self.engine, schema_cache=self.cache)
+        repository.get_table_schema(('customers',))
+
+        with self.engine.connect() as conn:
+            conn.execute(text("ALTER TABLE customers ADD COLUMN email VARCHAR(255);"))
+            conn.commit()
+
+        self.assertIn("email", repository.get_table_schema(('customers',)))
+        self.assertEqual(self.cache.misses, 2)
+
+
+class TestQueryCache(unittest.TestCase):
+    def test_schema_change_invalidates_entries(self):
+        from sql_agent.query_cache import QueryCache
+        cache = QueryCache()
+        cache.put("db", "v1", "How many orders are there?", "SELECT COUNT(*) FROM orders")
+
+        self.assertIsNotNone(cache.get("db", "v1", "how many orders are there"))
+        self.assertIsNone(cache.get("db", "v2", "how many orders are there"))
+
+    def test_similar_questions_with_different_literals_do_not_match(self):
+        from sql_agent.query_cache import QueryCache
+        cache = QueryCache(similarity_threshold=0.9)
+        cache.put("db", "v1", "How many orders were placed in 2023?", "SELECT 1")
+
+        self.assertIsNone(cache.get("db", "v1", "How many orders were placed in 2024?"))
+
+    def test_similar_questions_with_opposite_orderings_do_not_match(self):
+        from sql_agent.query_cache import QueryCache
+        pairs = [
+            ("Show total revenue per product, descending", "Show total revenue per product, ascending"),
+            ("List orders by date in ascending order", "List orders by date in descending order"),
+            (
+                "Which customers placed the most orders in total across all stores?",
+                "Which customers placed the fewest orders in total across all stores?",
+            ),
+            (
+                "Show the top products by total sales amount per category",
+                "Show the bottom products by total sales amount per category",
+            ),
+            (
+                "Show the order date of the earliest order of each customer",
+                "Show the order date of the latest order of each customer",
+            ),
+            (
+                "Show the maximum unit price of the products of each category",
+                "Show the minimum unit price of the products of each category",
+            ),
+        ]
+        # Each pair is similar enough to be served by the similarity tier if only literals were compared
+        for cached, asked in pairs:
+            with self.subTest(asked=asked):
+                cache = QueryCache(similarity_threshold=0.9)
+                cache.put("db", "v1", cached, "SELECT 1")
+
+                self.assertIsNone(cache.get("db", "v1", asked))
+
+    def test_similarity_tier_is_disabled_by_default(self):
+        from sql_agent.query_cache import QueryCache
+        cache = QueryCache()
+        cache.put("db", "v1", "Show me all orders", "SELECT * FROM orders")
+
+        self.assertIsNone(cache.get("db", "v1", "Show me all the orders"))
+        self.assertEqual(cache.get("db", "v1", "show me all orders?").tier, "exact")
+
+    def test_entries_survive_restart(self):
+        import tempfile
+        from sql_agent.query_cache import QueryCache
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "query_cache.sqlite3")
+            QueryCache(path=path).put("db", "v1", "How many orders are there?", "SELECT COUNT(*) FROM orders")
+
+            hit = QueryCache(path=path).get("db", "v1", "How many orders are there?")
+
+        self.assertEqual(hit.sql_query, "SELECT COUNT(*) FROM orders")
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        from sql_agent.repositories.result_cache import ResultCache
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        self.engine = create_engine("sqlite:///:memory:")
+        self.repository = SQLiteRepository(engine=self.engine, result_cache=ResultCache(max_bytes=1024 * 1024))
+        with self.engine.connect() as conn:
+            conn.execute(text("CREATE TABLE products (id INT PRIMARY KEY, name VARCHAR(255));"))
+            conn.execute(text("INSERT INTO products (id, name) VALUES (1, 'Laptop'), (2, 'Mouse');"))
+            conn.commit()
+
+    def test_repeated_query_is_served_from_cache(self):
+        first = self.repository.execute_query("SELECT * FROM products")
+        second = self.repository.execute_query("SELECT *\n  FROM products;")
+
+        self.assertFalse(first.cache_hit)
+        self.assertTrue(second.cache_hit)
+        self.assertEqual(second.rows, first.rows)
+        self.assertEqual(self.repository.result_cache.stats()["hits"], 1)
+
+    def test_table_change_invalidates_cached_result(self):
+        self.repository.execute_query("SELECT * FROM products")
+        with self.engine.connect() as conn:
+            conn.execute(text("INSERT INTO products (id, name) VALUES (3, 'Keyboard');"))
+            conn.commit()
+
+        result = self.repository.execute_query("SELECT * FROM products")
+
+        self.assertFalse(result.cache_hit)
+        self.assertEqual(len(result.rows), 3)
+
+    def test_same_size_update_of_a_database_file_invalidates_cached_result(self):
+        import tempfile
+        from sql_agent.repositories.result_cache import ResultCache
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "test.db")
+            engine = create_engine(f"sqlite:///{path}")
+            with engine.begin() as conn:
+                conn.execute(text("CREATE TABLE products (id INT PRIMARY KEY, name VARCHAR(255));"))
+                conn.execute(text("INSERT INTO products (id, name) VALUES (1, 'Laptop');"))
+            repository = SQLiteRepository(engine=engine, result_cache=ResultCache(max_bytes=1024 * 1024))
+            repository.execute_query("SELECT name FROM products")
+
+            # The file keeps its size and, as within one timestamp tick, its modification time
+            stat = os.stat(path)
+            with engine.begin() as conn:
+                conn.execute(text("UPDATE products SET name = 'Tablet' WHERE id = 1;"))
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual(os.stat(path).st_size, stat.st_size)
+
+            result = repository.execute_query("SELECT name FROM products")
+            engine.dispose()
+
+        self.assertFalse(result.cache_hit)
+        self.assertEqual(result.rows, [['Tablet']])
+
+
+class TestQueryLimit(unittest.TestCase):
+    def test_limit_is_appended_or_wrapped(self):
+        from sql_agent.repositories.query_wrapping import limit_query
+        self.assertEqual(limit_query("SELECT * FROM orders ORDER BY id;", 11), "SELECT * FROM orders ORDER BY id\nLIMIT 11")
+        self.assertEqual(limit_query("SELECT * FROM orders WHERE note = 'limit'", 11),
+                         "SELECT * FROM orders WHERE note = 'limit'\nLIMIT 11")
+        self.assertEqual(limit_query("SELECT * FROM orders LIMIT 50", 11),
+                         "SELECT * FROM (\nSELECT * FROM orders LIMIT 50\n) AS limited_query\nLIMIT 11")
+
+    def test_truncated_result_is_flagged(self):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        engine = create_engine("sqlite:///:memory:")
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE numbers (n INT PRIMARY KEY);"))
+            conn.execute(text("INSERT INTO numbers (n) VALUES (1), (2), (3);"))
+            conn.commit()
+        repository = SQLiteRepository(engine=engine)
+
+        truncated = repository.execute_query("SELECT n FROM numbers ORDER BY n DESC", max_rows=2)
+        complete = repository.execute_query("SELECT n FROM numbers ORDER BY n DESC", max_rows=3)
+
+        self.assertEqual(truncated.rows, [[3], [2]])
+        self.assertTrue(truncated.is_truncated)
+        self.assertEqual(complete.total_rows, 3)
+        self.assertFalse(complete.is_truncated)
+
+
+class TestStreamQuery(unittest.TestCase):
+    def test_result_is_streamed_in_growing_batches(self):
+        from sql_agent.repositories.sqlite_repository import SQLiteRepository
+        engine = create_engine("sqlite:///:memory:")
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE numbers (n INT PRIMARY KEY);"))
+            conn.execute(text("INSERT INTO numbers (n) VALUES (:n)"), [{"n": n} for n in range(2500)])
+            conn.commit()
+
+        stream = SQLiteRepository(engine=engine).stream_query("SELECT n FROM numbers ORDER BY n", batch_size=1000)
+        columns = next(stream)
+        batches = list(stream)
+
+        # Not bounded by max_rows; the first row is returned on its own, later batches are capped by batch_size
+        self.assertEqual(columns, ['n'])
+        self.assertEqual([len(batch) for batch in batches], [1, 10, 100, 1000, 1000, 389])
+        self.assertEqual([row[0] for batch in batches for row in batch], list(range(2500)))
+
+
+class TestAsyncAgent(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_connection_url = f"sqlite:///{os.path.join(self.directory.name, 'test.db')}"
+        engine = create_engine(self.db_connection_url)
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE customers (id INT PRIMARY KEY, name VARCHAR(255));"))
+            conn.execute(text("INSERT INTO customers (id, name) VALUES (1, 'Alice'), (2, 'Bob');"))
+            conn.commit()
+        engine.dispose()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @patch('sql_agent.graph.sql_generator')
+    @patch('sql_agent.graph.sql_corrector')
+    def test_concurrent_questions_with_correction(self, mock_sql_corrector, mock_sql_generator):
+        import asyncio
+        from unittest.mock import AsyncMock
+        from sql_agent.orchestrator import AsyncAgent
+
+        mock_sql_generator.ainvoke = AsyncMock(return_value="SELECT * FROM missing_table")
+        mock_sql_corrector.ainvoke = AsyncMock(return_value="SELECT * FROM customers")
+
+        async def ask_concurrently():
+            agent = AsyncAgent.with_connection_url(self.db_connection_url, ('customers',))
+            try:
+                return await asyncio.gather(*(agent.ask(f"Show me all customers {i}") for i in range(10)))
+            finally:
+                await agent.repository.dispose()
+
+        answers = asyncio.run(ask_concurrently())
+
+        # Every question fails execution once, is corrected and answered without blocking the others
+        self.assertEqual(mock_sql_generator.ainvoke.await_count, 10)
+        self.assertEqual(mock_sql_corrector.ainvoke.await_count, 10)
+        self.assertFalse(mock_sql_generator.invoke.called)
+        for answer in answers:
+            self.assertEqual(answer['result'].rows, [[1, 'Alice'], [2, 'Bob']])
+
+    @patch('sql_agent.graph.sql_generator')
+    def test_slower_candidates_are_cancelled(self, mock_sql_generator):
+        import asyncio
+        from sql_agent.orchestrator import AsyncAgent
+        cancelled = []
+
+        async def generate(inputs, config):
+            if config["configurable"]["temperature"] == 0:
+                try:
+                    await asyncio.sleep(30)
+                except asyncio.CancelledError:
+                    cancelled.append(config)
+                    raise
+            return "SELECT name FROM customers"
+
+        mock_sql_generator.ainvoke = generate
+
+        async def ask():
+            agent = AsyncAgent.with_connection_url(self.db_connection_url, ('customers',), generation_candidates=2)
+            try:
+                return await asyncio.wait_for(agent.ask("Show me all customer names"), timeout=10)
+            finally:
+                await agent.repository.dispose()
+
+        answer = asyncio.run(ask())
+
+        self.assertEqual(answer['result'].rows, [['Alice'], ['Bob']])
+        self.assertEqual(len(cancelled), 1)
+
+    def test_progress_is_streamed_before_the_answer(self):
+        import asyncio
+        from langchain_core.language_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage
+        from sql_agent.orchestrator import AsyncAgent
+        from sql_agent.sql_coder.generator import parse, sql_generation_prompt_template
+        model = GenericFakeChatModel(messages=iter([AIMessage("SELECT name FROM customers")]))
+
+        async def stream():
+            agent = AsyncAgent.with_connection_url(self.db_connection_url, ('customers',))
+            try:
+                return [event async for event in agent.stream("What are the names of the customers?")]
+            finally:
+                await agent.repository.dispose()
+
+        with patch('sql_agent.graph.sql_generator', sql_generation_prompt_template | model | parse):
+            events = asyncio.run(stream())
+
+        names = [event for event, _ in events]
+        tokens = [data["text"] for event, data in events if event == "token"]
+        self.assertEqual("".join(tokens), "SELECT name FROM customers")
+        self.assertEqual(names[len(tokens):], ["sql_generation", "validation", "execution", "answer"])
+        self.assertEqual(events[-1][1]["result"].rows, [["Alice"], ["Bob"]])
+
+    @patch('sql_agent.graph.sql_generator')
+    def test_identical_concurrent_questions_are_coalesced(self, mock_sql_generator):
+        import asyncio
+        from sql_agent.orchestrator import AsyncAgent
+
+        async def generate(inputs):
+            await asyncio.sleep(0.1)
+            return "SELECT name FROM customers"
+
+        mock_sql_generator.ainvoke = AsyncMock(side_effect=generate)
+
+        async def ask_concurrently():
+            agent = AsyncAgent.with_connection_url(self.db_connection_url, ('customers',))
+            try:
+                questions = ["Customer names?", "customer names", "Customer  names!"]
+                return await asyncio.gather(*(agent.ask(question) for question in questions)), agent.single_flight
+            finally:
+                await agent.repository.dispose()
+
+        answers, single_flight = asyncio.run(ask_concurrently())
+
+        self.assertEqual(mock_sql_generator.ainvoke.await_count, 1)
+        for answer in answers:
+            self.assertEqual(answer['result'].rows, [['Alice'], ['Bob']])
+        self.assertEqual(single_flight.stats()["coalesced"], 2)
+
+
+class TestAskMany(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        # Questions are answered in worker threads, which do not share in-memory SQLite databases
+        self.db_connection_url = f"sqlite:///{os.path.join(self.directory.name, 'test.db')}"
+        engine = create_engine(self.db_connection_url)
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE customers (id INT PRIMARY KEY, name VARCHAR(255));"))
+            conn.execute(text("INSERT INTO customers (id, name) VALUES (1, 'Alice'), (2, 'Bob');"))
+            conn.commit()
+        engine.dispose()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @patch('sql_agent.graph.sql_generator')
+    def test_answers_are_returned_in_order_with_errors(self, mock_sql_generator):
+        def generate(inputs, config=None):
+            if inputs["question"] == "Break":
+                raise ValueError("The model is unavailable")
+            if "names" in inputs["question"]:
+                return "SELECT name FROM customers ORDER BY id"
+            return "SELECT count(*) FROM customers"
+
+        mock_sql_generator.invoke.side_effect = generate
+        agent = SyncAgent.with_connection_url(self.db_connection_url, ('customers',))
+        questions = ["Customer names?", "How many customers?", "Break", "customer names"]
+
+        try:
+            answers = agent.ask_many(questions, max_concurrency=2)
+        finally:
+            agent.repository.engine.dispose()
+
+        self.assertEqual([answer.question for answer in answers], questions)
+        self.assertEqual(answers[0].answer['result'].rows, [['Alice'], ['Bob']])
+        self.assertEqual(answers[1].answer['result'].rows, [[2]])
+        self.assertIsNone(answers[2].answer)
+        self.assertIn("unavailable", str(answers[2].error))
+        # Identical questions are answered once
+        self.assertIs(answers[3].answer, answers[0].answer)
+        self.assertEqual(mock_sql_generator.invoke.call_count, 3)
+
+
+class TestReplayChatModel(unittest.TestCase):
+    def test_recorded_responses_are_replayed(self):
+        import tempfile
+        from langchain_core.language_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage
+        from sql_agent.sql_coder.replay import RecordingChatModel, ReplayChatModel
+
+        with tempfile.TemporaryDirectory() as directory:
+            fixture_path = os.path.join(directory, "fixture.jsonl")
+            model = GenericFakeChatModel(messages=iter([AIMessage("SELECT 1"), AIMessage("SELECT 2")]))
+            recorder = RecordingChatModel(model=model, fixture_path=fixture_path)
+            recorded = [recorder.invoke("Question").content for _ in range(2)]
+
+            replay = ReplayChatModel(fixture_path=fixture_path, latency_scale=0)
+            # Responses recorded for the same prompt are replayed in order, round robin
+            self.assertEqual([replay.invoke("Question").content for _ in range(3)], recorded + recorded[:1])
+            with self.assertRaises(LookupError):
+                replay.invoke("Another question")
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics_of_all_threads_are_rendered(self):
+        import threading
+        from sql_agent.metrics import Counter, Histogram, MetricsRegistry
+
+        registry = MetricsRegistry()
+        tokens = registry.register(Counter("tokens_total", "Tokens", ("kind",)))
+        duration = registry.register(Histogram("duration_seconds", "Duration", ("node",), buckets=(0.1, 1)))
+        registry.register_collector(lambda: [("cache_bytes", "gauge", "Cache size", [({}, 42)])])
+
+        def record():
+            tokens.inc("prompt", amount=10)
+            duration.observe(0.5, "validation")
+
+        # Values recorded by threads that finished are kept
+        threads = [threading.Thread(target=record) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tokens.inc("completion")
+        duration.observe(2, "validation")
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE tokens_total counter", lines)
+        self.assertIn('tokens_total{kind="prompt"} 30', lines)
+        self.assertIn('tokens_total{kind="completion"} 1', lines)
+        self.assertIn("# TYPE duration_seconds histogram", lines)
+        self.assertIn('duration_seconds_bucket{node="validation",le="0.1"} 0', lines)
+        self.assertIn('duration_seconds_bucket{node="validation",le="1"} 3', lines)
+        self.assertIn('duration_seconds_bucket{node="validation",le="+Inf"} 4', lines)
+        self.assertIn('duration_seconds_sum{node="validation"} 3.5', lines)
+        self.assertIn('duration_seconds_count{node="validation"} 4', lines)
+        self.assertIn("cache_bytes 42", lines)
+        # Shards of the finished threads were folded into one
+        self.assertEqual(len(tokens._shards), 1)
+
+
+class TestTracer(unittest.TestCase):
+    def test_unsampled_questions_are_summarized_when_failed_or_slow(self):
+        import threading
+        import time
+        from sql_agent.tracing import Tracer
+
+        exporting, release, exported = threading.Event(), threading.Event(), []
+
+        def exporter(batch):
+            exporting.set()
+            release.wait(5)
+            exported.extend(batch)
+
+        tracer = Tracer(sample_rate=0, slow_threshold=60, exporter=exporter, buffer_size=1, batch_size=1)
+
+        with tracer.trace("fast") as trace:
+            self.assertIsNone(trace.callbacks)
+            trace.answer = {"sql_query": "SELECT 1", "total_generations": 1}
+        with self.assertRaises(ValueError):
+            with tracer.trace("failed"):
+                raise ValueError("no such table")
+        exporting.wait(5)
+
+        tracer.slow_threshold = 0
+        for question in ("slow", "dropped"):
+            with tracer.trace(question) as trace:
+                trace.answer = {"sql_query": "SELECT 2", "total_generations": 2}
+
+        # The flusher is busy exporting and the buffer is full: the last record is dropped instead of waiting
+        self.assertEqual(tracer.stats()["dropped"], 1)
+        release.set()
+        for _ in range(500):
+            if len(exported) == 2:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(
+            [(record.question, record.reason) for record in exported], [("failed", "error"), ("slow", "slow")]
+        )
+        self.assertEqual(exported[0].error, "no such table")
+        self.assertEqual((exported[1].sql_query, exported[1].generations), ("SELECT 2", 2))
+        self.assertEqual(tracer.stats()["captured"], 2)
+
+    def test_sampled_questions_run_with_the_callback_handler(self):
+        from sql_agent.tracing import Tracer
+
+        handler = object()
+        tracer = Tracer(sample_rate=1, slow_threshold=0, callback_handler=handler, exporter=self.fail)
+        with self.assertRaises(ValueError):
+            with tracer.trace("failed") as trace:
+                self.assertEqual(trace.callbacks, [handler])
+                raise ValueError("no such table")
+        self.assertEqual(tracer.stats(), {"sampled": 1, "captured": 0, "dropped": 0, "exported": 0, "buffered": 0})
@@ -0,0 +1,199 @@
+import contextlib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+from langfuse.langchain import CallbackHandler
+
+logger = logging.getLogger(__name__)
+
+
+class TraceRecord(NamedTuple):
+    """Summary of a question that was not sampled but is traced anyway because it failed or was slow"""
+    question: str
+    reason: str
+    duration: float
+    sql_query: Optional[str] = None
+    error: Optional[str] = None
+    generations: int = 0
+
+
+class Trace:
+    """Tracing state of one question; ``callbacks`` is None unless the question was sampled"""
+
+    __slots__ = ("question", "callbacks", "started", "answer")
+
+    def __init__(self, question: str, callbacks: Optional[list]):
+        self.question = question
+        self.callbacks = callbacks
+        self.started = time.perf_counter()
+        self.answer = None
+
+
+def export_to_langfuse(records: List[TraceRecord]):
+    """Send trace records to Langfuse as one observation per question"""
+    from langfuse import get_client
+
+    client = get_client()
+    for record in records:
+        client.start_observation(
+            name="question",
+            input={"question": record.question},
+            output={"sql_query": record.sql_query, "error": record.error},
+            level="ERROR" if record.error else "WARNING",
+            status_message=record.error,
+            metadata={"reason": record.reason, "duration_seconds": record.duration, "generations": record.generations},
+        ).end()
+
+
+class Tracer:
+    """
+    Head-sampled tracing of questions.
+
+    Whether a question is traced is decided when it is asked: a ``sample_rate`` share of the questions run with the
+    Langfuse callback handler and are traced step by step. The others run without any callbacks, so LangChain has
+    nothing to dispatch; only once they finished, those that failed or took ``slow_threshold`` seconds or more are
+    summarized as a ``TraceRecord``. Records are queued in a buffer of ``buffer_size`` records that a background
+    thread hands to ``exporter`` in batches, at least every ``flush_interval`` seconds; when the buffer is full,
+    records are dropped instead of making the request wait.
+    """
+
+    def __init__(
+            self,
+            sample_rate: float = 0.01,
+            slow_threshold: float = 10.0,
+            callback_handler=None,
+            exporter: Callable[[List[TraceRecord]], None] = export_to_langfuse,
+            buffer_size: int = 1000,
+            batch_size: int = 100,
+            flush_interval: float = 5.0
+    ):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.callback_handler = callback_handler
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sampled = 0
+        self.captured = 0
+        self.dropped = 0
+        self.exported = 0
+        self._buffer: queue.Queue = queue.Queue(maxsize=buffer_size)
+        self._flusher: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # Serializes exports of the flusher thread and of ``flush``
+        self._export_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Factory method to create the tracer from environment variables; returns None when tracing is disabled"""
+        if os.environ.get('LANGFUSE_ENABLED', 'false').lower() not in ('1', 'true'):
+            return None
+        return cls(
+            sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', 0.01)),
+            slow_threshold=float(os.environ.get('TRACE_SLOW_THRESHOLD', 10)),
+            buffer_size=int(os.environ.get('TRACE_BUFFER_SIZE', 1000)),
+            flush_interval=float(os.environ.get('TRACE_FLUSH_INTERVAL', 5)),
+        )
+
+    @contextlib.contextmanager
+    def trace(self, question: str):
+        """
+        Trace the question answered within the block, which passes ``Trace.callbacks`` to the graph and sets
+        ``Trace.answer`` to the answer state
+        """
+        trace = Trace(question, self._callbacks() if random.random() < self.sample_rate else None)
+        try:
+            yield trace
+        except Exception as e:
+            self._finish(trace, str(e))
+            raise
+        else:
+            self._finish(trace, trace.answer.get("error") if trace.answer else None)
+
+    def _callbacks(self) -> list:
+        with self._lock:
+            self.sampled += 1
+            if self.callback_handler is None:
+                self.callback_handler = CallbackHandler()
+            return [self.callback_handler]
+
+    def _finish(self, trace: Trace, error: Optional[str]):
+        if trace.callbacks is not None:
+            return
+        duration = time.perf_counter() - trace.started
+        if error:
+            reason = "error"
+        elif duration >= self.slow_threshold:
+            reason = "slow"
+        else:
+            return
+
+        answer = trace.answer or {}
+        record = TraceRecord(
+            question=trace.question, reason=reason, duration=duration, sql_query=answer.get("sql_query"),
+            error=error, generations=answer.get("total_generations", 0)
+        )
+        self._start_flusher()
+        try:
+            self._buffer.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            self.captured += 1
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_periodically, name="trace-flusher", daemon=True)
+                    self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            batch = [self._buffer.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._buffer.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._export(batch)
+
+    def _export(self, batch: List[TraceRecord]):
+        with self._export_lock:
+            try:
+                self.exporter(batch)
+            except Exception:
+                logger.exception("Failed to export %d trace records", len(batch))
+                return
+        with self._lock:
+            self.exported += len(batch)
+
+    def flush(self):
+        """Export the buffered records now, e.g. before the process exits"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._buffer.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._export(batch)
+
+    def stats(self) -> dict:
+        """Sampled questions, records of unsampled questions captured, dropped and exported, and buffered records"""
+        with self._lock:
+            return {
+                "sampled": self.sampled,
+                "captured": self.captured,
+                "dropped": self.dropped,
+                "exported": self.exported,
+                "buffered": self._buffer.qsize(),
+            }
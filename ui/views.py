@@ -1,6 +1,9 @@
+import os
+
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny
 from django.shortcuts import render
+from django.urls import reverse
 
 
 class FrontendView(APIView):
@@ -10,4 +13,6 @@ class FrontendView(APIView):
     permission_classes = [AllowAny]
 
     def get(self, request):
-        return render(request, 'index.html')
+        # Progress is streamed from the endpoint matching the application server, see entrypoint.sh
+        stream_view = 'query-async-stream' if os.environ.get('SERVER') == 'uvicorn' else 'query-stream'
+        return render(request, 'index.html', {'stream_url': reverse(stream_view)})